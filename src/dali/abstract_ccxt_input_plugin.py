@@ -22,7 +22,17 @@ import logging
 from datetime import datetime, timezone
 from multiprocessing.pool import ThreadPool
 from time import sleep
-from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Union,
+    cast,
+)
 
 from ccxt import (
     DDoSProtection,
@@ -37,11 +47,12 @@ from rp2.logger import create_logger
 from rp2.rp2_decimal import ZERO, RP2Decimal
 from rp2.rp2_error import RP2RuntimeError
 
-from dali.abstract_input_plugin import AbstractInputPlugin
+from dali.abstract_input_plugin import AbstractInputPlugin, Checkpoint
 from dali.abstract_transaction import AbstractTransaction
 from dali.ccxt_pagination import (
     AbstractPaginationDetailSet,
     AbstractPaginationDetailsIterator,
+    PaginationCheckpoint,
     PaginationDetails,
 )
 from dali.configuration import Keyword
@@ -73,6 +84,9 @@ _WITHDRAWAL: str = "withdrawal"
 
 _MS_IN_SECOND: int = 1000
 
+# Records can show up on an exchange some time after their timestamp: incremental loads read again this much before the watermark
+_WATERMARK_OVERLAP_MS: int = 86400000
+
 
 class Trade(NamedTuple):
     base_asset: str
@@ -91,6 +105,11 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
 
     __DEFAULT_THREAD_COUNT: int = 1
 
+    # Endpoints with incremental loads
+    DEPOSITS_ENDPOINT: str = "deposits"
+    TRADES_ENDPOINT: str = "trades"
+    WITHDRAWALS_ENDPOINT: str = "withdrawals"
+
     def __init__(
         self,
         account_holder: str,
@@ -117,6 +136,11 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
     def _initialize_client(self) -> Exchange:
         raise NotImplementedError("Abstract method")
 
+    # The standard CCXT endpoints (deposits, trades, withdrawals) support incremental loads. Implicit API calls read the whole
+    # history every time: their results are merged with the cached ones.
+    def is_incremental(self) -> bool:
+        return True
+
     def exchange_name(self) -> str:
         raise NotImplementedError("Abstract method")
 
@@ -175,6 +199,36 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
     def _start_time_ms(self) -> int:
         return self.__start_time_ms
 
+    # Start time of the pagination of an endpoint: the exchange start time, or shortly before the watermark of the cached load
+    def _get_start_time_ms(self, endpoint: str) -> int:
+        watermark: Optional[int] = self._get_watermark(endpoint)
+        if watermark is None:
+            return self.__start_time_ms
+        return max(self.__start_time_ms, watermark - _WATERMARK_OVERLAP_MS)
+
+    # Moves the iterator to the checkpoint of the endpoint (if resuming) and returns the transactions read before it
+    def _restore_endpoint_checkpoint(self, endpoint: str, pagination_detail_iterator: AbstractPaginationDetailsIterator) -> ProcessOperationResult:
+        endpoint_result: ProcessOperationResult = ProcessOperationResult(in_transactions=[], out_transactions=[], intra_transactions=[])
+        checkpoint: Optional[Checkpoint] = self._get_checkpoint(endpoint)
+        if checkpoint is None:
+            return endpoint_result
+        pagination_detail_iterator.restore_checkpoint(cast(PaginationCheckpoint, checkpoint.position))
+        self.__logger.info("Resuming %s from checkpoint: %s", endpoint, checkpoint.position)
+        for transaction in checkpoint.items:
+            if isinstance(transaction, InTransaction):
+                endpoint_result.in_transactions.append(transaction)
+            elif isinstance(transaction, OutTransaction):
+                endpoint_result.out_transactions.append(transaction)
+            elif isinstance(transaction, IntraTransaction):
+                endpoint_result.intra_transactions.append(transaction)
+        return endpoint_result
+
+    # Checkpoints have the pagination position after the page and the transactions read from it
+    def _save_endpoint_checkpoint(
+        self, endpoint: str, pagination_detail_iterator: AbstractPaginationDetailsIterator, page_transactions: List[AbstractTransaction]
+    ) -> None:
+        self._append_checkpoint(endpoint, pagination_detail_iterator.get_checkpoint(), page_transactions)
+
     @property
     def _thread_count(self) -> int:
         return self.__thread_count
@@ -184,6 +238,7 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
         in_transactions: List[InTransaction] = []
         out_transactions: List[OutTransaction] = []
         intra_transactions: List[IntraTransaction] = []
+        load_time_ms: int = int(datetime.now().timestamp()) * _MS_IN_SECOND
 
         if self._client.has[_FETCH_DEPOSITS]:
             self._process_deposits(intra_transactions)
@@ -194,6 +249,10 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
             self._process_withdrawals(intra_transactions)
         self._process_implicit_api(in_transactions, out_transactions, intra_transactions)
 
+        # Everything up to the start of this load has been read (watermarks are only saved if the load succeeds)
+        for endpoint in (self.DEPOSITS_ENDPOINT, self.TRADES_ENDPOINT, self.WITHDRAWALS_ENDPOINT):
+            self._set_watermark(endpoint, load_time_ms)
+
         result.extend(in_transactions)
         result.extend(out_transactions)
         result.extend(intra_transactions)
@@ -215,6 +274,8 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
         has_pagination_detail_set: AbstractPaginationDetailSet = pagination_detail_set
 
         pagination_detail_iterator: AbstractPaginationDetailsIterator = iter(has_pagination_detail_set)
+        # Deposits are collected per endpoint, so that they can be checkpointed after each page
+        endpoint_result: ProcessOperationResult = self._restore_endpoint_checkpoint(self.DEPOSITS_ENDPOINT, pagination_detail_iterator)
 
         try:
             while True:
@@ -271,16 +332,22 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
                 with ThreadPool(self._thread_count) as pool:
                     processing_result_list = pool.map(self._process_transfer, deposits)
 
+                page_transactions: List[AbstractTransaction] = []
                 for processing_result in processing_result_list:
                     if processing_result is None:
                         continue
                     if processing_result.intra_transactions:
-                        intra_transactions.extend(processing_result.intra_transactions)
+                        endpoint_result.intra_transactions.extend(processing_result.intra_transactions)
+                        page_transactions.extend(processing_result.intra_transactions)
+
+                self._save_endpoint_checkpoint(self.DEPOSITS_ENDPOINT, pagination_detail_iterator, page_transactions)
 
         except StopIteration:
             # End of pagination details
             pass
 
+        intra_transactions.extend(endpoint_result.intra_transactions)
+
     def _process_gains(
         self,
         in_transactions: List[InTransaction],
@@ -311,6 +378,7 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
         has_pagination_detail_set: AbstractPaginationDetailSet = pagination_detail_set
 
         pagination_detail_iterator: AbstractPaginationDetailsIterator = iter(has_pagination_detail_set)
+        endpoint_result: ProcessOperationResult = self._restore_endpoint_checkpoint(self.TRADES_ENDPOINT, pagination_detail_iterator)
         try:
             while True:
                 pagination_details: PaginationDetails = next(pagination_detail_iterator)
@@ -354,18 +422,26 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
                 with ThreadPool(self._thread_count) as pool:
                     processing_result_list = pool.map(self._process_buy_and_sell, trades)
 
+                page_transactions: List[AbstractTransaction] = []
                 for processing_result in processing_result_list:
                     if processing_result is None:
                         continue
                     if processing_result.in_transactions:
-                        in_transactions.extend(processing_result.in_transactions)
+                        endpoint_result.in_transactions.extend(processing_result.in_transactions)
+                        page_transactions.extend(processing_result.in_transactions)
                     if processing_result.out_transactions:
-                        out_transactions.extend(processing_result.out_transactions)
+                        endpoint_result.out_transactions.extend(processing_result.out_transactions)
+                        page_transactions.extend(processing_result.out_transactions)
+
+                self._save_endpoint_checkpoint(self.TRADES_ENDPOINT, pagination_detail_iterator, page_transactions)
 
         except StopIteration:
             # End of pagination details
             pass
 
+        in_transactions.extend(endpoint_result.in_transactions)
+        out_transactions.extend(endpoint_result.out_transactions)
+
     def _process_withdrawals(
         self,
         intra_transactions: List[IntraTransaction],
@@ -380,6 +456,7 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
         has_pagination_detail_set: AbstractPaginationDetailSet = pagination_detail_set
 
         pagination_detail_iterator: AbstractPaginationDetailsIterator = iter(has_pagination_detail_set)
+        endpoint_result: ProcessOperationResult = self._restore_endpoint_checkpoint(self.WITHDRAWALS_ENDPOINT, pagination_detail_iterator)
 
         try:
             while True:
@@ -432,16 +509,22 @@ class AbstractCcxtInputPlugin(AbstractInputPlugin):
                 with ThreadPool(self._thread_count) as pool:
                     processing_result_list = pool.map(self._process_transfer, withdrawals)
 
+                page_transactions: List[AbstractTransaction] = []
                 for processing_result in processing_result_list:
                     if processing_result is None:
                         continue
                     if processing_result.intra_transactions:
-                        intra_transactions.extend(processing_result.intra_transactions)
+                        endpoint_result.intra_transactions.extend(processing_result.intra_transactions)
+                        page_transactions.extend(processing_result.intra_transactions)
+
+                self._save_endpoint_checkpoint(self.WITHDRAWALS_ENDPOINT, pagination_detail_iterator, page_transactions)
 
         except StopIteration:
             # End of pagination details
             pass
 
+        intra_transactions.extend(endpoint_result.intra_transactions)
+
     def __safe_api_call(
         self,
         function: Callable[..., Iterable[Dict[str, Union[str, float]]]],
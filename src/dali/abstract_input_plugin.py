@@ -12,13 +12,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Optional, cast
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, cast
 
 from rp2.abstract_country import AbstractCountry
 from rp2.rp2_error import RP2RuntimeError, RP2TypeError
 
 from dali.abstract_transaction import AbstractTransaction
-from dali.cache import load_from_cache, save_to_cache
+from dali.cache import (
+    append_to_cache,
+    get_schema,
+    load_from_cache,
+    load_records_from_cache,
+    remove_from_cache,
+    save_to_cache,
+)
+from dali.configuration import is_unknown
+from dali.in_transaction import InTransaction
+from dali.intra_transaction import IntraTransaction
+from dali.out_transaction import OutTransaction
+
+
+# Page of an endpoint read by a load: the position of the endpoint after the page (e.g. the URL of the next page) and its items
+class _CheckpointRecord(NamedTuple):
+    endpoint: str
+    position: object
+    items: List[object]
+
+
+# Position of an endpoint in a load that failed, and the items read up to it
+class Checkpoint(NamedTuple):
+    position: object
+    items: List[object]
+
+
+# Transaction caches (and checkpoints, which contain transactions) are invalidated when a transaction class changes
+_TRANSACTIONS_SCHEMA: str = get_schema(InTransaction, OutTransaction, IntraTransaction)
+_CHECKPOINTS_SCHEMA: str = get_schema(_CheckpointRecord, InTransaction, OutTransaction, IntraTransaction)
+
+
+# Transactions read again by an incremental load replace the cached ones with the same identity
+def _get_transaction_identity(transaction: AbstractTransaction) -> Tuple[str, ...]:
+    transaction_type: str = transaction.transaction_type if isinstance(transaction, (InTransaction, OutTransaction)) else ""
+    identity: Tuple[str, ...] = (
+        type(transaction).__name__,
+        transaction.unique_id,
+        transaction.asset,
+        transaction.timestamp,
+        transaction_type,
+    )
+    # Without a unique id, only the exchange data tells records apart
+    return identity + (transaction.raw_data,) if is_unknown(transaction.unique_id) else identity
+
+
+def merge_transactions(cached_transactions: List[AbstractTransaction], new_transactions: List[AbstractTransaction]) -> List[AbstractTransaction]:
+    identity_2_transaction: Dict[Tuple[str, ...], AbstractTransaction] = {
+        _get_transaction_identity(transaction): transaction for transaction in cached_transactions
+    }
+    for transaction in new_transactions:
+        identity_2_transaction[_get_transaction_identity(transaction)] = transaction
+    return list(identity_2_transaction.values())
 
 
 class AbstractInputPlugin:
@@ -33,6 +86,14 @@ class AbstractInputPlugin:
             raise RP2TypeError(f"account_holder is not a string: {account_holder}")
         self.__account_holder: str = account_holder
         self.__native_fiat: Optional[str] = native_fiat
+        # High-water marks (e.g. ms timestamps) per endpoint: the ones of the cached load, and the ones of the current load
+        self.__watermarks: Dict[str, int] = {}
+        self.__new_watermarks: Dict[str, int] = {}
+        # Checkpoints restored from a load that failed. Each page read is appended to the checkpoint file, so a failed load can be
+        # resumed from the last page read: a load that isn't resumed starts a new file.
+        self.__checkpoints: Dict[str, Checkpoint] = {}
+        self.__is_checkpoint_file_started: bool = False
+        self.__checkpoint_lock: Lock = Lock()
 
     def cache_key(self) -> Optional[str]:
         return None
@@ -40,13 +101,84 @@ class AbstractInputPlugin:
     def load(self, country: AbstractCountry) -> List[AbstractTransaction]:
         raise NotImplementedError("Abstract method: it must be implemented in the plugin class")
 
+    # Plugins that can read only the records after the watermarks of the cached load return True and use _get_watermark() and
+    # _set_watermark() in load()
+    def is_incremental(self) -> bool:
+        return False
+
+    # Reads the records added since the cached load and merges them into the cached transactions
+    def load_incrementally(self, country: AbstractCountry, cached_transactions: List[AbstractTransaction]) -> List[AbstractTransaction]:
+        if not self.is_incremental():
+            raise RP2RuntimeError("Plugin doesn't support incremental load")
+        # Watermarks are only valid together with the cached transactions they were recorded with
+        watermarks: Optional[Dict[str, int]] = cast(Optional[Dict[str, int]], load_from_cache(self._watermarks_cache_key(), schema=_TRANSACTIONS_SCHEMA))
+        self.__watermarks = watermarks if watermarks is not None else {}
+        self.__new_watermarks = {}
+        return merge_transactions(cached_transactions, self.load(country))
+
+    def _get_watermark(self, endpoint: str) -> Optional[int]:
+        return self.__watermarks.get(endpoint)
+
+    def _set_watermark(self, endpoint: str, watermark: int) -> None:
+        self.__new_watermarks[endpoint] = watermark
+
+    def _watermarks_cache_key(self) -> str:
+        return f"{self.cache_key()}-watermarks"
+
+    # Makes load() start from the checkpoints saved by a previous load that failed
+    def resume_from_checkpoints(self) -> None:
+        if self.cache_key() is None:
+            return
+        records: Optional[List[_CheckpointRecord]] = cast(
+            Optional[List[_CheckpointRecord]], load_records_from_cache(self._checkpoints_cache_key(), schema=_CHECKPOINTS_SCHEMA)
+        )
+        endpoint_2_position: Dict[str, object] = {}
+        endpoint_2_items: Dict[str, List[object]] = {}
+        for record in records if records is not None else []:
+            endpoint_2_position[record.endpoint] = record.position
+            endpoint_2_items.setdefault(record.endpoint, []).extend(record.items)
+        with self.__checkpoint_lock:
+            self.__checkpoints = {endpoint: Checkpoint(position, endpoint_2_items[endpoint]) for endpoint, position in endpoint_2_position.items()}
+            self.__is_checkpoint_file_started = True
+
+    # Called once the transactions of a successful load have been saved
+    def clear_checkpoints(self) -> None:
+        if self.cache_key() is None:
+            return
+        with self.__checkpoint_lock:
+            self.__checkpoints = {}
+            self.__is_checkpoint_file_started = False
+            remove_from_cache(self._checkpoints_cache_key())
+
+    def _get_checkpoint(self, endpoint: str) -> Optional[Checkpoint]:
+        with self.__checkpoint_lock:
+            return self.__checkpoints.get(endpoint)
+
+    # Saves the position of the endpoint after a page and the items of the page (not the ones read before it). Plugins without
+    # cache key have nowhere to save checkpoints. Endpoints of one plugin can be read by different threads, so records are
+    # appended under the lock.
+    def _append_checkpoint(self, endpoint: str, position: object, items: Sequence[object]) -> None:
+        if self.cache_key() is None:
+            return
+        with self.__checkpoint_lock:
+            if not self.__is_checkpoint_file_started:
+                # Checkpoints of a failed load that wasn't resumed
+                remove_from_cache(self._checkpoints_cache_key())
+                self.__is_checkpoint_file_started = True
+            append_to_cache(
+                self._checkpoints_cache_key(), _CheckpointRecord(endpoint, position, list(items)), schema=_CHECKPOINTS_SCHEMA, plugin=self._plugin_module()
+            )
+
+    def _checkpoints_cache_key(self) -> str:
+        return f"{self.cache_key()}-checkpoints.records"
+
     def load_from_cache(self) -> Optional[List[AbstractTransaction]]:
         cache_key = self.cache_key()  # pylint: disable=assignment-from-none
         if cache_key is None:
             raise RP2RuntimeError("Plugin doesn't support load cache")
         if not isinstance(cache_key, str):
             raise RP2RuntimeError("Plugin cache_key() doesn't return a string")
-        return cast(Optional[List[AbstractTransaction]], load_from_cache(cache_key))
+        return cast(Optional[List[AbstractTransaction]], load_from_cache(cache_key, schema=_TRANSACTIONS_SCHEMA))
 
     def save_to_cache(self, transactions: List[AbstractTransaction]) -> None:
         cache_key = self.cache_key()  # pylint: disable=assignment-from-none
@@ -54,7 +186,16 @@ class AbstractInputPlugin:
             raise RP2RuntimeError("Plugin doesn't support load cache")
         if not isinstance(cache_key, str):
             raise RP2RuntimeError("Plugin cache_key() doesn't return a string")
-        save_to_cache(cache_key, transactions)
+        save_to_cache(cache_key, transactions, schema=_TRANSACTIONS_SCHEMA, plugin=self._plugin_module())
+        if self.is_incremental():
+            # Watermarks are only valid with the transactions: they are invalidated together
+            watermarks: Dict[str, int] = dict(self.__watermarks)
+            watermarks.update(self.__new_watermarks)
+            save_to_cache(self._watermarks_cache_key(), watermarks, schema=_TRANSACTIONS_SCHEMA, plugin=self._plugin_module())
+
+    # Identifies the plugin that wrote a cache file in the cache manifest
+    def _plugin_module(self) -> str:
+        return type(self).__module__
 
     @property
     def account_holder(self) -> str:
@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime, timedelta
+import asyncio
+from datetime import date, datetime, timedelta, timezone
 from json import JSONDecodeError, loads
-from typing import Any, Dict, List, NamedTuple, Optional, cast
+from threading import RLock
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, cast
 
 import requests
 from requests.exceptions import ReadTimeout
@@ -26,7 +28,9 @@ from rp2.rp2_error import RP2RuntimeError, RP2TypeError
 from dali.cache import load_from_cache, save_to_cache
 from dali.configuration import HISTORICAL_PRICE_KEYWORD_SET
 from dali.historical_bar import HistoricalBar
+from dali.historical_bar_store import HistoricalBarStore, open_historical_bar_store
 from dali.logger import LOGGER
+from dali.single_flight import SingleFlight
 
 # exchangerates.host keywords
 _SUCCESS: str = "success"
@@ -36,9 +40,18 @@ _RATES: str = "rates"
 # exchangerates.host urls
 _EXCHANGE_BASE_URL: str = "https://api.exchangerate.host/"
 _EXCHANGE_SYMBOLS_URL: str = "https://api.exchangerate.host/symbols"
+_EXCHANGE_TIMESERIES_URL: str = "https://api.exchangerate.host/timeseries"
+
+# Maximum number of days returned by one timeseries request
+_TIMESERIES_MAX_DAYS: int = 366
 
 _DAYS_IN_SECONDS: int = 86400
+
+# Negative cache bucket of lookups that failed for lack of a route rather than of data at a given time
+_NO_ROUTE_BUCKET: int = -1
 _FIAT_EXCHANGE: str = "exchangerate.host"
+# Daily fiat rates: date -> base -> quote -> rate (change it when the structure changes, to invalidate old caches)
+_FIAT_RATES_SCHEMA: str = "Dict[date, Dict[str, Dict[str, RP2Decimal]]]"
 
 # First on the list has the most priority
 # This is hard-coded for now based on volume of each of these markets for BTC on Coinmarketcap.com
@@ -46,6 +59,12 @@ _FIAT_EXCHANGE: str = "exchangerate.host"
 _FIAT_PRIORITY: List[str] = ["USD", "JPY", "KRW", "EUR", "GBP", "AUD"]
 
 
+# Raised by native sources when a lookup failed without proving that there is no data (e.g. the exchange kept refusing the requests):
+# the price is missing, but the lookup isn't recorded in the negative cache, so that the next run tries again
+class UnavailableBarError(RP2RuntimeError):
+    pass
+
+
 class AssetPairAndTimestamp(NamedTuple):
     timestamp: datetime
     from_asset: str
@@ -53,24 +72,45 @@ class AssetPairAndTimestamp(NamedTuple):
     exchange: str
 
 
+class AssetPairAndExchange(NamedTuple):
+    from_asset: str
+    to_asset: str
+    exchange: str
+
+
+# Bar found for a lookup (if any) and the qualifier of its source in log messages
+_BarLookup = Tuple[Optional[HistoricalBar], str]
+
+
 class AbstractPairConverterPlugin:
     __ISSUES_URL: str = "https://github.com/eprbell/dali-rp2/issues"
     __TIMEOUT: int = 30
 
-    def __init__(self, historical_price_type: str, fiat_priority: Optional[str] = None) -> None:
+    def __init__(self, historical_price_type: str, fiat_priority: Optional[str] = None, negative_cache_ttl: Optional[int] = None) -> None:
         if not isinstance(historical_price_type, str):
             raise RP2TypeError(f"historical_price_type is not a string: {historical_price_type}")
         if historical_price_type not in HISTORICAL_PRICE_KEYWORD_SET:
             raise RP2TypeError(
                 f"historical_price_type must be one of {', '.join(sorted(HISTORICAL_PRICE_KEYWORD_SET))}, instead it was: {historical_price_type}"
             )
-        result = cast(Dict[AssetPairAndTimestamp, HistoricalBar], load_from_cache(self.cache_key()))
-        self.__cache: Dict[AssetPairAndTimestamp, HistoricalBar] = result if result is not None else {}
+        self.__cache: HistoricalBarStore = open_historical_bar_store(self.cache_key())
         self.__historical_price_type: str = historical_price_type
         self.__session: Session = requests.Session()
         self.__fiat_list: List[str] = []
         self.__fiat_priority: List[str]
         self.__fiat_priority = loads(fiat_priority) if fiat_priority is not None else _FIAT_PRIORITY
+        # Lookups that found no data are not repeated for this long (in hours): 0 disables the negative cache
+        self.__negative_cache_ttl: timedelta = timedelta(hours=negative_cache_ttl if negative_cache_ttl is not None else 0)
+
+        # Daily fiat rates: date -> base -> quote -> rate. Each exchangerate.host response has the rates of all quotes for a base,
+        # and rates between two quotes are triangulated through the base.
+        fiat_rates = cast(Dict[date, Dict[str, Dict[str, RP2Decimal]]], load_from_cache(self._fiat_rates_cache_key(), schema=_FIAT_RATES_SCHEMA))
+        self.__fiat_rates: Dict[date, Dict[str, Dict[str, RP2Decimal]]] = fiat_rates if fiat_rates is not None else {}
+        # Converters can be shared by worker threads: the lock guards the fiat list and the fiat rate table (not the downloads,
+        # which are deduplicated by day and base instead). The bar store has its own lock.
+        self.__fiat_lock: RLock = RLock()
+        self.__fiat_rate_flights: SingleFlight[Tuple[date, str], None] = SingleFlight()
+        self.__bar_lookup_flights: SingleFlight[AssetPairAndTimestamp, _BarLookup] = SingleFlight()
 
     def name(self) -> str:
         raise NotImplementedError("Abstract method: it must be implemented in the plugin class")
@@ -78,12 +118,36 @@ class AbstractPairConverterPlugin:
     def cache_key(self) -> str:
         raise NotImplementedError("Abstract method: it must be implemented in the plugin class")
 
+    # For candles read from an exchange, timestamped with their open time: they can be reused for other timestamps they cover
     def _add_bar_to_cache(self, key: AssetPairAndTimestamp, historical_bar: HistoricalBar) -> None:
-        self.__cache[self._floor_key(key)] = historical_bar
+        self.__cache.put(self._floor_key(key), historical_bar, native=True)
 
     def _get_bar_from_cache(self, key: AssetPairAndTimestamp) -> Optional[HistoricalBar]:
         return self.__cache.get(self._floor_key(key))
 
+    # Misses are kept per UTC day: an asset with no data at some time of the day (e.g. an airdrop without a market yet) is unlikely
+    # to have any later that day. A timestamp of None denotes the lack of a route between the assets.
+    def _is_known_miss(self, from_asset: str, to_asset: str, exchange: str, timestamp: Optional[datetime]) -> bool:
+        if self.__negative_cache_ttl <= timedelta(0):
+            return False
+        recorded: Optional[datetime] = self.__cache.get_miss((from_asset, to_asset, exchange, self._get_miss_bucket(timestamp)))
+        if recorded is None or datetime.now(timezone.utc) - recorded > self.__negative_cache_ttl:
+            return False
+        LOGGER.debug("Skipping %s/%s->%s on %s: no data found on %s", timestamp, from_asset, to_asset, exchange, recorded)
+        return True
+
+    def _add_miss(self, from_asset: str, to_asset: str, exchange: str, timestamp: Optional[datetime]) -> None:
+        if self.__negative_cache_ttl > timedelta(0):
+            self.__cache.put_miss((from_asset, to_asset, exchange, self._get_miss_bucket(timestamp)), datetime.now(timezone.utc))
+
+    @staticmethod
+    def _get_miss_bucket(timestamp: Optional[datetime]) -> int:
+        return int(timestamp.timestamp()) // _DAYS_IN_SECONDS if timestamp is not None else _NO_ROUTE_BUCKET
+
+    # Cached bars of any granularity (e.g. an hourly bar of an illiquid pair) that contain the timestamp of the key
+    def _get_covering_bar_from_cache(self, key: AssetPairAndTimestamp) -> Optional[HistoricalBar]:
+        return self.__cache.find_covering(key)
+
     # The most granular pricing available is 1 minute, to reduce the size of cache and increase the reuse of pricing data
     def _floor_key(self, key: AssetPairAndTimestamp) -> AssetPairAndTimestamp:
         raw_timestamp: datetime = key.timestamp
@@ -115,31 +179,97 @@ class AbstractPairConverterPlugin:
     def get_historic_bar_from_native_source(self, timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[HistoricalBar]:
         raise NotImplementedError("Abstract method: it must be implemented in the plugin class")
 
+    # Called by the transaction resolver before any call to get_conversion_rate(), with the minute-floored timestamps of all the
+    # prices it is going to need, grouped by pair and exchange. The plugin can fetch them in bulk and store them in its cache.
+    # It returns the pairs and timestamps it cannot price, so that the next plugin in the list can try them: the default
+    # implementation doesn't prefetch anything.
+    def prefetch_historical_bars(self, pair_2_timestamps: Dict[AssetPairAndExchange, List[datetime]]) -> Dict[AssetPairAndExchange, List[datetime]]:
+        return pair_2_timestamps
+
+    # Called once the plugin is no longer needed (after the transactions are resolved): plugins release their resources (e.g. threads) here
+    def close(self) -> None:
+        pass
+
+    # Bars are upserted into the store as they are found: this only flushes the ones that haven't been committed yet
     def save_historical_price_cache(self) -> None:
-        save_to_cache(self.cache_key(), self.__cache)
+        self.__cache.commit()
+        with self.__fiat_lock:
+            save_to_cache(self._fiat_rates_cache_key(), self.__fiat_rates, schema=_FIAT_RATES_SCHEMA, plugin=self.name())
+
+    def _fiat_rates_cache_key(self) -> str:
+        return f"{self.cache_key()}-fiat-rates"
 
     def get_conversion_rate(self, timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[RP2Decimal]:
-        result: Optional[RP2Decimal] = None
-        historical_bar: Optional[HistoricalBar] = None
         key: AssetPairAndTimestamp = AssetPairAndTimestamp(timestamp, from_asset, to_asset, exchange)
-        log_message_qualifier: str = ""
-        if key in self.__cache:
-            historical_bar = self.__cache[key]
-            log_message_qualifier = "cache of "
+        floored_key: AssetPairAndTimestamp = self._floor_key(key)
+        # Bars are cached by minute: lookups of the same minute (e.g. the fills of an order) share one fetch, even if they run
+        # concurrently. The price is still derived from the exact timestamp.
+        historical_bar, log_message_qualifier = self.__bar_lookup_flights.do(floored_key, lambda: self._lookup_bar(key, floored_key))
+        return self._derive_conversion_rate(key, historical_bar, log_message_qualifier)
+
+    def _lookup_bar(self, key: AssetPairAndTimestamp, floored_key: AssetPairAndTimestamp) -> _BarLookup:
+        historical_bar: Optional[HistoricalBar] = self.__cache.get(floored_key)
+        if historical_bar is not None:
+            return historical_bar, "cache of "
+        if self._is_known_miss(key.from_asset, key.to_asset, key.exchange, key.timestamp):
+            return None, ""
+        try:
+            historical_bar = self.get_historic_bar_from_native_source(key.timestamp, key.from_asset, key.to_asset, key.exchange)
+        except UnavailableBarError as exc:
+            LOGGER.info("Price of %s/%s->%s on %s not available: %s", key.timestamp, key.from_asset, key.to_asset, key.exchange, exc)
+            return None, ""
+        self._cache_native_source_result(floored_key, historical_bar)
+        return historical_bar, ""
+
+    # Batch version of get_conversion_rate(), with the same cache semantics. Lookups that miss the cache run concurrently on the
+    # event loop: plugins that override get_historic_bar_from_native_source_async() overlap their network waits, the others run
+    # get_historic_bar_from_native_source() on the default executor.
+    async def get_conversion_rates(self, keys: Iterable[AssetPairAndTimestamp]) -> Dict[AssetPairAndTimestamp, Optional[RP2Decimal]]:
+        unique_keys: List[AssetPairAndTimestamp] = list(dict.fromkeys(keys))
+        # One lookup per minute, with the first key of that minute
+        floored_key_2_key: Dict[AssetPairAndTimestamp, AssetPairAndTimestamp] = {}
+        for key in unique_keys:
+            floored_key_2_key.setdefault(self._floor_key(key), key)
+        bar_lookups: List[_BarLookup] = await asyncio.gather(*(self._lookup_bar_async(key, floored_key) for floored_key, key in floored_key_2_key.items()))
+        floored_key_2_bar_lookup: Dict[AssetPairAndTimestamp, _BarLookup] = dict(zip(floored_key_2_key, bar_lookups))
+        return {key: self._derive_conversion_rate(key, *floored_key_2_bar_lookup[self._floor_key(key)]) for key in unique_keys}
+
+    async def _lookup_bar_async(self, key: AssetPairAndTimestamp, floored_key: AssetPairAndTimestamp) -> _BarLookup:
+        historical_bar: Optional[HistoricalBar] = self.__cache.get(floored_key)
+        if historical_bar is not None:
+            return historical_bar, "cache of "
+        if self._is_known_miss(key.from_asset, key.to_asset, key.exchange, key.timestamp):
+            return None, ""
+        try:
+            historical_bar = await self.get_historic_bar_from_native_source_async(key.timestamp, key.from_asset, key.to_asset, key.exchange)
+        except UnavailableBarError as exc:
+            LOGGER.info("Price of %s/%s->%s on %s not available: %s", key.timestamp, key.from_asset, key.to_asset, key.exchange, exc)
+            return None, ""
+        self._cache_native_source_result(floored_key, historical_bar)
+        return historical_bar, ""
+
+    async def get_historic_bar_from_native_source_async(self, timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[HistoricalBar]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_historic_bar_from_native_source, timestamp, from_asset, to_asset, exchange)
+
+    def _cache_native_source_result(self, key: AssetPairAndTimestamp, historical_bar: Optional[HistoricalBar]) -> None:
+        if historical_bar:
+            # The native source may have cached the same bar as a candle already: don't overwrite it, or it would stop covering
+            if self.__cache.get(key) is None:
+                self.__cache.put(key, historical_bar)
         else:
-            historical_bar = self.get_historic_bar_from_native_source(timestamp, from_asset, to_asset, exchange)
-            if historical_bar:
-                self.__cache[key] = historical_bar
+            self._add_miss(key.from_asset, key.to_asset, key.exchange, key.timestamp)
 
+    def _derive_conversion_rate(self, key: AssetPairAndTimestamp, historical_bar: Optional[HistoricalBar], log_message_qualifier: str) -> Optional[RP2Decimal]:
+        result: Optional[RP2Decimal] = None
         if historical_bar:
-            result = historical_bar.derive_transaction_price(timestamp, self.__historical_price_type)
+            result = historical_bar.derive_transaction_price(key.timestamp, self.__historical_price_type)
             LOGGER.debug(
                 "Fetched %s conversion rate %s for %s/%s->%s from %splugin %s: %s",
                 self.__historical_price_type,
                 result,
-                timestamp,
-                from_asset,
-                to_asset,
+                key.timestamp,
+                key.from_asset,
+                key.to_asset,
                 log_message_qualifier,
                 self.name(),
                 historical_bar,
@@ -179,6 +309,10 @@ class AbstractPairConverterPlugin:
             LOGGER.info("Fetching of fiat symbols failed. The server might be down. Please try again later.")
             raise RP2RuntimeError("JSON decode error") from exc
 
+    # Used by plugins that persist the fiat list, to avoid querying exchangerate.host at every run
+    def _set_fiat_list(self, fiat_list: List[str]) -> None:
+        self.__fiat_list = fiat_list
+
     def _add_fiat_edges_to_graph(self, graph: Dict[str, Dict[str, None]], markets: Dict[str, List[str]]) -> None:
         if not self.__fiat_list:
             self._build_fiat_list()
@@ -213,45 +347,120 @@ class AbstractPairConverterPlugin:
 
     def _is_fiat(self, asset: str) -> bool:
         if not self.__fiat_list:
-            self._build_fiat_list()
+            with self.__fiat_lock:
+                if not self.__fiat_list:
+                    self._build_fiat_list()
 
         return asset in self.__fiat_list
 
     def _get_fiat_exchange_rate(self, timestamp: datetime, from_asset: str, to_asset: str) -> Optional[HistoricalBar]:
-        result: Optional[HistoricalBar] = None
-        params: Dict[str, Any] = {"base": from_asset, "symbols": to_asset}
-        request_count: int = 0
         # exchangerate.host only gives us daily accuracy, which should be suitable for tax reporting
-        while request_count < 5:
+        rate_date: date = timestamp.date()
+        rate: Optional[RP2Decimal] = self._get_fiat_rate_from_table(rate_date, from_asset, to_asset)
+        if rate is None and not self._has_fiat_rates(rate_date, from_asset):
+            # Workers pricing the same day in the same base share one request
+            self.__fiat_rate_flights.do((rate_date, from_asset), lambda: self._download_fiat_rates(rate_date, from_asset))
+            rate = self._get_fiat_rate_from_table(rate_date, from_asset, to_asset)
+
+        if rate is None:
+            return None
+        return HistoricalBar(
+            duration=timedelta(seconds=_DAYS_IN_SECONDS),
+            timestamp=timestamp,
+            open=rate,
+            high=rate,
+            low=rate,
+            close=rate,
+            volume=ZERO,
+        )
+
+    def _download_fiat_rates(self, rate_date: date, base: str) -> None:
+        # A download that finished while this one was waiting to start may have added the rates
+        if self._has_fiat_rates(rate_date, base):
+            return
+        # No symbols parameter: the response contains the rates of all the fiat currencies
+        data: Any = self._get_exchangerate_host_data(f"{_EXCHANGE_BASE_URL}{rate_date.isoformat()}", {"base": base})
+        # {
+        #     'motd':
+        #         {
+        #             'msg': 'If you or your company ...',
+        #             'url': 'https://exchangerate.host/#/donate'
+        #         },
+        #     'success': True,
+        #     'historical': True,
+        #     'base': 'EUR',
+        #     'date': '2020-04-04',
+        #     'rates':
+        #         {
+        #             'USD': 1.0847, ... // float, Lists all supported currencies unless you specify
+        #         }
+        # }
+        if data[_SUCCESS]:
+            self._add_fiat_rates(rate_date, base, data[_RATES])
+
+    def _has_fiat_rates(self, rate_date: date, base: str) -> bool:
+        with self.__fiat_lock:
+            return base in self.__fiat_rates.get(rate_date, {})
+
+    def _add_fiat_rates(self, rate_date: date, base: str, rates: Dict[str, Any]) -> None:
+        quote_2_rate: Dict[str, RP2Decimal] = {quote: RP2Decimal(str(rate)) for quote, rate in rates.items() if rate}
+        with self.__fiat_lock:
+            self.__fiat_rates.setdefault(rate_date, {})[base] = quote_2_rate
+
+    def _get_fiat_rate_from_table(self, rate_date: date, from_asset: str, to_asset: str) -> Optional[RP2Decimal]:
+        with self.__fiat_lock:
+            base_2_rates: Dict[str, Dict[str, RP2Decimal]] = self.__fiat_rates.get(rate_date, {})
+            if from_asset in base_2_rates:
+                return RP2Decimal("1") if from_asset == to_asset else base_2_rates[from_asset].get(to_asset)
+
+            # Cross rate: from_asset -> base -> to_asset
+            for base, rates in base_2_rates.items():
+                from_rate: Optional[RP2Decimal] = RP2Decimal("1") if from_asset == base else rates.get(from_asset)
+                to_rate: Optional[RP2Decimal] = RP2Decimal("1") if to_asset == base else rates.get(to_asset)
+                if from_rate and to_rate:
+                    return to_rate / from_rate
+
+        return None
+
+    # Downloads the daily rates of all fiat currencies for the days the given timestamps fall on, with one request per year
+    # of data. Afterwards _get_fiat_exchange_rate() doesn't need the network for any fiat pair on these days.
+    def _prefetch_fiat_exchange_rates(self, base: str, timestamps: Iterable[datetime]) -> None:
+        with self.__fiat_lock:
+            # Days that only have the rates of other bases are still downloaded
+            missing_dates: Set[date] = {timestamp.date() for timestamp in timestamps if base not in self.__fiat_rates.get(timestamp.date(), {})}
+        if not missing_dates:
+            return
+        start_date: date = min(missing_dates)
+        end_date: date = max(missing_dates)
+        LOGGER.debug("Prefetching %s fiat exchange rates from %s to %s", base, start_date, end_date)
+        while start_date <= end_date:
+            page_end_date: date = min(end_date, start_date + timedelta(days=_TIMESERIES_MAX_DAYS - 1))
+            # {
+            #     'success': True,
+            #     'timeseries': True,
+            #     'base': 'USD',
+            #     'start_date': '2020-01-01',
+            #     'end_date': '2020-01-02',
+            #     'rates':
+            #         {
+            #             '2020-01-01': {'JPY': 108.6, ...},
+            #             '2020-01-02': {'JPY': 108.5, ...},
+            #         }
+            # }
+            data: Any = self._get_exchangerate_host_data(
+                _EXCHANGE_TIMESERIES_URL, {"base": base, "start_date": start_date.isoformat(), "end_date": page_end_date.isoformat()}
+            )
+            if data[_SUCCESS]:
+                for rate_date, rates in data[_RATES].items():
+                    self._add_fiat_rates(date.fromisoformat(rate_date), base, rates)
+            start_date = page_end_date + timedelta(days=1)
+
+    def _get_exchangerate_host_data(self, url: str, params: Dict[str, Any]) -> Any:
+        request_count: int = 0
+        while True:
             try:
-                response: Response = self.__session.get(f"{_EXCHANGE_BASE_URL}{timestamp.strftime('%Y-%m-%d')}", params=params, timeout=self.__TIMEOUT)
-                # {
-                #     'motd':
-                #         {
-                #             'msg': 'If you or your company ...',
-                #             'url': 'https://exchangerate.host/#/donate'
-                #         },
-                #     'success': True,
-                #     'historical': True,
-                #     'base': 'EUR',
-                #     'date': '2020-04-04',
-                #     'rates':
-                #         {
-                #             'USD': 1.0847, ... // float, Lists all supported currencies unless you specify
-                #         }
-                # }
-                data: Any = response.json()
-                if data[_SUCCESS]:
-                    result = HistoricalBar(
-                        duration=timedelta(seconds=_DAYS_IN_SECONDS),
-                        timestamp=timestamp,
-                        open=RP2Decimal(str(data[_RATES][to_asset])),
-                        high=RP2Decimal(str(data[_RATES][to_asset])),
-                        low=RP2Decimal(str(data[_RATES][to_asset])),
-                        close=RP2Decimal(str(data[_RATES][to_asset])),
-                        volume=ZERO,
-                    )
-                break
+                response: Response = self.__session.get(url, params=params, timeout=self.__TIMEOUT)
+                return response.json()
 
             except (JSONDecodeError, ReadTimeout) as exc:
                 LOGGER.debug("Fetching of fiat exchange rates failed. The server might be down. Retrying the connection.")
@@ -260,5 +469,3 @@ class AbstractPairConverterPlugin:
                     LOGGER.info("Giving up after 4 tries. Saving to Cache.")
                     self.save_historical_price_cache()
                     raise RP2RuntimeError("JSON decode error") from exc
-
-        return result
@@ -0,0 +1,172 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2TypeError
+
+from dali.historical_bar import HistoricalBar
+
+# Bars added after loading are kept in a dictionary and merged into the columns when there are this many of them:
+# merging costs O(n), so doing it at every insertion would make bulk fetches quadratic.
+_MERGE_THRESHOLD: int = 1024
+
+# Lookup timestamps are floored to the minute, so they can precede the bar timestamp by up to this many microseconds
+_KEY_SLACK: int = 60_000_000
+
+_EPOCH: datetime = datetime.fromtimestamp(0, timezone.utc)
+_PRICE_COLUMNS: Tuple[str, ...] = ("open", "high", "low", "close", "volume")
+
+# (timestamp, duration, bar timestamp, open, high, low, close, volume, native): times in microseconds, prices as decimal strings.
+# Native is 1 for candles read from an exchange (REST API or CSV), whose bar timestamp and duration are the real ones: only those can
+# cover other timestamps. Bars synthesized by pair converters (route products, fiat rates) are only valid for their lookup timestamp.
+BarRow = Tuple[int, int, int, str, str, str, str, str, int]
+
+
+def to_microseconds(timestamp: datetime) -> int:
+    if timestamp.tzinfo is None:
+        raise RP2TypeError(f"Historical bar store timestamps must be timezone-aware: {timestamp}")
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_microseconds(microseconds: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=microseconds)
+
+
+def bar_to_row(timestamp: int, historical_bar: HistoricalBar, native: bool = False) -> BarRow:
+    return (
+        timestamp,
+        historical_bar.duration // timedelta(microseconds=1),
+        to_microseconds(historical_bar.timestamp),
+        str(historical_bar.open),
+        str(historical_bar.high),
+        str(historical_bar.low),
+        str(historical_bar.close),
+        str(historical_bar.volume),
+        int(native),
+    )
+
+
+def row_to_bar(row: BarRow) -> HistoricalBar:
+    return HistoricalBar(
+        duration=timedelta(microseconds=row[1]),
+        timestamp=from_microseconds(row[2]),
+        open=RP2Decimal(row[3]),
+        high=RP2Decimal(row[4]),
+        low=RP2Decimal(row[5]),
+        close=RP2Decimal(row[6]),
+        volume=RP2Decimal(row[7]),
+    )
+
+
+def _is_finer(row: BarRow, other: Optional[BarRow]) -> bool:
+    return other is None or (row[1], -row[2]) < (other[1], -other[2])
+
+
+# Columnar storage for the bars of one (from_asset, to_asset, exchange): a sorted int64 array of lookup timestamps, int64 arrays
+# of durations and bar timestamps, an int8 array of native flags, and byte-string arrays of decimal prices (which keep the exact
+# value of RP2Decimal). This takes a few dozen bytes per bar instead of the kilobyte or so of a HistoricalBar with its datetime,
+# timedelta and decimals: HistoricalBar objects are only created for the bars that are looked up. Not thread-safe: callers must hold a lock.
+class BarSeries:
+    def __init__(self, rows: Iterable[BarRow] = ()) -> None:
+        self.__timestamps: np.ndarray = np.empty(0, dtype=np.int64)
+        self.__durations: np.ndarray = np.empty(0, dtype=np.int64)
+        self.__bar_timestamps: np.ndarray = np.empty(0, dtype=np.int64)
+        self.__natives: np.ndarray = np.empty(0, dtype=np.int8)
+        self.__prices: List[np.ndarray] = [np.empty(0, dtype="S1") for _ in _PRICE_COLUMNS]
+        self.__pending: Dict[int, BarRow] = {}
+        self.__max_duration: int = 0
+        for row in rows:
+            self.add(row)
+        self._merge()
+
+    def __len__(self) -> int:
+        self._merge()
+        return len(self.__timestamps)
+
+    # Upserts a bar: it replaces the bar with the same lookup timestamp, if any
+    def add(self, row: BarRow) -> None:
+        self.__pending[row[0]] = row
+        self.__max_duration = max(self.__max_duration, row[1])
+        if len(self.__pending) >= _MERGE_THRESHOLD:
+            self._merge()
+
+    def get(self, timestamp: int) -> Optional[HistoricalBar]:
+        row: Optional[BarRow] = self.get_row(timestamp)
+        return row_to_bar(row) if row is not None else None
+
+    def get_row(self, timestamp: int) -> Optional[BarRow]:
+        if timestamp in self.__pending:
+            return self.__pending[timestamp]
+        index: int = int(np.searchsorted(self.__timestamps, timestamp))
+        if index >= len(self.__timestamps) or int(self.__timestamps[index]) != timestamp:
+            return None
+        return self._row(index)
+
+    # Returns the shortest native bar with bar timestamp <= timestamp < bar timestamp + duration (the latest one if there are several).
+    # Bars are sorted by lookup timestamp, so only the window that the longest bar could span is scanned.
+    def find_covering_row(self, timestamp: int) -> Optional[BarRow]:
+        result: Optional[BarRow] = None
+        for row in self.__pending.values():
+            if row[8] and row[2] <= timestamp < row[2] + row[1] and _is_finer(row, result):
+                result = row
+
+        start: int = int(np.searchsorted(self.__timestamps, timestamp - self.__max_duration - _KEY_SLACK, side="left"))
+        end: int = int(np.searchsorted(self.__timestamps, timestamp, side="right"))
+        bar_timestamps: np.ndarray = self.__bar_timestamps[start:end]
+        durations: np.ndarray = self.__durations[start:end]
+        candidates: np.ndarray = np.flatnonzero((self.__natives[start:end] != 0) & (bar_timestamps <= timestamp) & (timestamp < bar_timestamps + durations))
+        if len(candidates) > 0:
+            best: int = int(candidates[np.lexsort((-bar_timestamps[candidates], durations[candidates]))[0]])
+            column_row: BarRow = self._row(start + best)
+            if _is_finer(column_row, result):
+                result = column_row
+
+        return result
+
+    def _row(self, index: int) -> BarRow:
+        open_price, high, low, close, volume = (column[index].decode() for column in self.__prices)
+        return (
+            int(self.__timestamps[index]),
+            int(self.__durations[index]),
+            int(self.__bar_timestamps[index]),
+            open_price,
+            high,
+            low,
+            close,
+            volume,
+            int(self.__natives[index]),
+        )
+
+    def _merge(self) -> None:
+        if not self.__pending:
+            return
+        new_rows: List[BarRow] = sorted(self.__pending.values())
+        self.__pending = {}
+        new_timestamps: np.ndarray = np.array([row[0] for row in new_rows], dtype=np.int64)
+        # Upserted bars replace the old ones
+        kept: np.ndarray = ~np.isin(self.__timestamps, new_timestamps)
+        timestamps: np.ndarray = np.concatenate((self.__timestamps[kept], new_timestamps))
+        order: np.ndarray = np.argsort(timestamps, kind="stable")
+        self.__timestamps = timestamps[order]
+        self.__durations = np.concatenate((self.__durations[kept], np.array([row[1] for row in new_rows], dtype=np.int64)))[order]
+        self.__bar_timestamps = np.concatenate((self.__bar_timestamps[kept], np.array([row[2] for row in new_rows], dtype=np.int64)))[order]
+        self.__natives = np.concatenate((self.__natives[kept], np.array([row[8] for row in new_rows], dtype=np.int8)))[order]
+        self.__prices = [
+            np.concatenate((column[kept], np.array([str(row[3 + offset]).encode() for row in new_rows], dtype=np.bytes_)))[order]
+            for offset, column in enumerate(self.__prices)
+        ]
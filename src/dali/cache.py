@@ -13,29 +13,434 @@
 # limitations under the License.
 
 
+import json
 import os
 import pickle  # nosec
-from typing import Any
+import struct
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib import import_module
+from inspect import signature
+from io import BytesIO
+from tempfile import mkstemp
+from threading import RLock
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    cast,
+)
 
-from rp2.rp2_error import RP2TypeError
+from rp2.rp2_error import RP2RuntimeError, RP2TypeError, RP2ValueError
+
+from dali.logger import LOGGER
 
 CACHE_DIR: str = ".dali_cache"
 
+# Describes each cache file: DaLI version and plugin that wrote it, schema of its data and creation time
+CACHE_MANIFEST: str = "manifest.json"
 
-def load_from_cache(cache_name: str) -> Any:
-    cache_path = os.path.join(CACHE_DIR, cache_name)
-    if not os.path.exists(cache_path):
+# Compression of new cache files: zstd, lz4 or none (the default is the best one installed)
+CACHE_COMPRESSION_ENVIRONMENT_VARIABLE: str = "DALI_CACHE_COMPRESSION"
+
+# Cache files start with a fixed-size header (magic, format version, compression, pickle protocol, payload size and CRC-32), so
+# that truncated, corrupted and stale files are detected without unpickling them. Files without the magic are plain pickles written
+# by previous versions of DaLI.
+_MAGIC: bytes = b"DALICACHE\0"
+_HEADER_FORMAT: str = ">HBBQI"
+_HEADER_SIZE: int = len(_MAGIC) + struct.calcsize(_HEADER_FORMAT)
+_FORMAT_VERSION: int = 1
+
+_NONE: str = "none"
+_ZSTD: str = "zstd"
+_LZ4: str = "lz4"
+_COMPRESSION_2_CODE: Dict[str, int] = {_NONE: 0, _ZSTD: 1, _LZ4: 2}
+_CODE_2_COMPRESSION: Dict[int, str] = {code: compression for compression, code in _COMPRESSION_2_CODE.items()}
+_COMPRESSION_2_MODULE: Dict[str, str] = {_ZSTD: "zstandard", _LZ4: "lz4.frame"}
+
+_CHUNK_SIZE: int = 1024 * 1024
+
+# Manifest updates are read-modify-write operations
+_MANIFEST_LOCK: RLock = RLock()
+
+# Functions converting data of an old schema (the key) to the current one
+CacheMigrations = Dict[str, Callable[[Any], Any]]
+
+
+class CacheManifestEntry(NamedTuple):
+    dali_version: str
+    plugin: Optional[str]
+    schema: Optional[str]
+    created: str
+
+
+class _Header(NamedTuple):
+    format_version: int
+    compression: str
+    pickle_protocol: int
+    payload_size: int
+    checksum: int
+
+
+# Compression libraries are optional dependencies (pip install dali-rp2[compression])
+def _import_compression_module(compression: str) -> Any:
+    try:
+        return import_module(_COMPRESSION_2_MODULE[compression])
+    except ImportError:
         return None
+
+
+def _get_dali_version() -> str:
+    try:
+        return cast(str, import_module("importlib.metadata").version("dali-rp2"))
+    except ImportError:
+        # Python < 3.8 or DaLI not installed
+        return "unknown"
+
+
+_DALI_VERSION: str = _get_dali_version()
+
+
+# Describes the structure of cached classes: NamedTuples by their fields, other classes by the parameters of their constructor. When
+# a class changes (e.g. HistoricalBar gains a field), so does the schema, and caches saved with the old schema are invalidated.
+def get_schema(*classes: type) -> str:
+    descriptions: List[str] = []
+    for cls in classes:
+        fields: Optional[Tuple[str, ...]] = getattr(cls, "_fields", None)
+        if fields is None:
+            fields = tuple(signature(cls).parameters)
+        descriptions.append(f"{cls.__module__}.{cls.__qualname__}({','.join(fields)})")
+    return ";".join(descriptions)
+
+
+def get_cache_manifest() -> Dict[str, CacheManifestEntry]:
+    manifest_path: str = os.path.join(CACHE_DIR, CACHE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            raw_manifest: Any = json.load(manifest_file)
+    except ValueError:
+        LOGGER.warning("Ignoring corrupted cache manifest: %s", manifest_path)
+        return {}
+    return {
+        cache_name: CacheManifestEntry(
+            dali_version=str(fields.get("dali_version", "unknown")),
+            plugin=fields.get("plugin"),
+            schema=fields.get("schema"),
+            created=str(fields.get("created", "")),
+        )
+        for cache_name, fields in raw_manifest.items()
+        if isinstance(fields, dict)
+    }
+
+
+def _save_cache_manifest(manifest: Dict[str, CacheManifestEntry]) -> None:
+    with _open_atomically(os.path.join(CACHE_DIR, CACHE_MANIFEST)) as manifest_file:
+        manifest_file.write(json.dumps({cache_name: entry._asdict() for cache_name, entry in sorted(manifest.items())}, indent=4).encode("utf-8"))
+
+
+# Records a cache file in the manifest. save_to_cache() calls it: caches with their own file format (e.g. HistoricalBarStore) call
+# it directly. The creation time is reset when the schema changes.
+def register_cache(cache_name: str, schema: Optional[str] = None, plugin: Optional[str] = None) -> None:
+    with _MANIFEST_LOCK:
+        manifest: Dict[str, CacheManifestEntry] = get_cache_manifest()
+        entry: Optional[CacheManifestEntry] = manifest.get(cache_name)
+        created: str = entry.created if entry is not None and entry.schema == schema else datetime.now(timezone.utc).isoformat()
+        new_entry: CacheManifestEntry = CacheManifestEntry(dali_version=_DALI_VERSION, plugin=plugin, schema=schema, created=created)
+        if new_entry != entry:
+            manifest[cache_name] = new_entry
+            _save_cache_manifest(manifest)
+
+
+def _unregister_cache(cache_name: str) -> None:
+    with _MANIFEST_LOCK:
+        manifest: Dict[str, CacheManifestEntry] = get_cache_manifest()
+        if manifest.pop(cache_name, None) is not None:
+            _save_cache_manifest(manifest)
+
+
+# The file is written to a temporary file, which replaces the file at path only once it's complete and on disk: an interrupted
+# write leaves the previous file as it was.
+@contextmanager
+def _open_atomically(path: str) -> Iterator[IO[bytes]]:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file_descriptor, temporary_path = mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as output_file:
+            yield output_file
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+# Computes size and CRC-32 of the payload while it's streamed to the file
+class _ChecksumWriter:
+    def __init__(self, output_file: IO[bytes]) -> None:
+        self.__output_file: IO[bytes] = output_file
+        self.size: int = 0
+        self.checksum: int = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+        return self.__output_file.write(data)
+
+    def flush(self) -> None:
+        self.__output_file.flush()
+
+
+# Computes size and CRC-32 of the payload while it's streamed from the file, so that the file is read only once
+class _ChecksumReader:
+    def __init__(self, input_file: IO[bytes]) -> None:
+        self.__input_file: IO[bytes] = input_file
+        self.size: int = 0
+        self.checksum: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+        return self.__update(self.__input_file.read(size))
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.__update(self.__input_file.readline(size))
+
+    # Decompressors and pickle may stop before the end of the payload
+    def read_to_end(self) -> None:
+        while self.read(_CHUNK_SIZE):
+            pass
+
+    def __update(self, data: bytes) -> bytes:
+        self.size += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+        return data
+
+
+def _get_compression() -> str:
+    compression: Optional[str] = os.environ.get(CACHE_COMPRESSION_ENVIRONMENT_VARIABLE)
+    if compression is None:
+        for candidate in (_ZSTD, _LZ4):
+            if _import_compression_module(candidate) is not None:
+                return candidate
+        return _NONE
+    if compression not in _COMPRESSION_2_CODE:
+        raise RP2ValueError(f"{CACHE_COMPRESSION_ENVIRONMENT_VARIABLE} must be one of {sorted(_COMPRESSION_2_CODE)}, instead it was: {compression}")
+    if compression != _NONE and _import_compression_module(compression) is None:
+        raise RP2RuntimeError(f"{compression} cache compression requires the {_COMPRESSION_2_MODULE[compression]} package")
+    return compression
+
+
+@contextmanager
+def _open_payload_writer(output_file: _ChecksumWriter, compression: str) -> Iterator[IO[bytes]]:
+    if compression == _ZSTD:
+        with _import_compression_module(_ZSTD).ZstdCompressor().stream_writer(output_file, closefd=False) as writer:
+            yield cast(IO[bytes], writer)
+    elif compression == _LZ4:
+        with _import_compression_module(_LZ4).LZ4FrameFile(output_file, mode="wb") as writer:
+            yield cast(IO[bytes], writer)
+    else:
+        yield cast(IO[bytes], output_file)
+
+
+@contextmanager
+def _open_payload_reader(input_file: IO[bytes], compression: str, cache_path: str) -> Iterator[IO[bytes]]:
+    if compression == _NONE:
+        yield input_file
+        return
+    module: Any = _import_compression_module(compression)
+    if module is None:
+        raise RP2RuntimeError(
+            f"{cache_path} is compressed with {compression}: install the {_COMPRESSION_2_MODULE[compression]} package or delete the cache file"
+        )
+    if compression == _ZSTD:
+        with module.ZstdDecompressor().stream_reader(input_file, closefd=False) as reader:
+            yield cast(IO[bytes], reader)
+    else:
+        with module.LZ4FrameFile(input_file, mode="rb") as reader:
+            yield cast(IO[bytes], reader)
+
+
+def _read_header(cache_file: IO[bytes]) -> Optional[_Header]:
+    data: bytes = cache_file.read(_HEADER_SIZE)
+    if len(data) < _HEADER_SIZE or not data.startswith(_MAGIC):
+        return None
+    format_version, compression_code, pickle_protocol, payload_size, checksum = struct.unpack_from(_HEADER_FORMAT, data, len(_MAGIC))
+    return _Header(format_version, _CODE_2_COMPRESSION.get(compression_code, str(compression_code)), pickle_protocol, payload_size, checksum)
+
+
+def _pack_header(header: _Header) -> bytes:
+    return _MAGIC + struct.pack(
+        _HEADER_FORMAT, header.format_version, _COMPRESSION_2_CODE[header.compression], header.pickle_protocol, header.payload_size, header.checksum
+    )
+
+
+def _is_supported(header: _Header) -> bool:
+    return header.format_version == _FORMAT_VERSION and header.compression in _COMPRESSION_2_CODE and header.pickle_protocol <= pickle.HIGHEST_PROTOCOL
+
+
+# Stale and truncated files are cache misses: the data is loaded again and the file rewritten
+def _is_valid(header: _Header, cache_file: IO[bytes], cache_path: str) -> bool:
+    if not _is_supported(header):
+        LOGGER.warning("Ignoring cache file with unsupported format %s: %s", header, cache_path)
+        return False
+    if os.fstat(cache_file.fileno()).st_size != _HEADER_SIZE + header.payload_size:
+        LOGGER.warning("Ignoring truncated cache file: %s", cache_path)
+        return False
+    return True
+
+
+# So are corrupted files: the checksum is computed while the payload is unpickled, and checked once it has all been read
+def _is_corrupted(checksum_reader: _ChecksumReader, header: _Header, cache_path: str) -> bool:
+    checksum_reader.read_to_end()
+    if checksum_reader.size != header.payload_size or checksum_reader.checksum != header.checksum:
+        LOGGER.warning("Ignoring corrupted cache file: %s", cache_path)
+        return True
+    return False
+
+
+def _unpickle(payload: IO[bytes], cache_path: str) -> Any:
+    try:
+        return pickle.load(payload)  # nosec
+    except TypeError as exc:
+        raise RP2TypeError(f"Cache format changed for {cache_path}: delete the cache file and rerun DaLI") from exc
+
+
+def _load_file(cache_path: str) -> Any:
     with open(cache_path, "rb") as cache_file:
+        header: Optional[_Header] = _read_header(cache_file)
+        if header is None:
+            cache_file.seek(0)
+            return _unpickle(cache_file, cache_path)
+        if not _is_valid(header, cache_file, cache_path):
+            return None
+        checksum_reader: _ChecksumReader = _ChecksumReader(cache_file)
         try:
-            result: Any = pickle.load(cache_file)  # nosec
-        except TypeError as exc:
-            raise RP2TypeError(f"Cache format changed for {cache_path}: delete the cache file and rerun DaLI") from exc
-        return result
+            with _open_payload_reader(cast(IO[bytes], checksum_reader), header.compression, cache_path) as payload:
+                data: Any = _unpickle(payload, cache_path)
+        except Exception:
+            # Corrupted payloads can fail to decompress or unpickle in many ways: the checksum tells them apart from other errors
+            if _is_corrupted(checksum_reader, header, cache_path):
+                return None
+            raise
+        return None if _is_corrupted(checksum_reader, header, cache_path) else data
 
 
-def save_to_cache(cache_name: str, data: Any) -> None:
-    if not os.path.exists(CACHE_DIR):
-        os.mkdir(CACHE_DIR)
-    with open(os.path.join(CACHE_DIR, cache_name), "wb") as cache_file:
-        cache_file.write(pickle.dumps(data))
+# Callers that pass the schema of their data get None (and the file is deleted) if the cache was saved with a different schema,
+# unless there is a migration from that schema, or if it can't be unpickled. Caches without manifest entry (saved by previous
+# versions of DaLI) are loaded as they are.
+def load_from_cache(cache_name: str, schema: Optional[str] = None, migrations: Optional[CacheMigrations] = None) -> Any:
+    cache_path = os.path.join(CACHE_DIR, cache_name)
+    if not os.path.exists(cache_path):
+        return None
+    entry: Optional[CacheManifestEntry] = get_cache_manifest().get(cache_name) if schema is not None else None
+    migration: Optional[Callable[[Any], Any]] = None
+    if entry is not None and entry.schema != schema:
+        migration = migrations.get(entry.schema) if migrations is not None and entry.schema is not None else None
+        if migration is None:
+            LOGGER.info("Invalidating cache %s: schema changed from %s to %s", cache_name, entry.schema, schema)
+            remove_from_cache(cache_name)
+            return None
+
+    try:
+        data: Any = _load_file(cache_path)
+    except RP2TypeError:
+        if schema is None:
+            raise
+        LOGGER.info("Invalidating cache %s: it was saved with an incompatible version of its classes", cache_name)
+        remove_from_cache(cache_name)
+        return None
+
+    if migration is not None and entry is not None and data is not None:
+        LOGGER.info("Migrating cache %s from schema %s to %s", cache_name, entry.schema, schema)
+        data = migration(data)
+        save_to_cache(cache_name, data, schema=schema, plugin=entry.plugin)
+    return data
+
+
+# Data is pickled straight to the temporary file of _open_atomically(), without an in-memory copy of the serialized data
+def save_to_cache(cache_name: str, data: Any, schema: Optional[str] = None, plugin: Optional[str] = None) -> None:
+    compression: str = _get_compression()
+    with _open_atomically(os.path.join(CACHE_DIR, cache_name)) as cache_file:
+        cache_file.write(bytes(_HEADER_SIZE))
+        checksum_writer: _ChecksumWriter = _ChecksumWriter(cache_file)
+        with _open_payload_writer(checksum_writer, compression) as payload:
+            pickle.dump(data, payload, protocol=pickle.HIGHEST_PROTOCOL)
+        cache_file.seek(0)
+        cache_file.write(_pack_header(_Header(_FORMAT_VERSION, compression, pickle.HIGHEST_PROTOCOL, checksum_writer.size, checksum_writer.checksum)))
+    register_cache(cache_name, schema, plugin)
+
+
+def remove_from_cache(cache_name: str) -> None:
+    cache_path = os.path.join(CACHE_DIR, cache_name)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    _unregister_cache(cache_name)
+
+
+# Record caches (e.g. load checkpoints) grow by appending records, each one with the header and payload of a cache file: saving a
+# record doesn't rewrite the ones before it.
+def append_to_cache(cache_name: str, data: Any, schema: Optional[str] = None, plugin: Optional[str] = None) -> None:
+    compression: str = _get_compression()
+    record: BytesIO = BytesIO()
+    checksum_writer: _ChecksumWriter = _ChecksumWriter(record)
+    with _open_payload_writer(checksum_writer, compression) as payload:
+        pickle.dump(data, payload, protocol=pickle.HIGHEST_PROTOCOL)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, cache_name), "ab") as cache_file:
+        is_new: bool = cache_file.tell() == 0
+        cache_file.write(_pack_header(_Header(_FORMAT_VERSION, compression, pickle.HIGHEST_PROTOCOL, checksum_writer.size, checksum_writer.checksum)))
+        cache_file.write(record.getvalue())
+        cache_file.flush()
+        os.fsync(cache_file.fileno())
+    if is_new:
+        register_cache(cache_name, schema, plugin)
+
+
+# Returns the records of a record cache in the order they were appended. A record cut short by an interrupted append is removed
+# from the file, together with anything after it, so that the records appended next can be read. Schemas are checked as in
+# load_from_cache(), without migrations.
+def load_records_from_cache(cache_name: str, schema: Optional[str] = None) -> Optional[List[object]]:
+    cache_path = os.path.join(CACHE_DIR, cache_name)
+    if not os.path.exists(cache_path):
+        return None
+    entry: Optional[CacheManifestEntry] = get_cache_manifest().get(cache_name) if schema is not None else None
+    if entry is not None and entry.schema != schema:
+        LOGGER.info("Invalidating cache %s: schema changed from %s to %s", cache_name, entry.schema, schema)
+        remove_from_cache(cache_name)
+        return None
+
+    records: List[object] = []
+    is_compatible: bool = True
+    with open(cache_path, "r+b") as cache_file:
+        file_size: int = os.fstat(cache_file.fileno()).st_size
+        record_start: int = 0
+        while record_start < file_size:
+            header: Optional[_Header] = _read_header(cache_file)
+            payload: bytes = cache_file.read(header.payload_size) if header is not None else b""
+            if header is None or not _is_supported(header) or len(payload) != header.payload_size or zlib.crc32(payload) != header.checksum:
+                LOGGER.warning("Ignoring truncated or corrupted records after byte %d of cache file: %s", record_start, cache_path)
+                cache_file.truncate(record_start)
+                break
+            try:
+                with _open_payload_reader(BytesIO(payload), header.compression, cache_path) as payload_reader:
+                    records.append(_unpickle(payload_reader, cache_path))
+            except RP2TypeError:
+                if schema is None:
+                    raise
+                is_compatible = False
+                break
+            record_start = cache_file.tell()
+
+    if not is_compatible:
+        LOGGER.info("Invalidating cache %s: it was saved with an incompatible version of its classes", cache_name)
+        remove_from_cache(cache_name)
+        return None
+    return records
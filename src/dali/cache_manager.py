@@ -0,0 +1,476 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tarfile
+import time
+from argparse import ArgumentParser, Namespace, RawTextHelpFormatter
+from contextlib import closing
+from datetime import date, datetime, timedelta, timezone
+from tempfile import TemporaryDirectory
+from typing import IO, Any, Dict, List, NamedTuple, Optional, Tuple
+
+from rp2.rp2_error import RP2TypeError, RP2ValueError
+
+from dali.abstract_transaction import AbstractTransaction
+from dali.cache import (
+    CACHE_DIR,
+    CACHE_MANIFEST,
+    CacheManifestEntry,
+    get_cache_manifest,
+    load_from_cache,
+    load_records_from_cache,
+    register_cache,
+    remove_from_cache,
+    save_to_cache,
+)
+from dali.historical_bar_store import (
+    HistoricalBarStore,
+    SeriesStats,
+    open_historical_bar_store,
+)
+from dali.logger import LOGGER
+from dali.plugin.pair_converter.csv.kraken import (
+    Kraken,
+    _PairStartEnd,
+)
+
+# Namespaces are the top-level entries of the cache directory: pickled caches, record caches (e.g. load checkpoints), SQLite bar
+# stores and the Kraken chunk directory
+_KRAKEN_DIRECTORY: str = "kraken"
+_SQLITE_EXTENSION: str = ".sqlite"
+_RECORDS_EXTENSION: str = ".records"
+_SQLITE_SIDE_FILE_SUFFIXES: Tuple[str, ...] = ("-journal", "-wal", "-shm")
+_TEMPORARY_FILE_SUFFIX: str = ".tmp"
+
+_BAR_STORE: str = "bar store"
+_KRAKEN_CHUNKS: str = "Kraken chunks"
+_PICKLE: str = "pickle"
+_RECORDS: str = "records"
+
+_SECONDS_IN_DAY: int = 86400
+_SIZE_UNITS: Tuple[str, ...] = ("B", "KB", "MB", "GB", "TB")
+
+
+class NamespaceStats(NamedTuple):
+    name: str
+    kind: str
+    size: int  # bytes
+    entry_count: int
+    start: Optional[datetime]
+    end: Optional[datetime]
+    manifest_entry: Optional[CacheManifestEntry]
+
+
+# Manages the .dali_cache directory: reports its contents, prunes and compacts it, and moves it between machines
+def cache_manager_entry() -> None:
+    parser: ArgumentParser = _setup_argument_parser()
+    args: Namespace = parser.parse_args()
+
+    if not os.path.isdir(CACHE_DIR):
+        print(f"Cache directory '{CACHE_DIR}' not found: run dali_cache from the directory DaLI is run from")
+        sys.exit(1)
+
+    try:
+        if args.command == "stats":
+            _print_stats([get_namespace_stats(name) for name in _get_selected_namespaces(args.namespaces)])
+        elif args.command == "inspect":
+            _print_inspection(args.namespace)
+        elif args.command == "prune":
+            older_than: Optional[timedelta] = timedelta(days=args.older_than) if args.older_than is not None else None
+            if older_than is None and args.asset is None and args.exchange is None:
+                parser.error("prune needs at least one of --older-than, --asset and --exchange")
+            prune_namespaces(_get_selected_namespaces(args.namespaces), older_than, args.asset, args.exchange)
+        elif args.command == "compact":
+            freed_size: int = compact_namespaces(_get_selected_namespaces(args.namespaces))
+            LOGGER.info("Compaction freed %s", _format_size(freed_size))
+        elif args.command == "export":
+            export_namespaces(args.archive, _get_selected_namespaces(args.namespaces))
+        elif args.command == "import":
+            import_namespaces(args.archive, args.overwrite)
+        else:
+            parser.print_help()
+            sys.exit(1)
+    except (RP2TypeError, RP2ValueError) as exc:
+        LOGGER.error("%s", exc)
+        sys.exit(1)
+
+
+def get_namespaces() -> List[str]:
+    result: List[str] = []
+    for name in sorted(os.listdir(CACHE_DIR)):
+        # Temporary files of interrupted saves, SQLite journals and the manifest are not namespaces
+        if name == CACHE_MANIFEST or name.endswith(_TEMPORARY_FILE_SUFFIX) or name.endswith(_SQLITE_SIDE_FILE_SUFFIXES):
+            continue
+        if os.path.isdir(os.path.join(CACHE_DIR, name)) and name != _KRAKEN_DIRECTORY:
+            continue
+        result.append(name)
+    return result
+
+
+def _get_selected_namespaces(names: List[str]) -> List[str]:
+    namespaces: List[str] = get_namespaces()
+    if not names:
+        return namespaces
+    unknown_names: List[str] = [name for name in names if name not in namespaces]
+    if unknown_names:
+        raise RP2ValueError(f"Unknown cache namespaces: {', '.join(unknown_names)} (known: {', '.join(namespaces)})")
+    return names
+
+
+def _get_kind(name: str) -> str:
+    if name == _KRAKEN_DIRECTORY:
+        return _KRAKEN_CHUNKS
+    if name.endswith(_SQLITE_EXTENSION):
+        return _BAR_STORE
+    if name.endswith(_RECORDS_EXTENSION):
+        return _RECORDS
+    return _PICKLE
+
+
+def _get_paths(name: str) -> List[str]:
+    namespace_path: str = os.path.join(CACHE_DIR, name)
+    if name == _KRAKEN_DIRECTORY:
+        return [os.path.join(directory, file_name) for directory, _, file_names in os.walk(namespace_path) for file_name in file_names]
+    return [namespace_path] + [f"{namespace_path}{suffix}" for suffix in _SQLITE_SIDE_FILE_SUFFIXES if os.path.exists(f"{namespace_path}{suffix}")]
+
+
+def _get_size(name: str) -> int:
+    return sum(os.path.getsize(path) for path in _get_paths(name))
+
+
+def _open_store(name: str) -> HistoricalBarStore:
+    return open_historical_bar_store(name[: -len(_SQLITE_EXTENSION)])
+
+
+def _get_kraken_chunk_names() -> List[str]:
+    chunk_directory: str = os.path.join(CACHE_DIR, _KRAKEN_DIRECTORY)
+    return sorted(os.listdir(chunk_directory)) if os.path.isdir(chunk_directory) else []
+
+
+# Chunk file names are <pair>_<start timestamp>_<duration in minutes>.<extension>
+def _get_kraken_chunk_pair(chunk_name: str) -> str:
+    return chunk_name.split(".", 1)[0].rsplit("_", 2)[0]
+
+
+# Base and quote asset of a chunk: the ones recorded with the time range of its pair (None if they are unknown)
+def _get_kraken_chunk_assets(chunk_name: str, kraken_pairs: Dict[str, _PairStartEnd]) -> Optional[Tuple[str, str]]:
+    pair, _, duration_in_minutes = chunk_name.split(".", 1)[0].rsplit("_", 2)
+    pair_start_end: Optional[_PairStartEnd] = kraken_pairs.get(pair + duration_in_minutes)
+    if pair_start_end is not None and pair_start_end.base_asset is not None and pair_start_end.quote_asset is not None:
+        return pair_start_end.base_asset, pair_start_end.quote_asset
+    return None
+
+
+def _get_kraken_pairs() -> Dict[str, _PairStartEnd]:
+    kraken_pairs: Any = load_from_cache(Kraken("").cache_key())
+    return kraken_pairs if isinstance(kraken_pairs, dict) else {}
+
+
+def _from_seconds(seconds: int) -> datetime:
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+# Number of entries of pickled data and the times they cover (if they have any)
+def _describe_data(data: Any) -> Tuple[int, List[datetime]]:
+    if isinstance(data, list):
+        return len(data), [transaction.timestamp_value for transaction in data if isinstance(transaction, AbstractTransaction)]
+    if isinstance(data, dict):
+        # Fiat rates are indexed by day, Kraken pairs have a start and end timestamp in seconds
+        times: List[datetime] = [datetime(key.year, key.month, key.day, tzinfo=timezone.utc) for key in data if isinstance(key, date)]
+        for value in data.values():
+            if isinstance(value, _PairStartEnd):
+                times.extend((_from_seconds(value.start), _from_seconds(value.end)))
+        return len(data), times
+    # Market snapshots
+    markets: Any = getattr(data, "markets", None)
+    snapshot_time: Any = getattr(data, "timestamp", None)
+    if isinstance(markets, list) and isinstance(snapshot_time, datetime):
+        return len(markets), [snapshot_time]
+    return 0 if data is None else 1, []
+
+
+def get_namespace_stats(name: str) -> NamespaceStats:
+    kind: str = _get_kind(name)
+    entry_count: int
+    times: List[datetime] = []
+    if kind == _BAR_STORE:
+        series_stats: List[SeriesStats] = _open_store(name).get_series_stats()
+        entry_count = sum(series.bar_count for series in series_stats)
+        times = [series.start for series in series_stats] + [series.end for series in series_stats]
+    elif kind == _KRAKEN_CHUNKS:
+        entry_count = len(_get_kraken_chunk_names())
+        for pair_start_end in _get_kraken_pairs().values():
+            times.extend((_from_seconds(pair_start_end.start), _from_seconds(pair_start_end.end)))
+    elif kind == _RECORDS:
+        entry_count = len(load_records_from_cache(name) or [])
+    else:
+        try:
+            entry_count, times = _describe_data(load_from_cache(name))
+        except RP2TypeError as exc:
+            LOGGER.warning("Cannot read %s: %s", name, exc)
+            entry_count = 0
+    return NamespaceStats(
+        name=name,
+        kind=kind,
+        size=_get_size(name),
+        entry_count=entry_count,
+        start=min(times) if times else None,
+        end=max(times) if times else None,
+        manifest_entry=get_cache_manifest().get(name),
+    )
+
+
+def _format_size(size: float) -> str:
+    for unit in _SIZE_UNITS:
+        if size < 1024 or unit == _SIZE_UNITS[-1]:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != _SIZE_UNITS[0] else f"{int(size)} B"
+
+
+def _format_time(timestamp: Optional[datetime]) -> str:
+    return timestamp.strftime("%Y-%m-%d") if timestamp is not None else "-"
+
+
+def _print_stats(namespace_stats: List[NamespaceStats]) -> None:
+    row_format: str = "{:<50} {:<14} {:>10} {:>10} {:>10} {:>10}  {}"
+    print(row_format.format("NAMESPACE", "KIND", "SIZE", "ENTRIES", "FROM", "TO", "PLUGIN"))
+    for stats in namespace_stats:
+        plugin: Optional[str] = stats.manifest_entry.plugin if stats.manifest_entry is not None else None
+        print(
+            row_format.format(
+                stats.name, stats.kind, _format_size(stats.size), stats.entry_count, _format_time(stats.start), _format_time(stats.end), plugin or "-"
+            )
+        )
+    print(row_format.format("TOTAL", "", _format_size(sum(stats.size for stats in namespace_stats)), "", "", "", ""))
+
+
+def _print_inspection(name: str) -> None:
+    stats: NamespaceStats = get_namespace_stats(_get_selected_namespaces([name])[0])
+    _print_stats([stats])
+    if stats.manifest_entry is not None:
+        print(f"\nWritten by DaLI {stats.manifest_entry.dali_version} on {stats.manifest_entry.created}, schema: {stats.manifest_entry.schema}")
+    if stats.kind == _BAR_STORE:
+        row_format: str = "{:<10} {:<10} {:<20} {:>10} {:>20} {:>20}"
+        print("\n" + row_format.format("FROM", "TO", "EXCHANGE", "BARS", "START", "END"))
+        for series in _open_store(name).get_series_stats():
+            print(row_format.format(series.from_asset, series.to_asset, series.exchange, series.bar_count, series.start.isoformat(), series.end.isoformat()))
+    elif stats.kind == _KRAKEN_CHUNKS:
+        pair_2_chunk_count: Dict[str, int] = {}
+        for chunk_name in _get_kraken_chunk_names():
+            pair: str = _get_kraken_chunk_pair(chunk_name)
+            pair_2_chunk_count[pair] = pair_2_chunk_count.get(pair, 0) + 1
+        print("\n" + "\n".join(f"{pair}: {chunk_count} chunks" for pair, chunk_count in sorted(pair_2_chunk_count.items())))
+
+
+def _is_older(path: str, older_than: timedelta) -> bool:
+    return time.time() - os.path.getmtime(path) > older_than.total_seconds()
+
+
+def _remove_namespace(name: str) -> None:
+    for path in _get_paths(name):
+        if os.path.exists(path):
+            os.remove(path)
+    # The files are gone: this only removes the manifest entry
+    remove_from_cache(name)
+
+
+# Namespaces (Kraken chunks) that haven't been written for longer than older_than are deleted. Bars of asset (as base or quote)
+# and/or exchange are deleted from bar stores, as are the Kraken chunks of pairs with asset as base or quote asset (Kraken names,
+# e.g. XBT for BTC). Pickled caches (e.g. input plugin transactions) can only be pruned by age.
+def prune_namespaces(names: List[str], older_than: Optional[timedelta] = None, asset: Optional[str] = None, exchange: Optional[str] = None) -> None:
+    for name in names:
+        kind: str = _get_kind(name)
+        if kind == _KRAKEN_CHUNKS:
+            chunk_directory: str = os.path.join(CACHE_DIR, _KRAKEN_DIRECTORY)
+            pruned_chunk_names: List[str] = []
+            kraken_pairs: Dict[str, _PairStartEnd] = _get_kraken_pairs()
+            for chunk_name in _get_kraken_chunk_names():
+                if older_than is not None and _is_older(os.path.join(chunk_directory, chunk_name), older_than):
+                    pruned_chunk_names.append(chunk_name)
+                elif (asset is not None or exchange is not None) and (exchange is None or exchange.lower() == "kraken"):
+                    if asset is None or asset in (_get_kraken_chunk_assets(chunk_name, kraken_pairs) or ()):
+                        pruned_chunk_names.append(chunk_name)
+            if pruned_chunk_names:
+                Kraken("").delete_chunks(pruned_chunk_names)
+                LOGGER.info("Pruned %d Kraken chunks", len(pruned_chunk_names))
+        elif older_than is not None and all(_is_older(path, older_than) for path in _get_paths(name)):
+            _remove_namespace(name)
+            LOGGER.info("Pruned %s", name)
+        elif kind == _BAR_STORE and (asset is not None or exchange is not None):
+            bar_count: int = _open_store(name).delete(asset, exchange)
+            LOGGER.info("Pruned %d bars from %s", bar_count, name)
+
+
+# Bar stores are vacuumed and pickled caches are rewritten with the current format and compression. Temporary files left by
+# interrupted saves are deleted. Returns the number of bytes freed.
+def compact_namespaces(names: List[str]) -> int:
+    initial_size: int = 0
+    final_size: int = 0
+    for file_name in os.listdir(CACHE_DIR):
+        if file_name.startswith(".") and file_name.endswith(_TEMPORARY_FILE_SUFFIX):
+            initial_size += os.path.getsize(os.path.join(CACHE_DIR, file_name))
+            os.remove(os.path.join(CACHE_DIR, file_name))
+    for name in names:
+        initial_size += _get_size(name)
+        kind: str = _get_kind(name)
+        if kind == _BAR_STORE:
+            store: HistoricalBarStore = _open_store(name)
+            store.vacuum()
+            store.close()
+        elif kind == _PICKLE:
+            data: Any = load_from_cache(name)
+            if data is not None:
+                manifest_entry: Optional[CacheManifestEntry] = get_cache_manifest().get(name)
+                save_to_cache(name, data, manifest_entry.schema if manifest_entry else None, manifest_entry.plugin if manifest_entry else None)
+        final_size += _get_size(name)
+        LOGGER.info("Compacted %s", name)
+    return initial_size - final_size
+
+
+# Writes the namespaces and their manifest entries to a tar archive (compressed with gzip if its name ends with .gz or .tgz).
+# The Kraken chunk directory should be exported together with the Kraken pair cache.
+def export_namespaces(archive_path: str, names: List[str]) -> None:
+    manifest: Dict[str, CacheManifestEntry] = get_cache_manifest()
+    # Two calls, because the mode of tarfile.open() is typed as a literal
+    archive: tarfile.TarFile = (
+        tarfile.open(archive_path, "w:gz") if archive_path.endswith((".gz", ".tgz")) else tarfile.open(archive_path, "w")  # pylint: disable=consider-using-with
+    )
+    with archive, TemporaryDirectory() as temporary_directory:
+        for name in names:
+            namespace_path: str = os.path.join(CACHE_DIR, name)
+            if _get_kind(name) == _BAR_STORE:
+                # The SQLite backup API makes a consistent copy, even if DaLI is writing to the store
+                copy_path: str = os.path.join(temporary_directory, name)
+                with closing(sqlite3.connect(namespace_path)) as source, closing(sqlite3.connect(copy_path)) as copy:
+                    source.backup(copy)
+                archive.add(copy_path, arcname=name)
+            else:
+                archive.add(namespace_path, arcname=name)
+            LOGGER.info("Exported %s", name)
+        manifest_data: bytes = json.dumps({name: manifest[name]._asdict() for name in names if name in manifest}, indent=4).encode("utf-8")
+        manifest_info: tarfile.TarInfo = tarfile.TarInfo(CACHE_MANIFEST)
+        manifest_info.size = len(manifest_data)
+        manifest_info.mtime = int(time.time())
+        archive.addfile(manifest_info, io.BytesIO(manifest_data))
+
+
+# Only regular files and directories with relative paths inside the cache directory are accepted
+def _validate_archive_member(member: tarfile.TarInfo) -> None:
+    normalized_name: str = os.path.normpath(member.name)
+    if os.path.isabs(member.name) or normalized_name.startswith("..") or not (member.isfile() or member.isdir()):
+        raise RP2ValueError(f"Invalid cache archive member: {member.name}")
+
+
+# Files that already exist are skipped, unless overwrite is True: bar stores are merged instead (bars already in the local store
+# are kept), as are Kraken pairs. Returns the names of the imported files.
+def import_namespaces(archive_path: str, overwrite: bool = False) -> List[str]:
+    result: List[str] = []
+    with tarfile.open(archive_path, "r:*") as archive, TemporaryDirectory(dir=CACHE_DIR) as temporary_directory:
+        members: List[tarfile.TarInfo] = archive.getmembers()
+        for member in members:
+            _validate_archive_member(member)
+        raw_manifest: Dict[str, Dict[str, Optional[str]]] = {}
+        kraken_cache_key: str = Kraken("").cache_key()
+
+        for member in members:
+            if not member.isfile():
+                continue
+            member_file: Optional[IO[bytes]] = archive.extractfile(member)
+            if member_file is None:
+                continue
+            if member.name == CACHE_MANIFEST:
+                raw_manifest = json.load(member_file)
+                continue
+            extracted_path: str = os.path.join(temporary_directory, "member")
+            with member_file, open(extracted_path, "wb") as extracted_file:
+                shutil.copyfileobj(member_file, extracted_file)
+
+            target_path: str = os.path.join(CACHE_DIR, os.path.normpath(member.name))
+            if os.path.exists(target_path) and not overwrite:
+                if member.name.endswith(_SQLITE_EXTENSION) and os.sep not in os.path.normpath(member.name):
+                    LOGGER.info("Merged %d bars into %s", _open_store(member.name).merge(extracted_path), member.name)
+                    result.append(member.name)
+                elif member.name == kraken_cache_key:
+                    # The temporary directory is inside the cache directory, so load_from_cache() can read the extracted file
+                    imported_pairs: Any = load_from_cache(os.path.relpath(extracted_path, CACHE_DIR))
+                    Kraken("").save_cached_pairs(imported_pairs if isinstance(imported_pairs, dict) else {})
+                    LOGGER.info("Merged Kraken pairs into %s", member.name)
+                    result.append(member.name)
+                else:
+                    LOGGER.info("Skipped %s: it's already in the cache", member.name)
+                os.remove(extracted_path)
+                continue
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.replace(extracted_path, target_path)
+            result.append(member.name)
+
+    manifest: Dict[str, CacheManifestEntry] = get_cache_manifest()
+    for name in result:
+        fields: Optional[Dict[str, Optional[str]]] = raw_manifest.get(name)
+        if fields is not None and (name not in manifest or overwrite):
+            register_cache(name, fields.get("schema"), fields.get("plugin"))
+    LOGGER.info("Imported %d files from %s", len(result), archive_path)
+    return result
+
+
+def _setup_argument_parser() -> ArgumentParser:
+    parser: ArgumentParser = ArgumentParser(
+        description=(
+            "Manage the DaLI cache (.dali_cache): report, prune, compact, export and import it. Run it from the directory DaLI is run from. "
+            "Don't run it while DaLI is running. Links:\n"
+            "- documentation: https://github.com/eprbell/dali-rp2/blob/main/README.md\n"
+            "- support DaLI by leaving a star on Github: https://github.com/eprbell/dali-rp2"
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    stats_parser: ArgumentParser = subparsers.add_parser("stats", help="Print size, entry count and time coverage of cache namespaces")
+    stats_parser.add_argument("namespaces", nargs="*", help="Namespaces to report (default: all)", metavar="NAMESPACE")
+
+    inspect_parser: ArgumentParser = subparsers.add_parser("inspect", help="Print the details of a cache namespace (e.g. the pairs of a bar store)")
+    inspect_parser.add_argument("namespace", help="Namespace to inspect", metavar="NAMESPACE")
+
+    prune_parser: ArgumentParser = subparsers.add_parser("prune", help="Delete old namespaces, or the data of an asset or exchange")
+    prune_parser.add_argument(
+        "-o",
+        "--older-than",
+        action="store",
+        help="Delete namespaces (and Kraken chunks) that haven't been written for more than DAYS days",
+        metavar="DAYS",
+        type=int,
+    )
+    prune_parser.add_argument("-a", "--asset", action="store", help="Delete the bars of ASSET (as base or quote asset)", metavar="ASSET", type=str)
+    prune_parser.add_argument("-e", "--exchange", action="store", help="Delete the bars of EXCHANGE", metavar="EXCHANGE", type=str)
+    prune_parser.add_argument("namespaces", nargs="*", help="Namespaces to prune (default: all)", metavar="NAMESPACE")
+
+    compact_parser: ArgumentParser = subparsers.add_parser("compact", help="Vacuum bar stores and rewrite pickled caches with the current format")
+    compact_parser.add_argument("namespaces", nargs="*", help="Namespaces to compact (default: all)", metavar="NAMESPACE")
+
+    export_parser: ArgumentParser = subparsers.add_parser("export", help="Write cache namespaces to a tar archive (.tar.gz for gzip compression)")
+    export_parser.add_argument("archive", help="Archive to write", metavar="ARCHIVE")
+    export_parser.add_argument("namespaces", nargs="*", help="Namespaces to export (default: all)", metavar="NAMESPACE")
+
+    import_parser: ArgumentParser = subparsers.add_parser("import", help="Read cache namespaces from an archive written by export")
+    import_parser.add_argument("-f", "--overwrite", action="store_true", help="Replace the files that are already in the cache, instead of merging bar stores")
+    import_parser.add_argument("archive", help="Archive to read", metavar="ARCHIVE")
+
+    return parser
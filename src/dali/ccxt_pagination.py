@@ -40,6 +40,13 @@ class PaginationDetails(NamedTuple):
     params: Optional[Dict[str, Union[int, str, None]]]
 
 
+# Position of an iterator, saved after each page so that an interrupted load can restart from the next page
+class PaginationCheckpoint(NamedTuple):
+    market_index: int
+    since: Optional[int]
+    end_of_data: bool
+
+
 class AbstractPaginationDetailSet:
     def __iter__(self) -> "AbstractPaginationDetailsIterator":
         raise NotImplementedError("Abstract method")
@@ -137,6 +144,12 @@ class AbstractPaginationDetailsIterator:
     def _next_market(self) -> None:
         self.__market_count += 1
 
+    def _get_market_index(self) -> int:
+        return self.__market_count
+
+    def _set_market_index(self, market_index: int) -> None:
+        self.__market_count = market_index
+
     def _get_limit(self) -> Optional[int]:
         return self.__limit
 
@@ -149,6 +162,12 @@ class AbstractPaginationDetailsIterator:
     def update_fetched_elements(self, current_results: Any) -> None:
         raise NotImplementedError("Abstract method")
 
+    def get_checkpoint(self) -> PaginationCheckpoint:
+        raise NotImplementedError("Abstract method")
+
+    def restore_checkpoint(self, checkpoint: PaginationCheckpoint) -> None:
+        raise NotImplementedError("Abstract method")
+
     def __next__(self) -> PaginationDetails:
         raise NotImplementedError("Abstract method")
 
@@ -196,6 +215,17 @@ class DateBasedPaginationDetailsIterator(AbstractPaginationDetailsIterator):
     def _is_end_of_data(self) -> bool:
         return self.__end_of_data
 
+    def get_checkpoint(self) -> PaginationCheckpoint:
+        return PaginationCheckpoint(market_index=self._get_market_index(), since=self.__since, end_of_data=self.__end_of_data)
+
+    # The end of the time windows (now) is not restored: a resumed load reads up to the time it was resumed
+    def restore_checkpoint(self, checkpoint: PaginationCheckpoint) -> None:
+        if checkpoint.since is None:
+            raise RP2RuntimeError(f"Checkpoint has no since: {checkpoint}")
+        self._set_market_index(checkpoint.market_index)
+        self.__since = checkpoint.since
+        self.__end_of_data = checkpoint.end_of_data
+
     def _get_since(self) -> int:
         return self.__since
 
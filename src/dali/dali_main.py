@@ -61,6 +61,8 @@ class _InputPluginHelperArgs(NamedTuple):
     package_name: str
     country: AbstractCountry
     use_cache: bool
+    incremental: bool
+    resume: bool
 
 
 def dali_main(country: AbstractCountry) -> None:
@@ -147,7 +149,9 @@ def _dali_main_internal(country: AbstractCountry) -> None:
                     LOGGER.error("Plugin '%s' has no 'load' method. Exiting...", normalized_section_name)
                     sys.exit(1)
                 LOGGER.info("Initialized input plugin '%s'", section_name)
-                input_plugin_args_list.append(_InputPluginHelperArgs(input_plugin, section_name, country, args.use_cache))
+                input_plugin_args_list.append(
+                    _InputPluginHelperArgs(input_plugin, section_name, country, args.use_cache or args.incremental, args.incremental, args.resume)
+                )
 
         if not input_plugin_args_list:
             LOGGER.error("No input plugin configuration found in config file. Exiting...")
@@ -166,7 +170,12 @@ def _dali_main_internal(country: AbstractCountry) -> None:
         transactions: List[AbstractTransaction] = [transaction for result in result_list for transaction in result]
 
         LOGGER.info("Resolving transactions")
-        resolved_transactions: List[AbstractTransaction] = resolve_transactions(transactions, dali_configuration, args.read_spot_price_from_web)
+        resolved_transactions: List[AbstractTransaction]
+        try:
+            resolved_transactions = resolve_transactions(transactions, dali_configuration, args.read_spot_price_from_web, args.resolver_thread_count)
+        finally:
+            for pair_converter in pair_converter_list:
+                pair_converter.close()
 
         LOGGER.info("Generating config file in %s", args.output_dir)
         generate_configuration_file(args.output_dir, args.prefix, "crypto_data.ini", resolved_transactions, dali_configuration)
@@ -188,9 +197,16 @@ def _input_plugin_helper(args: _InputPluginHelperArgs) -> List[AbstractTransacti
     country: AbstractCountry = args.country
     use_cache: bool = args.use_cache
     plugin_transactions: List[AbstractTransaction]
+    if args.resume:
+        input_plugin.resume_from_checkpoints()
     if use_cache and input_plugin.cache_key() is not None:
         cache = input_plugin.load_from_cache()
-        if cache:
+        # Only incremental runs read the native source when there is a cache: otherwise -c reads the cache alone
+        if cache and args.incremental and input_plugin.is_incremental():
+            LOGGER.info("Reading new crypto data using plugin '%s' and merging it with %d cached transactions", package_name, len(cache))
+            plugin_transactions = input_plugin.load_incrementally(country, cache)
+            input_plugin.save_to_cache(plugin_transactions)
+        elif cache:
             LOGGER.info("Reading crypto data for plugin '%s' from cache", package_name)
             plugin_transactions = cache
         else:
@@ -200,6 +216,8 @@ def _input_plugin_helper(args: _InputPluginHelperArgs) -> List[AbstractTransacti
     else:
         LOGGER.info("Reading crypto data using plugin '%s'", package_name)
         plugin_transactions = input_plugin.load(country)
+    # The load succeeded: the next one starts from scratch (or from the cache)
+    input_plugin.clear_checkpoints()
 
     for transaction in plugin_transactions:
         if not isinstance(transaction, AbstractTransaction):
@@ -225,6 +243,13 @@ def _setup_argument_parser() -> ArgumentParser:
         action="store_true",
         help="Cache input plugin data load (developers only)",
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Read only the crypto data added since the cached input plugin data load and merge it with the cache, for input plugins that "
+        "support it (implies -c)",
+    )
     parser.add_argument(
         "-o",
         "--output_dir",
@@ -243,6 +268,21 @@ def _setup_argument_parser() -> ArgumentParser:
         metavar="PREFIX",
         type=str,
     )
+    parser.add_argument(
+        "-r",
+        "--resolver-thread-count",
+        action="store",
+        default=1,
+        help="Number of concurrent threads for transaction resolution (transactions are split among threads by asset)",
+        metavar="RESOLVER_THREAD_COUNT",
+        type=int,
+    )
+    parser.add_argument(
+        "-R",
+        "--resume",
+        action="store_true",
+        help="Resume input plugin data loads from the checkpoints saved by a previous run that failed",
+    )
     parser.add_argument(
         "-s",
         "--read-spot-price-from-web",
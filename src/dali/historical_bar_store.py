@@ -0,0 +1,287 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sqlite3
+from datetime import datetime
+from threading import Lock, RLock
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, cast
+
+from dali.bar_series import (
+    BarRow,
+    BarSeries,
+    bar_to_row,
+    from_microseconds,
+    row_to_bar,
+    to_microseconds,
+)
+from dali.cache import CACHE_DIR, load_from_cache, register_cache
+from dali.historical_bar import HistoricalBar
+
+# Uncommitted upserts are flushed to disk after this many writes: a crash loses at most this many bars
+_COMMIT_INTERVAL: int = 100
+
+_STORE_EXTENSION: str = ".sqlite"
+# Recorded in the cache manifest: bars are stored as rows, so the store doesn't depend on the fields of HistoricalBar. Change it when
+# the tables change.
+_STORE_SCHEMA: str = "bars(from_asset,to_asset,exchange,timestamp,duration,bar_timestamp,open,high,low,close,volume,native);misses;metadata"
+_LEGACY_IMPORTED: str = "legacy_imported"
+
+_CREATE_BARS_TABLE: str = """
+    CREATE TABLE IF NOT EXISTS bars (
+        from_asset TEXT NOT NULL,
+        to_asset TEXT NOT NULL,
+        exchange TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        duration INTEGER NOT NULL,
+        bar_timestamp INTEGER NOT NULL,
+        open TEXT NOT NULL,
+        high TEXT NOT NULL,
+        low TEXT NOT NULL,
+        close TEXT NOT NULL,
+        volume TEXT NOT NULL,
+        native INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (from_asset, to_asset, exchange, timestamp)
+    ) WITHOUT ROWID
+"""
+# Lookups that found no data, so that they can fail fast until they expire
+_CREATE_MISSES_TABLE: str = """
+    CREATE TABLE IF NOT EXISTS misses (
+        from_asset TEXT NOT NULL,
+        to_asset TEXT NOT NULL,
+        exchange TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        recorded INTEGER NOT NULL,
+        PRIMARY KEY (from_asset, to_asset, exchange, bucket)
+    ) WITHOUT ROWID
+"""
+_CREATE_METADATA_TABLE: str = "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+# Stores created before the native column are migrated: their bars may have the lookup timestamp instead of the candle one, so they
+# aren't native
+_ADD_NATIVE_COLUMN: str = "ALTER TABLE bars ADD COLUMN native INTEGER NOT NULL DEFAULT 0"
+_NATIVE_COLUMN: str = "native"
+_BAR_COLUMNS: str = "from_asset, to_asset, exchange, timestamp, duration, bar_timestamp, open, high, low, close, volume"
+_UPSERT_BAR: str = "INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_UPSERT_MISS: str = "INSERT OR REPLACE INTO misses VALUES (?, ?, ?, ?, ?)"
+_SELECT_MISS: str = "SELECT recorded FROM misses WHERE from_asset = ? AND to_asset = ? AND exchange = ? AND bucket = ?"
+_SELECT_SERIES: str = (
+    "SELECT timestamp, duration, bar_timestamp, open, high, low, close, volume, native FROM bars " "WHERE from_asset = ? AND to_asset = ? AND exchange = ?"
+)
+
+_SELECT_SERIES_STATS: str = (
+    "SELECT from_asset, to_asset, exchange, COUNT(*), MIN(bar_timestamp), MAX(bar_timestamp + duration) FROM bars "
+    "GROUP BY from_asset, to_asset, exchange ORDER BY from_asset, to_asset, exchange"
+)
+# Filters of delete(): None matches everything
+_ASSET_AND_EXCHANGE_FILTER: str = "(:asset IS NULL OR from_asset = :asset OR to_asset = :asset) AND (:exchange IS NULL OR exchange = :exchange)"
+
+
+class SeriesStats(NamedTuple):
+    from_asset: str
+    to_asset: str
+    exchange: str
+    bar_count: int
+    start: datetime
+    end: datetime
+
+
+# Same layout as AssetPairAndTimestamp: (timestamp, from_asset, to_asset, exchange)
+BarKey = Tuple[datetime, str, str, str]
+# (from_asset, to_asset, exchange, bucket): the meaning of bucket is up to the caller (e.g. a day number)
+MissKey = Tuple[str, str, str, int]
+# (from_asset, to_asset, exchange)
+_SeriesKey = Tuple[str, str, str]
+_BarRow = Tuple[str, str, str, int, int, int, str, str, str, str, str, int]
+
+
+# Persistent historical bar cache, indexed by (from_asset, to_asset, exchange, timestamp). Writes are incremental upserts, so opening
+# the store doesn't depend on its size. The first read of a (from_asset, to_asset, exchange) loads all of its bars into a columnar
+# BarSeries with one query: later reads are binary searches in memory. It is safe to use from multiple threads.
+class HistoricalBarStore:
+    def __init__(self, cache_name: str) -> None:
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        self.__cache_name: str = cache_name
+        self.__path: str = os.path.join(CACHE_DIR, f"{cache_name}{_STORE_EXTENSION}")
+        self.__lock: RLock = RLock()
+        self.__pending_writes: int = 0
+        self.__series: Dict[_SeriesKey, BarSeries] = {}
+        self.__connection: sqlite3.Connection = sqlite3.connect(self.__path, check_same_thread=False)
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(_CREATE_BARS_TABLE)
+        if _NATIVE_COLUMN not in self._get_bar_columns("main"):
+            self.__connection.execute(_ADD_NATIVE_COLUMN)
+        self.__connection.execute(_CREATE_MISSES_TABLE)
+        self.__connection.execute(_CREATE_METADATA_TABLE)
+        self.__connection.commit()
+        self._import_legacy_cache()
+        register_cache(f"{cache_name}{_STORE_EXTENSION}", schema=_STORE_SCHEMA)
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    # Bars cached by previous versions of DaLI are stored as a pickled dictionary: import them the first time the store is opened
+    def _import_legacy_cache(self) -> None:
+        with self.__lock:
+            if self.__connection.execute("SELECT value FROM metadata WHERE key = ?", (_LEGACY_IMPORTED,)).fetchone() is not None:
+                return
+            legacy_cache: Any = load_from_cache(self.__cache_name)
+            if isinstance(legacy_cache, dict):
+                self.__connection.executemany(
+                    _UPSERT_BAR,
+                    (self._to_row(key, value) for key, value in legacy_cache.items() if key[0].tzinfo is not None and value.timestamp.tzinfo is not None),
+                )
+            self.__connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (_LEGACY_IMPORTED, "1"))
+            self.__connection.commit()
+
+    def _get_bar_columns(self, database: str) -> List[str]:
+        return [str(column[1]) for column in self.__connection.execute(f"PRAGMA {database}.table_info(bars)")]  # nosec
+
+    @staticmethod
+    def _to_row(key: BarKey, historical_bar: HistoricalBar, native: bool = False) -> _BarRow:
+        timestamp, from_asset, to_asset, exchange = key
+        return (from_asset, to_asset, exchange) + bar_to_row(to_microseconds(timestamp), historical_bar, native)
+
+    # Must be called with the lock held
+    def _get_series(self, series_key: _SeriesKey) -> BarSeries:
+        series: Optional[BarSeries] = self.__series.get(series_key)
+        if series is None:
+            series = BarSeries(self.__connection.execute(_SELECT_SERIES, series_key))
+            self.__series[series_key] = series
+        return series
+
+    def get(self, key: BarKey) -> Optional[HistoricalBar]:
+        timestamp, from_asset, to_asset, exchange = key
+        microseconds: int = to_microseconds(timestamp)
+        with self.__lock:
+            row: Optional[BarRow] = self._get_series((from_asset, to_asset, exchange)).get_row(microseconds)
+        # The HistoricalBar is built outside of the lock
+        return row_to_bar(row) if row is not None else None
+
+    # Returns the finest cached native bar whose interval contains the timestamp of the key, at any granularity
+    def find_covering(self, key: BarKey) -> Optional[HistoricalBar]:
+        timestamp, from_asset, to_asset, exchange = key
+        microseconds: int = to_microseconds(timestamp)
+        with self.__lock:
+            row: Optional[BarRow] = self._get_series((from_asset, to_asset, exchange)).find_covering_row(microseconds)
+        return row_to_bar(row) if row is not None else None
+
+    # Native bars are candles read from an exchange, with their real timestamp and duration: only they are found by find_covering()
+    def put(self, key: BarKey, historical_bar: HistoricalBar, native: bool = False) -> None:
+        self.put_many([(key, historical_bar)], native)
+
+    def put_many(self, items: Iterable[Tuple[BarKey, HistoricalBar]], native: bool = False) -> None:
+        rows: List[_BarRow] = [self._to_row(key, historical_bar, native) for key, historical_bar in items]
+        with self.__lock:
+            self.__connection.executemany(_UPSERT_BAR, rows)
+            # Series that haven't been read yet will be loaded from the database with these bars
+            for row in rows:
+                series: Optional[BarSeries] = self.__series.get(row[:3])
+                if series is not None:
+                    series.add(row[3:])
+            self._count_writes(len(rows))
+
+    # Returns when the miss was recorded, or None if the lookup never failed
+    def get_miss(self, key: MissKey) -> Optional[datetime]:
+        with self.__lock:
+            row: Optional[Tuple[int]] = self.__connection.execute(_SELECT_MISS, key).fetchone()
+        return from_microseconds(row[0]) if row is not None else None
+
+    def put_miss(self, key: MissKey, recorded: datetime) -> None:
+        with self.__lock:
+            self.__connection.execute(_UPSERT_MISS, key + (to_microseconds(recorded),))
+            self._count_writes(1)
+
+    # Must be called with the lock held
+    def _count_writes(self, write_count: int) -> None:
+        self.__pending_writes += write_count
+        if self.__pending_writes >= _COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self) -> None:
+        with self.__lock:
+            self.__connection.commit()
+            self.__pending_writes = 0
+
+    # Cache maintenance (see dali_cache): time coverage of each (from_asset, to_asset, exchange)
+    def get_series_stats(self) -> List[SeriesStats]:
+        with self.__lock:
+            rows: List[Tuple[str, str, str, int, int, int]] = self.__connection.execute(_SELECT_SERIES_STATS).fetchall()
+        return [SeriesStats(row[0], row[1], row[2], row[3], from_microseconds(row[4]), from_microseconds(row[5])) for row in rows]
+
+    # Deletes the bars (and misses) of an asset (as base or quote) and/or exchange: returns the number of bars deleted
+    def delete(self, asset: Optional[str] = None, exchange: Optional[str] = None) -> int:
+        parameters: Dict[str, Optional[str]] = {"asset": asset, "exchange": exchange}
+        with self.__lock:
+            bar_count: int = self.__connection.execute(f"DELETE FROM bars WHERE {_ASSET_AND_EXCHANGE_FILTER}", parameters).rowcount  # nosec
+            self.__connection.execute(f"DELETE FROM misses WHERE {_ASSET_AND_EXCHANGE_FILTER}", parameters)  # nosec
+            self.__connection.commit()
+            self.__series = {}
+        return bar_count
+
+    # Adds the bars and misses of another store file, e.g. one exported from another machine: bars already in this store are kept
+    def merge(self, path: str) -> int:
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                # Files exported before the native column have no native bars
+                columns: str = f"{_BAR_COLUMNS}, {_NATIVE_COLUMN}" if _NATIVE_COLUMN in self._get_bar_columns("other") else _BAR_COLUMNS
+                bar_count: int = self.__connection.execute(f"INSERT OR IGNORE INTO bars ({columns}) SELECT {columns} FROM other.bars").rowcount  # nosec
+                self.__connection.execute("INSERT OR IGNORE INTO misses SELECT * FROM other.misses")
+                self.__connection.commit()
+            finally:
+                self.__connection.execute("DETACH DATABASE other")
+            self.__series = {}
+        return bar_count
+
+    # Rebuilds the database file, returning the space left by deleted rows to the file system
+    def vacuum(self) -> None:
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.execute("VACUUM")
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.close()
+            self.__series = {}
+        with _STORES_LOCK:
+            if _STORES.get(self.__path) is self:
+                del _STORES[self.__path]
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return int(self.__connection.execute("SELECT COUNT(*) FROM bars").fetchone()[0])
+
+    # Typed like Container.__contains__, so that stores can be used with assertIn() and the like: only bar keys can be found
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, tuple) and len(key) == 4 and self.get(cast(BarKey, key)) is not None
+
+
+_STORES: Dict[str, HistoricalBarStore] = {}
+_STORES_LOCK: Lock = Lock()
+
+
+# Plugins sharing a cache name share the same store: SQLite doesn't allow two connections to write to the same file at the same time
+def open_historical_bar_store(cache_name: str) -> HistoricalBarStore:
+    path: str = os.path.join(CACHE_DIR, f"{cache_name}{_STORE_EXTENSION}")
+    with _STORES_LOCK:
+        store: Optional[HistoricalBarStore] = _STORES.get(path)
+        # The store is recreated if its file was deleted
+        if store is None or not os.path.exists(path):
+            store = HistoricalBarStore(cache_name)
+            _STORES[path] = store
+        return store
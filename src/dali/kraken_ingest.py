@@ -0,0 +1,94 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+from argparse import ArgumentParser, Namespace, RawTextHelpFormatter
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from rp2.logger import LOG_FILE
+
+from dali.logger import LOGGER
+from dali.plugin.pair_converter.csv.kraken import Kraken, _PairStartEnd
+
+_ARCHIVE_SUFFIX: str = "_OHLCVT.zip"
+
+
+# Kraken OHLCVT archives that have already been downloaded (e.g. from https://support.kraken.com/hc/en-us/articles/360047124832)
+# can be split into the Kraken CSV chunk cache ahead of time, so that DaLI doesn't need to download them from Google Drive.
+def kraken_ingest_entry() -> None:
+    parser: ArgumentParser = _setup_argument_parser()
+    args: Namespace = parser.parse_args()
+
+    archive_directory: Path = Path(args.archive_dir)
+    if not archive_directory.is_dir():
+        print(f"Archive directory '{args.archive_dir}' not found")
+        parser.print_help()
+        sys.exit(1)
+
+    archive_paths: List[str] = sorted(str(archive_path) for archive_path in archive_directory.glob(f"*{_ARCHIVE_SUFFIX}"))
+    if not archive_paths:
+        LOGGER.error("No *%s files found in %s", _ARCHIVE_SUFFIX, args.archive_dir)
+        sys.exit(1)
+
+    cached_pairs: Dict[str, _PairStartEnd] = ingest_archives(archive_paths, args.process_count)
+    LOGGER.info("Ingested %d markets from %d archives", len(cached_pairs), len(archive_paths))
+    LOGGER.info("Log file: %s", LOG_FILE)
+
+
+def ingest_archives(archive_paths: List[str], process_count: Optional[int] = None) -> Dict[str, _PairStartEnd]:
+    result: Dict[str, _PairStartEnd] = {}
+    # Each archive contains the markets of one base asset: archives are split in parallel on separate processes
+    with Pool(process_count) as pool:
+        for archive_path, cached_pairs in zip(archive_paths, pool.imap(_ingest_archive, archive_paths)):
+            LOGGER.info("Ingested %s: %s", archive_path, ", ".join(sorted(cached_pairs)))
+            result.update(cached_pairs)
+    Kraken("").save_cached_pairs(result)
+    return result
+
+
+def _ingest_archive(archive_path: str) -> Dict[str, _PairStartEnd]:
+    return Kraken("").ingest_archive(archive_path)
+
+
+def _setup_argument_parser() -> ArgumentParser:
+    parser: ArgumentParser = ArgumentParser(
+        description=(
+            "Split Kraken OHLCVT zip files into the DaLI Kraken CSV pricing cache. Run it from the directory DaLI is run from. Links:\n"
+            "- documentation: https://github.com/eprbell/dali-rp2/blob/main/docs/configuration_file.md\n"
+            "- support DaLI by leaving a star on Github: https://github.com/eprbell/dali-rp2"
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-p",
+        "--process-count",
+        action="store",
+        default=os.cpu_count(),
+        help="Number of archives split in parallel",
+        metavar="PROCESS_COUNT",
+        type=int,
+    )
+    parser.add_argument(
+        "archive_dir",
+        action="store",
+        help="Directory containing <ASSET>_OHLCVT.zip files",
+        metavar="ARCHIVE_DIR",
+        type=str,
+    )
+
+    return parser
@@ -210,21 +210,21 @@ class InputPlugin(AbstractCcxtInputPlugin):
     def _get_process_deposits_pagination_detail_set(self) -> Optional[AbstractPaginationDetailSet]:
         return DateBasedPaginationDetailSet(
             limit=_DEPOSIT_RECORD_LIMIT,
-            exchange_start_time=self._start_time_ms,
+            exchange_start_time=self._get_start_time_ms(self.DEPOSITS_ENDPOINT),
             window=_NINETY_DAYS_IN_MS,
         )
 
     def _get_process_withdrawals_pagination_detail_set(self) -> Optional[AbstractPaginationDetailSet]:
         return DateBasedPaginationDetailSet(
             limit=_WITHDRAWAL_RECORD_LIMIT,
-            exchange_start_time=self._start_time_ms,
+            exchange_start_time=self._get_start_time_ms(self.WITHDRAWALS_ENDPOINT),
             window=_NINETY_DAYS_IN_MS,
         )
 
     def _get_process_trades_pagination_detail_set(self) -> Optional[AbstractPaginationDetailSet]:
         return DateBasedPaginationDetailSet(
             limit=_TRADE_RECORD_LIMIT,
-            exchange_start_time=self._start_time_ms,
+            exchange_start_time=self._get_start_time_ms(self.TRADES_ENDPOINT),
             markets=self._get_markets(),
         )
 
@@ -36,7 +36,7 @@ from rp2.logger import create_logger
 from rp2.rp2_decimal import ZERO, RP2Decimal
 from rp2.rp2_error import RP2RuntimeError
 
-from dali.abstract_input_plugin import AbstractInputPlugin
+from dali.abstract_input_plugin import AbstractInputPlugin, Checkpoint
 from dali.abstract_transaction import AbstractTransaction
 from dali.configuration import Keyword
 from dali.in_transaction import InTransaction
@@ -943,15 +943,23 @@ class InputPlugin(AbstractInputPlugin):
     def __send_request_with_pagination(self, endpoint: str, params: Optional[Dict[str, Any]] = None) -> Any:
         if params is None:
             params = {}
-        current_url: str = f"{self.__api_url}{endpoint}"
-        while True:
+        current_url: Optional[str] = f"{self.__api_url}{endpoint}"
+        # Resumed loads replay the items of the checkpoint and continue from the next page (the position of the checkpoint)
+        checkpoint: Optional[Checkpoint] = self._get_checkpoint(endpoint)
+        if checkpoint is not None:
+            self.__logger.debug("Resuming %s from checkpoint: %d items read", endpoint, len(checkpoint.items))
+            current_url = cast(Optional[str], checkpoint.position)
+            yield from checkpoint.items
+        while current_url is not None:
             response: Response = self.__session.get(current_url, params=params, auth=self.__auth, timeout=self.__TIMEOUT)
             self._validate_response(response, "get", endpoint)
             json_response: Any = response.json()
-            yield from json_response["data"]
             if "pagination" not in json_response or "next_uri" not in json_response["pagination"] or not json_response["pagination"]["next_uri"]:
-                break
-            current_url = f"{self.__api_url}{json_response['pagination']['next_uri']}"
+                current_url = None
+            else:
+                current_url = f"{self.__api_url}{json_response['pagination']['next_uri']}"
+            self._append_checkpoint(endpoint, current_url, json_response["data"])
+            yield from json_response["data"]
 
     # Documented at: https://docs.cloud.coinbase.com/exchange/docs/requests
     def _validate_response(self, response: Response, method: str, endpoint: str) -> None:
@@ -13,15 +13,31 @@
 # limitations under the License.
 
 import logging
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from inspect import Signature, signature
-from time import sleep, time
-from typing import Any, Dict, List, NamedTuple, Optional, Union
+from threading import Lock, RLock
+from time import sleep
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 from ccxt import (
+    BadRequest,
+    BaseError,
     DDoSProtection,
     Exchange,
-    ExchangeError,
     ExchangeNotAvailable,
     NetworkError,
     RequestTimeout,
@@ -36,11 +52,16 @@ from rp2.rp2_error import RP2RuntimeError
 
 from dali.abstract_pair_converter_plugin import (
     AbstractPairConverterPlugin,
+    AssetPairAndExchange,
     AssetPairAndTimestamp,
+    UnavailableBarError,
 )
+from dali.cache import get_schema, load_from_cache, save_to_cache
 from dali.configuration import Keyword
 from dali.historical_bar import HistoricalBar
 from dali.plugin.pair_converter.csv.kraken import Kraken as KrakenCsvPricing
+from dali.single_flight import SingleFlight
+from dali.token_bucket import TokenBucket
 
 # Native format keywords
 _ID: str = "id"
@@ -73,7 +94,17 @@ _EXCHANGE_DICT: Dict[str, Any] = {_BINANCE: binance, _GATE: gateio, _HUOBI: huob
 # It appears Kraken public API is limited to around 12 calls per minute.
 # There also appears to be a limit of how many calls per 2 hour time period.
 # Being authenticated lowers this limit.
+# Exchanges not listed here are throttled using the rateLimit (in ms) advertised by CCXT.
 _REQUEST_DELAYDICT: Dict[str, float] = {_KRAKEN: 5.1}
+_DEFAULT_REQUEST_DELAY: float = 0.1
+
+# Number of workers fetching prices concurrently: each exchange is still throttled by its own token bucket
+_DEFAULT_THREAD_COUNT: int = 1
+
+# Markets and fiat symbols are persisted to avoid fetching them at every run
+_DEFAULT_MARKET_SNAPSHOT_TTL_HOURS: int = 24
+# Prices and routes that weren't found are retried after this many hours
+_DEFAULT_NEGATIVE_CACHE_TTL_HOURS: int = 24
 
 # CSV Pricing classes
 _CSV_PRICING_DICT: Dict[str, Any] = {_KRAKEN: KrakenCsvPricing}
@@ -127,12 +158,19 @@ _QUOTE_PRIORITY: Dict[str, None] = {
 
 # Time constants
 _MS_IN_SECOND: int = 1000
+_MINUTE_IN_MS: int = 60000
+
+# Maximum number of candles returned by a single OHLCV request: used to fetch many bars at once
+_DEFAULT_OHLCV_PAGE_SIZE: int = 500
+_OHLCV_PAGE_SIZE_DICT: Dict[str, int] = {_BINANCE: 1000, _GATE: 1000, _KRAKEN: 720}
 
 # Cache
 _CACHE_INTERVAL: int = 200
 
 # CSV Reader
 _GOOGLE_API_KEY: str = "google_api_key"
+_PROCESS_COUNT: str = "process_count"
+_CHUNK_CACHE_SIZE: str = "chunk_cache_size"
 
 
 class AssetPairAndHistoricalPrice(NamedTuple):
@@ -142,6 +180,22 @@ class AssetPairAndHistoricalPrice(NamedTuple):
     historical_data: Optional[HistoricalBar] = None
 
 
+# OHLCV request of a historical bar search: (timeframe, since in milliseconds, limit)
+OhlcvRequest = Tuple[str, int, int]
+# Searches are sent the candles of each request, or None if the exchange kept refusing it (as opposed to an empty list: no candles).
+# Searches that end without a bar because of refused requests raise UnavailableBarError instead of returning None.
+OhlcvSearch = Generator[OhlcvRequest, Optional[List[List[Union[int, float]]]], Optional[HistoricalBar]]
+
+
+class _MarketSnapshot(NamedTuple):
+    timestamp: datetime
+    markets: List[Tuple[str, str]]  # (base, quote) of the spot markets of the exchange
+    fiat_list: List[str]
+
+
+_MARKET_SNAPSHOT_SCHEMA: str = get_schema(_MarketSnapshot)
+
+
 class PairConverterPlugin(AbstractPairConverterPlugin):
     def __init__(
         self,
@@ -150,22 +204,50 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
         fiat_priority: Optional[str] = None,
         google_api_key: Optional[str] = None,
         exchange_locked: Optional[bool] = None,
+        use_ohlcv_pages: Optional[bool] = None,
+        thread_count: Optional[int] = None,
+        csv_process_count: Optional[int] = None,
+        csv_chunk_cache_size: Optional[int] = None,
+        market_snapshot_ttl: Optional[int] = None,
+        refresh_markets: Optional[bool] = None,
+        negative_cache_ttl: Optional[int] = None,
     ) -> None:
 
-        super().__init__(historical_price_type=historical_price_type, fiat_priority=fiat_priority)
+        super().__init__(
+            historical_price_type=historical_price_type,
+            fiat_priority=fiat_priority,
+            negative_cache_ttl=negative_cache_ttl if negative_cache_ttl is not None else _DEFAULT_NEGATIVE_CACHE_TTL_HOURS,
+        )
         self.__logger: logging.Logger = create_logger(f"{self.name()}/{historical_price_type}")
 
         self.__exchanges: Dict[str, Exchange] = {}
         self.__exchange_markets: Dict[str, Dict[str, List[str]]] = {}
         self.__google_api_key: Optional[str] = google_api_key
         self.__exchange_locked: bool = exchange_locked if exchange_locked is not None else False
+        self.__use_ohlcv_pages: bool = use_ohlcv_pages if use_ohlcv_pages is not None else False
+        self.__thread_count: int = thread_count if thread_count else _DEFAULT_THREAD_COUNT
+        self.__csv_process_count: Optional[int] = csv_process_count
+        self.__csv_chunk_cache_size: Optional[int] = csv_chunk_cache_size
+        self.__market_snapshot_ttl: timedelta = timedelta(hours=market_snapshot_ttl if market_snapshot_ttl is not None else _DEFAULT_MARKET_SNAPSHOT_TTL_HOURS)
+        self.__refresh_markets: bool = refresh_markets if refresh_markets is not None else False
 
         # TO BE IMPLEMENTED - graph and vertex classes to make this more understandable
         # https://github.com/eprbell/dali-rp2/pull/53#discussion_r924056308
         self.__default_exchange: str = _DEFAULT_EXCHANGE if default_exchange is None else default_exchange
         self.__exchange_csv_reader: Dict[str, Any] = {}
         self.__exchange_graphs: Dict[str, Dict[str, Dict[str, None]]] = {}
-        self.__exchange_last_request: Dict[str, float] = {}
+        # Routes are looked up for thousands of transactions sharing the same assets: BFS trees are cached per exchange and start asset
+        self.__exchange_bfs_trees: Dict[str, Dict[str, Dict[str, Optional[str]]]] = {}
+        self.__exchange_token_buckets: Dict[str, TokenBucket] = {}
+        # Hop bars are looked up on worker threads (and the converter can be shared by callers on other threads): markets are
+        # loaded and CSV readers are created by one thread at a time, and concurrent searches for the same bar share one search.
+        # Lookups of data that is already loaded don't take any lock.
+        self.__markets_lock: RLock = RLock()
+        self.__csv_reader_lock: Lock = Lock()
+        self.__bar_flights: SingleFlight[AssetPairAndTimestamp, Optional[HistoricalBar]] = SingleFlight()
+        # Worker threads are started on first use and shared by all lookups until the plugin is closed
+        self.__executor: Optional[ThreadPoolExecutor] = None
+        self.__executor_lock: Lock = Lock()
         if exchange_locked:
             self.__logger.debug("Routing locked to single exchange %s.", self.__default_exchange)
         else:
@@ -189,40 +271,53 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
     def exchange_graphs(self) -> Dict[str, Dict[str, Dict[str, None]]]:
         return self.__exchange_graphs
 
-    def _bfs_cyclic(self, graph: Dict[str, Dict[str, None]], start: str, end: str) -> Optional[List[str]]:
+    def close(self) -> None:
+        with self.__executor_lock:
+            if self.__executor is not None:
+                self.__executor.shutdown()
+                self.__executor = None
+        # CSV readers log their chunk cache statistics
+        for csv_reader in self.__exchange_csv_reader.values():
+            csv_reader.close()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self.__executor_lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.__thread_count, thread_name_prefix=self.name())
+            return self.__executor
 
-        # maintain a queue of paths
-        # TO BE IMPLEMENTED - using on vertex queue and one dict?
-        # https://github.com/eprbell/dali-rp2/pull/53#discussion_r924058754
-        queue: List[List[str]] = []
-        visited: Dict[str, None] = {}
+    def _bfs_cyclic(self, graph: Dict[str, Dict[str, None]], start: str, end: str) -> Optional[List[str]]:
+        return self._get_path_from_bfs_tree(self._build_bfs_tree(graph, start), start, end)
 
-        # push the first path into the queue
-        queue.append([start])
+    # Returns the BFS tree rooted at start as a node -> parent dictionary: it contains the shortest path from start to every reachable node
+    def _build_bfs_tree(self, graph: Dict[str, Dict[str, None]], start: str) -> Dict[str, Optional[str]]:
+        parents: Dict[str, Optional[str]] = {start: None}
+        queue: Deque[str] = deque([start])
 
         while queue:
-            # get the first path from the queue
-            path: List[str] = queue.pop(0)
-
-            # get the last node from the path
-            node: str = path[-1]
+            node: str = queue.popleft()
 
-            # path found
-            if node == end:
-                return path
-
-            # enumerate all adjacent nodes, construct a new path and push it into the queue
+            # enumerate all adjacent nodes in priority order: the first node to reach a vertex becomes its parent
             for adjacent in graph.get(node, {}):
-
                 # prevents an infinite loop.
-                if adjacent not in visited:
-                    new_path: List[str] = list(path)
-                    new_path.append(adjacent)
-                    queue.append(new_path)
-                    visited[adjacent] = None
+                if adjacent not in parents:
+                    parents[adjacent] = node
+                    queue.append(adjacent)
 
+        return parents
+
+    def _get_path_from_bfs_tree(self, parents: Dict[str, Optional[str]], start: str, end: str) -> Optional[List[str]]:
         # No path found
-        return None
+        if end not in parents:
+            return None
+
+        path: List[str] = [end]
+        node: Optional[str] = parents[end]
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return path if path[0] == start else None
 
     def _prioritize_quote_assets(self, current_graph: Dict[str, List[str]]) -> None:
         for base_asset in current_graph.keys():
@@ -240,6 +335,79 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
         if self._is_fiat_pair(from_asset, to_asset):
             return self._get_fiat_exchange_rate(timestamp, from_asset, to_asset)
 
+        conversion_route: Optional[List[AssetPairAndHistoricalPrice]] = self._find_conversion_route(from_asset, to_asset, exchange)
+        if conversion_route is None:
+            return None
+
+        hop_bars: List[Optional[HistoricalBar]]
+
+        # Hops priced by different venues don't share a rate limit, so they can be fetched in parallel
+        venue_count: int = len({self._get_hop_venue(hop_data) for hop_data in conversion_route})
+        if self.__thread_count > 1 and venue_count > 1:
+            hop_bars = list(self._get_executor().map(lambda hop_data: self._find_hop_bar(timestamp, hop_data), conversion_route))
+        else:
+            hop_bars = [self._find_hop_bar(timestamp, hop_data) for hop_data in conversion_route]
+
+        return self._multiply_hop_bars(timestamp, conversion_route, hop_bars)
+
+    # Routes that don't exist are remembered across runs: this skips loading the markets of the exchange
+    def _find_conversion_route(self, from_asset: str, to_asset: str, exchange: str) -> Optional[List[AssetPairAndHistoricalPrice]]:
+        if self._is_known_miss(from_asset, to_asset, exchange, None):
+            return None
+        conversion_route: Optional[List[AssetPairAndHistoricalPrice]] = self._get_conversion_route(from_asset, to_asset, exchange)
+        if conversion_route is None:
+            self._add_miss(from_asset, to_asset, exchange, None)
+        return conversion_route
+
+    def _multiply_hop_bars(
+        self, timestamp: datetime, conversion_route: List[AssetPairAndHistoricalPrice], hop_bars: List[Optional[HistoricalBar]]
+    ) -> Optional[HistoricalBar]:
+        result: Optional[HistoricalBar] = None
+        hop_bar: Optional[HistoricalBar] = None
+
+        # Iterate over the conversion stack to find the price for each conversion, then multiply them together to get our final price.
+        for i, hop_data in enumerate(conversion_route):
+            hop_bar = hop_bars[i]
+
+            if hop_bar is not None:
+                # Replacing an immutable attribute
+                conversion_route[i] = conversion_route[i]._replace(historical_data=hop_bar)
+            else:
+                self.__logger.debug(
+                    """No pricing data found for hop. This could be caused by airdropped
+                    coins that do not have a market yet. Market - %s%s, Timestamp - %s, Exchange - %s""",
+                    hop_data.from_asset,
+                    hop_data.to_asset,
+                    timestamp,
+                    hop_data.exchange,
+                )
+
+            if result is not None:
+                # TO BE IMPLEMENTED - override Historical Bar * to multiply two bars?
+                result = HistoricalBar(
+                    duration=max(result.duration, hop_bar.duration),  # type: ignore
+                    timestamp=timestamp,
+                    open=(result.open * hop_bar.open),  # type: ignore
+                    high=(result.high * hop_bar.high),  # type: ignore
+                    low=(result.low * hop_bar.low),  # type: ignore
+                    close=(result.close * hop_bar.close),  # type: ignore
+                    volume=(result.volume + hop_bar.volume),  # type: ignore
+                )
+            else:
+                result = hop_bar
+
+        return result
+
+    def _find_hop_bar(self, timestamp: datetime, hop_data: AssetPairAndHistoricalPrice) -> Optional[HistoricalBar]:
+        if self._is_fiat_pair(hop_data.from_asset, hop_data.to_asset):
+            return self._get_fiat_exchange_rate(timestamp, hop_data.from_asset, hop_data.to_asset)
+        return self.find_historical_bar(hop_data.from_asset, hop_data.to_asset, timestamp, hop_data.exchange)
+
+    def _get_hop_venue(self, hop_data: AssetPairAndHistoricalPrice) -> str:
+        return _FIAT_EXCHANGE if self._is_fiat_pair(hop_data.from_asset, hop_data.to_asset) else hop_data.exchange
+
+    # Returns the list of markets (hops) to go through to convert from_asset into to_asset or None if there is no route
+    def _get_conversion_route(self, from_asset: str, to_asset: str, exchange: str) -> Optional[List[AssetPairAndHistoricalPrice]]:
         if exchange == Keyword.UNKNOWN.value or exchange not in _EXCHANGE_DICT or self.__exchange_locked:
             if self.__exchange_locked:
                 self.__logger.debug("Price routing locked to %s type for %s.", self.__default_exchange, exchange)
@@ -249,29 +417,32 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
 
         # The exchange could have been added as an alt; if so markets wouldn't have been built
         if exchange not in self.__exchanges or exchange not in self.__exchange_markets:
-            if self.__exchange_locked:
-                self._add_exchange_to_memcache(self.__default_exchange)
-            elif exchange in _EXCHANGE_DICT:
-                self._add_exchange_to_memcache(exchange)
-            else:
+            if not self.__exchange_locked and exchange not in _EXCHANGE_DICT:
                 self.__logger.error("WARNING: Unrecognized Exchange: %s. Please open an issue at %s", exchange, self.issues_url)
                 return None
+            with self.__markets_lock:
+                # Another thread may have loaded the markets while this one was waiting for the lock
+                if exchange not in self.__exchanges or exchange not in self.__exchange_markets:
+                    self._add_exchange_to_memcache(self.__default_exchange if self.__exchange_locked else exchange)
 
         current_markets = self.__exchange_markets[exchange]
         current_graph = self.__exchange_graphs[exchange]
 
         market_symbol = from_asset + to_asset
-        result: Optional[HistoricalBar] = None
 
         # TO BE IMPLEMENTED - bypass routing if conversion can be done with one market on the exchange
         if market_symbol in current_markets and (exchange in current_markets[market_symbol]):
             self.__logger.debug("Found market - %s on single exchange, skipping routing.", market_symbol)
-            result = self.find_historical_bar(from_asset, to_asset, timestamp, exchange)
-            return result
+            return [AssetPairAndHistoricalPrice(from_asset=from_asset, to_asset=to_asset, exchange=exchange, historical_data=None)]
         # else:
         # Graph building goes here.
 
-        pricing_path: Optional[List[str]] = self._bfs_cyclic(current_graph, from_asset, to_asset)
+        bfs_trees: Dict[str, Dict[str, Optional[str]]] = self.__exchange_bfs_trees.setdefault(exchange, {})
+        bfs_tree: Optional[Dict[str, Optional[str]]] = bfs_trees.get(from_asset)
+        if bfs_tree is None:
+            # Threads racing here build the same tree: setdefault keeps the first one
+            bfs_tree = bfs_trees.setdefault(from_asset, self._build_bfs_tree(current_graph, from_asset))
+        pricing_path: Optional[List[str]] = self._get_path_from_bfs_tree(bfs_tree, from_asset, to_asset)
         if pricing_path is None:
             self.__logger.debug("No path found for %s to %s. Please open an issue at %s.", from_asset, to_asset, self.issues_url)
             return None
@@ -280,10 +451,8 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
 
         conversion_route: List[AssetPairAndHistoricalPrice] = []
         last_node: Optional[str] = None
-        hop_bar: Optional[HistoricalBar] = None
 
         # Build conversion stack, we will iterate over this to find the price for each conversion
-        # Then multiply them together to get our final price.
         for node in pricing_path:
 
             if last_node:
@@ -298,149 +467,360 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
 
             last_node = node
 
-        for i, hop_data in enumerate(conversion_route):
-            if self._is_fiat_pair(hop_data.from_asset, hop_data.to_asset):
-                hop_bar = self._get_fiat_exchange_rate(timestamp, hop_data.from_asset, hop_data.to_asset)
-            else:
-                hop_bar = self.find_historical_bar(hop_data.from_asset, hop_data.to_asset, timestamp, hop_data.exchange)
-
-            if hop_bar is not None:
-                # Replacing an immutable attribute
-                conversion_route[i] = conversion_route[i]._replace(historical_data=hop_bar)
-            else:
-                self.__logger.debug(
-                    """No pricing data found for hop. This could be caused by airdropped
-                    coins that do not have a market yet. Market - %s%s, Timestamp - %s, Exchange - %s""",
-                    hop_data.from_asset,
-                    hop_data.to_asset,
-                    timestamp,
-                    hop_data.exchange,
-                )
-
-            if result is not None:
-                # TO BE IMPLEMENTED - override Historical Bar * to multiply two bars?
-                result = HistoricalBar(
-                    duration=max(result.duration, hop_bar.duration),  # type: ignore
-                    timestamp=timestamp,
-                    open=(result.open * hop_bar.open),  # type: ignore
-                    high=(result.high * hop_bar.high),  # type: ignore
-                    low=(result.low * hop_bar.low),  # type: ignore
-                    close=(result.close * hop_bar.close),  # type: ignore
-                    volume=(result.volume + hop_bar.volume),  # type: ignore
-                )
-            else:
-                result = hop_bar
+        return conversion_route
+
+    # Fills the bar cache with pages of candles covering the requested timestamps: one request returns up to a page worth of
+    # candles, instead of one request (or more, one per granularity) for each timestamp.
+    def prefetch_historical_bars(self, pair_2_timestamps: Dict[AssetPairAndExchange, List[datetime]]) -> Dict[AssetPairAndExchange, List[datetime]]:
+        result: Dict[AssetPairAndExchange, List[datetime]] = {}
+        pair_2_hops: Dict[AssetPairAndExchange, List[AssetPairAndExchange]] = {}
+        hop_2_timestamps: Dict[AssetPairAndExchange, Set[datetime]] = {}
+        fiat_base_2_timestamps: Dict[str, Set[datetime]] = {}
+
+        for pair, timestamps in pair_2_timestamps.items():
+            if self._is_fiat_pair(pair.from_asset, pair.to_asset):
+                fiat_base_2_timestamps.setdefault(pair.from_asset, set()).update(timestamps)
+                continue
+            conversion_route: Optional[List[AssetPairAndHistoricalPrice]] = self._get_conversion_route(pair.from_asset, pair.to_asset, pair.exchange)
+            if conversion_route is None:
+                result[pair] = timestamps
+                continue
+            pair_2_hops[pair] = []
+            for hop_data in conversion_route:
+                if self._is_fiat_pair(hop_data.from_asset, hop_data.to_asset):
+                    fiat_base_2_timestamps.setdefault(hop_data.from_asset, set()).update(timestamps)
+                else:
+                    hop: AssetPairAndExchange = AssetPairAndExchange(hop_data.from_asset, hop_data.to_asset, hop_data.exchange)
+                    pair_2_hops[pair].append(hop)
+                    hop_2_timestamps.setdefault(hop, set()).update(timestamps)
+
+        # Daily fiat rates are downloaded as timeseries, one per base, for the days the base doesn't have rates for yet
+        for base, fiat_timestamps in fiat_base_2_timestamps.items():
+            self._prefetch_fiat_exchange_rates(base, fiat_timestamps)
+
+        # Hops are fetched concurrently: requests to the same exchange are serialized by its token bucket
+        if self.__thread_count > 1 and len(hop_2_timestamps) > 1:
+            # Consuming the results waits for all the hops
+            list(self._get_executor().map(lambda hop_item: self._prefetch_hop(hop_item[0], sorted(hop_item[1])), hop_2_timestamps.items()))
+        else:
+            for hop, hop_timestamps in hop_2_timestamps.items():
+                self._prefetch_hop(hop, sorted(hop_timestamps))
+
+        # Timestamps with a hop that isn't cached (e.g. the page had no candle for it, or the hop is priced by a CSV reader) are left
+        # to the next pair converter
+        for pair, hops in pair_2_hops.items():
+            missing_timestamps: List[datetime] = [
+                timestamp for timestamp in pair_2_timestamps[pair] if not all(self._is_bar_cached(hop, timestamp) for hop in hops)
+            ]
+            if missing_timestamps:
+                result[pair] = missing_timestamps
 
         return result
 
+    # Prefetching is optional: a hop that fails is logged and its prices are looked up one at a time later
+    def _prefetch_hop(self, hop: AssetPairAndExchange, timestamps: List[datetime]) -> None:
+        # CSV readers are local and have full history: they are faster than the REST API
+        if self._has_csv_reader(hop.exchange):
+            return
+        try:
+            self._prefetch_hop_pages(hop, timestamps)
+        except (BaseError, RP2RuntimeError) as exc:
+            self.__logger.warning("Cannot prefetch %s/%s bars on %s: %s", hop.from_asset, hop.to_asset, hop.exchange, exc)
+
+    def _prefetch_hop_pages(self, hop: AssetPairAndExchange, timestamps: List[datetime]) -> None:
+        # Illiquid hops only have candles at coarser granularities: the bars cached by earlier lookups tell which one
+        granularity: int = 0
+        uncached_timestamps: List[datetime] = []
+        for timestamp in timestamps:
+            if self._is_known_miss(hop.from_asset, hop.to_asset, hop.exchange, timestamp):
+                continue
+            key: AssetPairAndTimestamp = AssetPairAndTimestamp(timestamp, hop.from_asset, hop.to_asset, hop.exchange)
+            if self._get_bar_from_cache(key) is not None:
+                continue
+            covering_bar: Optional[HistoricalBar] = self._get_covering_bar_from_cache(key)
+            if covering_bar is None:
+                uncached_timestamps.append(timestamp)
+            elif int(covering_bar.duration.total_seconds()) in _TIME_GRANULARITY_IN_SECONDS:
+                granularity = max(granularity, _TIME_GRANULARITY_IN_SECONDS.index(int(covering_bar.duration.total_seconds())))
+
+        page_size: int = _OHLCV_PAGE_SIZE_DICT.get(hop.exchange, _DEFAULT_OHLCV_PAGE_SIZE)
+        candle_ms: int = _TIME_GRANULARITY_IN_SECONDS[granularity] * _MS_IN_SECOND
+        page_end: int = 0
+        for timestamp in uncached_timestamps:
+            ms_timestamp: int = int(timestamp.timestamp() * _MS_IN_SECOND) // candle_ms * candle_ms
+            if ms_timestamp < page_end:
+                continue
+            self._fetch_historical_bar_page(hop.from_asset, hop.to_asset, ms_timestamp, hop.exchange, page_size, granularity)
+            page_end = ms_timestamp + page_size * candle_ms
+
+    # Whether the bar of the hop for the timestamp is cached, at any granularity
+    def _is_bar_cached(self, hop: AssetPairAndExchange, timestamp: datetime) -> bool:
+        key: AssetPairAndTimestamp = AssetPairAndTimestamp(timestamp, hop.from_asset, hop.to_asset, hop.exchange)
+        return self._get_bar_from_cache(key) is not None or self._get_covering_bar_from_cache(key) is not None
+
+    # Reads up to page_size candles of the granularity (1 minute by default) starting at ms_timestamp and adds them all to the bar cache
+    def _fetch_historical_bar_page(self, from_asset: str, to_asset: str, ms_timestamp: int, exchange: str, page_size: int, granularity: int = 0) -> int:
+        historical_data: Optional[List[List[Union[int, float]]]] = self._fetch_ohlcv(
+            exchange, f"{from_asset}/{to_asset}", _TIME_GRANULARITY[granularity], ms_timestamp, page_size
+        )
+        if historical_data is None:
+            return 0
+        return self._cache_historical_bar_page(from_asset, to_asset, ms_timestamp, exchange, page_size, historical_data, granularity)
+
+    # Adds the candles of a page starting at ms_timestamp to the bar cache and returns how many there were
+    def _cache_historical_bar_page(
+        self,
+        from_asset: str,
+        to_asset: str,
+        ms_timestamp: int,
+        exchange: str,
+        page_size: int,
+        historical_data: List[List[Union[int, float]]],
+        granularity: int = 0,
+    ) -> int:
+        page_end: int = ms_timestamp + page_size * _TIME_GRANULARITY_IN_SECONDS[granularity] * _MS_IN_SECOND
+        bar_count: int = 0
+        for candle in historical_data:
+            # Some exchanges ignore the since parameter and return the latest candles instead
+            if not ms_timestamp <= int(candle[0]) < page_end:
+                continue
+            bar_timestamp: datetime = datetime.fromtimestamp(int(candle[0]) / _MS_IN_SECOND, timezone.utc)
+            self._add_bar_to_cache(
+                AssetPairAndTimestamp(bar_timestamp, from_asset, to_asset, exchange),
+                self._candle_to_bar(candle, _TIME_GRANULARITY_IN_SECONDS[granularity], bar_timestamp),
+            )
+            bar_count += 1
+        self.__logger.debug("Cached %d bars for %s/%s on %s starting at %s", bar_count, from_asset, to_asset, exchange, ms_timestamp)
+        return bar_count
+
+    @staticmethod
+    def _candle_to_bar(candle: List[Union[int, float]], duration_seconds: int, timestamp: datetime) -> HistoricalBar:
+        return HistoricalBar(
+            duration=timedelta(seconds=duration_seconds),
+            timestamp=timestamp,
+            open=RP2Decimal(str(candle[1])),
+            high=RP2Decimal(str(candle[2])),
+            low=RP2Decimal(str(candle[3])),
+            close=RP2Decimal(str(candle[4])),
+            volume=RP2Decimal(str(candle[5])),
+        )
+
+    def _has_csv_reader(self, exchange: str) -> bool:
+        if exchange in self.__exchange_csv_reader:
+            return True
+        csv_pricing: Any = _CSV_PRICING_DICT.get(exchange)
+        if csv_pricing is None:
+            return False
+        return _GOOGLE_API_KEY not in signature(csv_pricing).parameters or self.__google_api_key is not None
+
     def find_historical_bar(self, from_asset: str, to_asset: str, timestamp: datetime, exchange: str) -> Optional[HistoricalBar]:
-        result: Optional[HistoricalBar] = None
-        retry_count: int = 0
-        current_exchange: Any = self.__exchanges[exchange]
-        ms_timestamp: int = int(timestamp.timestamp() * _MS_IN_SECOND)
         key: AssetPairAndTimestamp = AssetPairAndTimestamp(timestamp, from_asset, to_asset, exchange)
+        historical_bar: Optional[HistoricalBar] = self._find_local_historical_bar(key)
+        if historical_bar is not None:
+            return historical_bar
+
+        # Bars are cached by minute: threads looking up the same minute wait for the first search instead of repeating its requests
+        return self.__bar_flights.do(self._floor_key(key), lambda: self._fetch_historical_bar(key))
+
+    def _fetch_historical_bar(self, key: AssetPairAndTimestamp) -> Optional[HistoricalBar]:
+        # A search that finished while this one was waiting to start may have cached the bar
+        historical_bar: Optional[HistoricalBar] = self._get_bar_from_cache(key)
+        if historical_bar is not None:
+            return historical_bar
+
+        search: OhlcvSearch = self._search_historical_bar(key)
+        try:
+            request: OhlcvRequest = next(search)
+            while True:
+                request = search.send(self._fetch_ohlcv(key.exchange, f"{key.from_asset}/{key.to_asset}", *request))
+        except StopIteration as stop:
+            return cast(Optional[HistoricalBar], stop.value)
+
+    # Looks up the bar in the cache and in the CSV readers, without calling the exchange REST API
+    def _find_local_historical_bar(self, key: AssetPairAndTimestamp) -> Optional[HistoricalBar]:
+        timestamp, from_asset, to_asset, exchange = key
         historical_bar: Optional[HistoricalBar] = self._get_bar_from_cache(key)
-        csv_pricing: Any = _CSV_PRICING_DICT.get(exchange)
-        csv_reader: Any = None
 
         if historical_bar is not None:
             self.__logger.debug("Retrieved cache for %s/%s->%s for %s", timestamp, from_asset, to_asset, exchange)
             return historical_bar
 
-        if self.__exchange_csv_reader.get(exchange):
-            csv_reader = self.__exchange_csv_reader[exchange]
-        elif csv_pricing is not None:
+        csv_reader: Any = self._get_csv_reader(exchange)
+        if csv_reader:
+            csv_bar: Optional[HistoricalBar] = csv_reader.find_historical_bar(from_asset, to_asset, timestamp)
+
+            if csv_bar:
+                self._add_bar_to_cache(key=AssetPairAndTimestamp(timestamp, from_asset, to_asset, exchange), historical_bar=csv_bar)
+
+            historical_bar = self._get_bar_from_cache(key)
+            if historical_bar is not None:
+                self.__logger.debug("Retrieved bar cache - %s for %s/%s->%s for %s", historical_bar, key.timestamp, key.from_asset, key.to_asset, key.exchange)
+                return historical_bar
+
+        # Illiquid pairs are often priced with hourly or daily bars: reusing a cached bar that contains the timestamp avoids falling
+        # back through all the granularities on the network again
+        historical_bar = self._get_covering_bar_from_cache(key)
+        if historical_bar is not None:
+            self.__logger.debug("Retrieved covering bar cache - %s for %s/%s->%s for %s", historical_bar, timestamp, from_asset, to_asset, exchange)
+
+        return historical_bar
+
+    def _get_csv_reader(self, exchange: str) -> Any:
+        csv_reader: Any = self.__exchange_csv_reader.get(exchange)
+        csv_pricing: Any = _CSV_PRICING_DICT.get(exchange)
+        if csv_reader or csv_pricing is None:
+            return csv_reader
+
+        with self.__csv_reader_lock:
+            # Another thread may have created the reader while this one was waiting for the lock
+            csv_reader = self.__exchange_csv_reader.get(exchange)
+            if csv_reader:
+                return csv_reader
+
             csv_signature: Signature = signature(csv_pricing)
+            csv_parameters: Dict[str, Any] = {}
+            if _PROCESS_COUNT in csv_signature.parameters:
+                csv_parameters[_PROCESS_COUNT] = self.__csv_process_count
+            if _CHUNK_CACHE_SIZE in csv_signature.parameters:
+                csv_parameters[_CHUNK_CACHE_SIZE] = self.__csv_chunk_cache_size
 
             # a Google API key is necessary to interact with Google Drive since Google restricts API calls to avoid spam, etc...
             if _GOOGLE_API_KEY in csv_signature.parameters:
                 if self.__google_api_key is not None:
-                    csv_reader = csv_pricing(self.__google_api_key)
+                    csv_reader = csv_pricing(self.__google_api_key, **csv_parameters)
                 else:
                     self.__logger.info(
                         "Google API Key is not set. Setting the Google API key in the CCXT pair converter plugin could speed up pricing resolution"
                     )
             else:
-                csv_reader = csv_pricing()
+                csv_reader = csv_pricing(**csv_parameters)
 
-        if csv_reader:
-            csv_bar: Optional[HistoricalBar] = csv_reader.find_historical_bar(from_asset, to_asset, timestamp)
+            if csv_reader:
+                self.__exchange_csv_reader[exchange] = csv_reader
+        return csv_reader
 
-            if csv_bar:
-                self._add_bar_to_cache(key=AssetPairAndTimestamp(timestamp, from_asset, to_asset, exchange), historical_bar=csv_bar)
+    # Finds the bar on the exchange REST API, starting from the finest granularity. The search doesn't do any I/O: it yields the
+    # (timeframe, since, limit) OHLCV requests it needs and is sent their candles back, so that the same search can be driven by
+    # blocking and by asyncio clients. The bar (or None) is the return value of the generator.
+    def _search_historical_bar(self, key: AssetPairAndTimestamp) -> OhlcvSearch:
+        timestamp, from_asset, to_asset, exchange = key
+        result: Optional[HistoricalBar] = None
+        retry_count: int = 0
+        ms_timestamp: int = int(timestamp.timestamp() * _MS_IN_SECOND)
+        historical_data: Optional[List[List[Union[int, float]]]]
+        # A request the exchange refused doesn't prove that there is no data: the miss is recorded only if all requests succeeded
+        has_failed_request: bool = False
 
-            historical_bar = self._get_bar_from_cache(key)
-            self.__exchange_csv_reader[exchange] = csv_reader
-            if historical_bar is not None:
-                self.__logger.debug("Retrieved bar cache - %s for %s/%s->%s for %s", historical_bar, key.timestamp, key.from_asset, key.to_asset, key.exchange)
-                return historical_bar
+        # Every granularity was already tried without success
+        if self._is_known_miss(from_asset, to_asset, exchange, timestamp):
+            return None
+
+        # Read a full page of 1-minute candles around the timestamp: later lookups in the same window will hit the cache
+        if self.__use_ohlcv_pages:
+            page_size: int = _OHLCV_PAGE_SIZE_DICT.get(exchange, _DEFAULT_OHLCV_PAGE_SIZE)
+            floored_ms_timestamp: int = int(self._floor_key(key).timestamp.timestamp() * _MS_IN_SECOND)
+            page_start: int = floored_ms_timestamp - (page_size // 2) * _MINUTE_IN_MS
+            historical_data = yield (_MINUTE, page_start, page_size)
+            if historical_data is None:
+                has_failed_request = True
+            elif self._cache_historical_bar_page(from_asset, to_asset, page_start, exchange, page_size, historical_data) > 0:
+                historical_bar: Optional[HistoricalBar] = self._get_bar_from_cache(key)
+                if historical_bar is not None:
+                    self.__logger.debug("Retrieved bar from page - %s for %s/%s->%s for %s", historical_bar, timestamp, from_asset, to_asset, exchange)
+                    return historical_bar
+                # The page has candles, but none for this minute: skip straight to coarser granularities
+                retry_count = 1
 
         while retry_count < len(_TIME_GRANULARITY):
 
-            timeframe: str = _TIME_GRANULARITY[retry_count]
-            request_count: int = 0
-            historical_data: List[List[Union[int, float]]] = []
-
-            # Most exceptions are caused by request limits of the underlying APIs
-            while request_count < 9:
-                try:
-                    # Excessive calls to the API within a certain window might get an IP temporarily banned
-                    if _REQUEST_DELAYDICT.get(exchange, 0) > 0:
-                        current_time = time()
-                        second_delay = max(0, _REQUEST_DELAYDICT[exchange] - (current_time - self.__exchange_last_request.get(exchange, 0)))
-                        self.__logger.debug("Delaying for %s seconds", second_delay)
-                        sleep(second_delay)
-                        self.__exchange_last_request[exchange] = time()
-
-                    # this is where we pull the historical prices from the underlying exchange
-                    historical_data = current_exchange.fetchOHLCV(f"{from_asset}/{to_asset}", timeframe, ms_timestamp, 1)
-                    break
-                except (DDoSProtection, ExchangeError) as exc:
-                    self.__logger.debug(
-                        "Exception from server, most likely too many requests. Making another attempt after 0.1 second delay. Exception - %s", exc
-                    )
-                    # logger INFO for retry?
-                    sleep(0.1)
-                    request_count += 3
-                except (ExchangeNotAvailable, NetworkError, RequestTimeout) as exc_na:
-                    request_count += 1
-                    if request_count > 9:
-                        if exchange == _BINANCE:
-                            self.__logger.info(
-                                """
-                                Binance server unavailable. Try a non-Binance locked exchange pair converter.
-                                Saving to cache and exiting.
-                                """
-                            )
-                        else:
-                            self.__logger.info("Maximum number of retries reached. Saving to cache and exiting.")
-                        self.save_historical_price_cache()
-                        raise RP2RuntimeError("Server error") from exc_na
-
-                    self.__logger.debug("Server not available. Making attempt #%s of 10 after a ten second delay. Exception - %s", request_count, exc_na)
-                    sleep(10)
+            historical_data = yield (_TIME_GRANULARITY[retry_count], ms_timestamp, 1)
 
             # If there is no candle the list will be empty
             if historical_data:
-                result = HistoricalBar(
-                    duration=timedelta(seconds=_TIME_GRANULARITY_IN_SECONDS[retry_count]),
-                    timestamp=timestamp,
-                    open=RP2Decimal(str(historical_data[0][1])),
-                    high=RP2Decimal(str(historical_data[0][2])),
-                    low=RP2Decimal(str(historical_data[0][3])),
-                    close=RP2Decimal(str(historical_data[0][4])),
-                    volume=RP2Decimal(str(historical_data[0][5])),
-                )
+                # The candle may open after the timestamp (e.g. if there were no trades in the meantime): the bar has its open time
+                candle_timestamp: datetime = datetime.fromtimestamp(int(historical_data[0][0]) / _MS_IN_SECOND, timezone.utc)
+                result = self._candle_to_bar(historical_data[0], _TIME_GRANULARITY_IN_SECONDS[retry_count], candle_timestamp)
                 break
 
+            if historical_data is None:
+                has_failed_request = True
+            # The exchange rejected the request (e.g. the market doesn't exist): coarser granularities have no data either
+            elif self._is_known_miss(from_asset, to_asset, exchange, timestamp):
+                break
             retry_count += 1
 
         # Save the individual pair to cache
         if result is not None:
             self._add_bar_to_cache(key, result)
+        elif has_failed_request:
+            raise UnavailableBarError(f"{exchange} kept refusing {from_asset}/{to_asset} requests")
+        else:
+            self._add_miss(from_asset, to_asset, exchange, timestamp)
 
         return result
 
+    # Returns None if the exchange kept refusing the request (e.g. because of rate limits) after all the retries
+    def _fetch_ohlcv(self, exchange: str, symbol: str, timeframe: str, ms_timestamp: int, limit: int) -> Optional[List[List[Union[int, float]]]]:
+        current_exchange: Any = self.__exchanges[exchange]
+        historical_data: Optional[List[List[Union[int, float]]]] = None
+        request_count: int = 0
+
+        # Most exceptions are caused by request limits of the underlying APIs
+        while request_count < 9:
+            try:
+                # Excessive calls to the API within a certain window might get an IP temporarily banned
+                second_delay: float = self._get_token_bucket(exchange).acquire()
+                if second_delay > 0:
+                    self.__logger.debug("Delayed %s for %s seconds", exchange, second_delay)
+
+                # this is where we pull the historical prices from the underlying exchange
+                historical_data = current_exchange.fetchOHLCV(symbol, timeframe, ms_timestamp, limit)
+                break
+            except BadRequest as exc:
+                self._add_rejected_request_miss(exchange, symbol, ms_timestamp, exc)
+                return []
+            except DDoSProtection as exc:
+                self.__logger.debug("Exception from server, most likely too many requests. Making another attempt after 0.1 second delay. Exception - %s", exc)
+                # logger INFO for retry?
+                sleep(0.1)
+                request_count += 3
+            except (ExchangeNotAvailable, NetworkError, RequestTimeout) as exc_na:
+                request_count += 1
+                if request_count > 9:
+                    if exchange == _BINANCE:
+                        self.__logger.info(
+                            """
+                            Binance server unavailable. Try a non-Binance locked exchange pair converter.
+                            Saving to cache and exiting.
+                            """
+                        )
+                    else:
+                        self.__logger.info("Maximum number of retries reached. Saving to cache and exiting.")
+                    self.save_historical_price_cache()
+                    raise RP2RuntimeError("Server error") from exc_na
+
+                self.__logger.debug("Server not available. Making attempt #%s of 10 after a ten second delay. Exception - %s", request_count, exc_na)
+                sleep(10)
+
+        return historical_data
+
+    # Requests the exchange rejects as invalid (e.g. BadSymbol for a market that doesn't exist) have no data: retrying them can't help
+    def _add_rejected_request_miss(self, exchange: str, symbol: str, ms_timestamp: int, exc: BadRequest) -> None:
+        self.__logger.debug("%s rejected the %s request, recording it as a miss. Exception - %s", exchange, symbol, exc)
+        from_asset, to_asset = symbol.split("/", 1)
+        self._add_miss(from_asset, to_asset, exchange, datetime.fromtimestamp(ms_timestamp / _MS_IN_SECOND, timezone.utc))
+
+    def _get_token_bucket(self, exchange: str) -> TokenBucket:
+        token_bucket: Optional[TokenBucket] = self.__exchange_token_buckets.get(exchange)
+        if token_bucket is None:
+            second_delay: float = _REQUEST_DELAYDICT.get(exchange, 0)
+            if second_delay <= 0:
+                rate_limit: Any = getattr(self.__exchanges[exchange], "rateLimit", None)
+                second_delay = float(rate_limit) / _MS_IN_SECOND if isinstance(rate_limit, (int, float)) and rate_limit > 0 else _DEFAULT_REQUEST_DELAY
+            # setdefault keeps a single bucket per exchange even if two workers get here at the same time
+            token_bucket = self.__exchange_token_buckets.setdefault(exchange, TokenBucket(rate=1 / second_delay))
+        return token_bucket
+
     def _add_alternative_markets(self, current_graph: Dict[str, Dict[str, None]], current_markets: Dict[str, List[str]]) -> None:
         for base_asset, quote_asset in _ALT_MARKET_BY_BASE_DICT.items():
             alt_market = base_asset + quote_asset
@@ -473,15 +853,29 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
         current_markets: Dict[str, List[str]] = {}
         current_graph: Dict[str, Dict[str, None]] = {}
 
-        for market in filter(lambda x: x[_TYPE] == "spot" and x[_QUOTE] in _QUOTE_PRIORITY, current_exchange.fetch_markets()):
-            self.__logger.debug("Market: %s", market)
-
-            current_markets[f"{market[_BASE]}{market[_QUOTE]}"] = [exchange]
+        market_snapshot: Optional[_MarketSnapshot] = self._load_market_snapshot(exchange)
+        if market_snapshot is None:
+            market_snapshot = _MarketSnapshot(
+                timestamp=datetime.now(timezone.utc),
+                markets=[
+                    (market[_BASE], market[_QUOTE])
+                    for market in current_exchange.fetch_markets()
+                    if market[_TYPE] == "spot" and market[_QUOTE] in _QUOTE_PRIORITY
+                ],
+                fiat_list=[],
+            )
+        elif not self.fiat_list:
+            self._set_fiat_list(market_snapshot.fiat_list)
+
+        for base_asset, quote_asset in market_snapshot.markets:
+            self.__logger.debug("Market: %s/%s", base_asset, quote_asset)
+
+            current_markets[f"{base_asset}{quote_asset}"] = [exchange]
 
             # TO BE IMPLEMENTED - lazy build graph only if needed
 
             # Add the quote asset to the graph if it isn't there already.
-            current_graph.setdefault(market[_BASE], {})[market[_QUOTE]] = None
+            current_graph.setdefault(base_asset, {})[quote_asset] = None
 
         self._prioritize_quote_assets(current_markets)
 
@@ -494,3 +888,28 @@ class PairConverterPlugin(AbstractPairConverterPlugin):
         self.__exchanges[exchange] = current_exchange
         self.__exchange_markets[exchange] = current_markets
         self.__exchange_graphs[exchange] = current_graph
+        self.__exchange_bfs_trees.pop(exchange, None)
+
+        # The fiat list is only known after the fiat edges are added
+        if not market_snapshot.fiat_list:
+            self._save_market_snapshot(exchange, market_snapshot._replace(fiat_list=list(self.fiat_list)))
+
+    def _market_snapshot_cache_key(self, exchange: str) -> str:
+        return f"{self.cache_key()}-markets-{exchange}"
+
+    # Returns None if the snapshot is missing, expired or a refresh was requested
+    def _load_market_snapshot(self, exchange: str) -> Optional[_MarketSnapshot]:
+        if self.__refresh_markets or self.__market_snapshot_ttl <= timedelta(0):
+            return None
+        market_snapshot: Any = load_from_cache(self._market_snapshot_cache_key(exchange), schema=_MARKET_SNAPSHOT_SCHEMA)
+        if not isinstance(market_snapshot, _MarketSnapshot) or not market_snapshot.fiat_list:
+            return None
+        if datetime.now(timezone.utc) - market_snapshot.timestamp > self.__market_snapshot_ttl:
+            self.__logger.debug("Market snapshot for %s expired on %s", exchange, market_snapshot.timestamp + self.__market_snapshot_ttl)
+            return None
+        self.__logger.debug("Loaded market snapshot for %s from %s", exchange, market_snapshot.timestamp)
+        return market_snapshot
+
+    def _save_market_snapshot(self, exchange: str, market_snapshot: _MarketSnapshot) -> None:
+        if self.__market_snapshot_ttl > timedelta(0):
+            save_to_cache(self._market_snapshot_cache_key(exchange), market_snapshot, schema=_MARKET_SNAPSHOT_SCHEMA, plugin=self.name())
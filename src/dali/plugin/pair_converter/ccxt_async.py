@@ -0,0 +1,201 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from contextvars import ContextVar, Token
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Union, cast
+
+from ccxt import (
+    BadRequest,
+    DDoSProtection,
+    ExchangeNotAvailable,
+    NetworkError,
+    RequestTimeout,
+    async_support,
+)
+from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2RuntimeError
+
+from dali.abstract_pair_converter_plugin import AssetPairAndTimestamp
+from dali.historical_bar import HistoricalBar
+from dali.logger import LOGGER
+from dali.plugin.pair_converter.ccxt import (
+    AssetPairAndHistoricalPrice,
+    OhlcvRequest,
+    OhlcvSearch,
+)
+from dali.plugin.pair_converter.ccxt import (
+    PairConverterPlugin as CcxtPairConverterPlugin,
+)
+from dali.single_flight import AsyncSingleFlight
+
+# Async clients of the batch being priced, by exchange. Async clients are bound to the event loop that created them, so each
+# get_conversion_rates() call creates its own and closes them when it's done: lookups run in tasks of the batch, which inherit it.
+_BATCH_ASYNC_EXCHANGES: ContextVar[Dict[str, Any]] = ContextVar("batch_async_exchanges")
+
+
+# Same routing, caching and pricing as the CCXT pair converter, but get_conversion_rates() prices a batch of keys concurrently on
+# an asyncio event loop with the ccxt.async_support clients: while a lookup waits for an exchange (or for its rate limit), the
+# others keep going. Markets are still loaded with the blocking clients (usually from the market snapshot).
+class PairConverterPlugin(CcxtPairConverterPlugin):
+    def __init__(
+        self,
+        historical_price_type: str,
+        default_exchange: Optional[str] = None,
+        fiat_priority: Optional[str] = None,
+        google_api_key: Optional[str] = None,
+        exchange_locked: Optional[bool] = None,
+        use_ohlcv_pages: Optional[bool] = None,
+        thread_count: Optional[int] = None,
+        csv_process_count: Optional[int] = None,
+        csv_chunk_cache_size: Optional[int] = None,
+        market_snapshot_ttl: Optional[int] = None,
+        refresh_markets: Optional[bool] = None,
+        negative_cache_ttl: Optional[int] = None,
+    ) -> None:
+
+        super().__init__(
+            historical_price_type=historical_price_type,
+            default_exchange=default_exchange,
+            fiat_priority=fiat_priority,
+            google_api_key=google_api_key,
+            exchange_locked=exchange_locked,
+            use_ohlcv_pages=use_ohlcv_pages,
+            thread_count=thread_count,
+            csv_process_count=csv_process_count,
+            csv_chunk_cache_size=csv_chunk_cache_size,
+            market_snapshot_ttl=market_snapshot_ttl,
+            refresh_markets=refresh_markets,
+            negative_cache_ttl=negative_cache_ttl,
+        )
+        self.__bar_flights: AsyncSingleFlight[AssetPairAndTimestamp, Optional[HistoricalBar]] = AsyncSingleFlight()
+
+    def name(self) -> str:
+        return "CCXT-async-converter"
+
+    # Bars are shared with the blocking CCXT pair converter
+    def cache_key(self) -> str:
+        return "CCXT-converter"
+
+    async def get_conversion_rates(self, keys: Iterable[AssetPairAndTimestamp]) -> Dict[AssetPairAndTimestamp, Optional[RP2Decimal]]:
+        async_exchanges: Dict[str, Any] = {}
+        token: Token[Dict[str, Any]] = _BATCH_ASYNC_EXCHANGES.set(async_exchanges)
+        try:
+            return await super().get_conversion_rates(keys)
+        finally:
+            _BATCH_ASYNC_EXCHANGES.reset(token)
+            await asyncio.gather(*(async_exchange.close() for async_exchange in async_exchanges.values()))
+
+    # The fiat list and the markets may have to be downloaded: they are looked up on the executor, so they don't block the event loop
+    async def get_historic_bar_from_native_source_async(self, timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[HistoricalBar]:
+        if await self._run_in_executor(self._is_fiat_pair, from_asset, to_asset):
+            return cast(Optional[HistoricalBar], await self._run_in_executor(self._get_fiat_exchange_rate, timestamp, from_asset, to_asset))
+
+        conversion_route: Optional[List[AssetPairAndHistoricalPrice]] = cast(
+            Optional[List[AssetPairAndHistoricalPrice]], await self._run_in_executor(self._find_conversion_route, from_asset, to_asset, exchange)
+        )
+        if conversion_route is None:
+            return None
+
+        # All the hops are done before an error is raised: none of them is left running after the batch closes its clients
+        hop_results: List[Union[Optional[HistoricalBar], BaseException]] = await asyncio.gather(
+            *(self._find_hop_bar_async(timestamp, hop_data) for hop_data in conversion_route), return_exceptions=True
+        )
+        hop_bars: List[Optional[HistoricalBar]] = []
+        for hop_result in hop_results:
+            if isinstance(hop_result, BaseException):
+                raise hop_result
+            hop_bars.append(hop_result)
+        return self._multiply_hop_bars(timestamp, conversion_route, hop_bars)
+
+    async def _find_hop_bar_async(self, timestamp: datetime, hop_data: AssetPairAndHistoricalPrice) -> Optional[HistoricalBar]:
+        if await self._run_in_executor(self._is_fiat_pair, hop_data.from_asset, hop_data.to_asset):
+            return cast(Optional[HistoricalBar], await self._run_in_executor(self._get_fiat_exchange_rate, timestamp, hop_data.from_asset, hop_data.to_asset))
+        return await self.find_historical_bar_async(hop_data.from_asset, hop_data.to_asset, timestamp, hop_data.exchange)
+
+    async def find_historical_bar_async(self, from_asset: str, to_asset: str, timestamp: datetime, exchange: str) -> Optional[HistoricalBar]:
+        key: AssetPairAndTimestamp = AssetPairAndTimestamp(timestamp, from_asset, to_asset, exchange)
+        # CSV readers may download files
+        historical_bar: Optional[HistoricalBar] = cast(Optional[HistoricalBar], await self._run_in_executor(self._find_local_historical_bar, key))
+        if historical_bar is not None:
+            return historical_bar
+
+        # Bars are cached by minute: tasks looking up the same minute wait for the first search instead of repeating its requests
+        return await self.__bar_flights.do(self._floor_key(key), lambda: self._fetch_historical_bar_async(key))
+
+    async def _fetch_historical_bar_async(self, key: AssetPairAndTimestamp) -> Optional[HistoricalBar]:
+        # A search that finished while this one was waiting to start may have cached the bar
+        historical_bar: Optional[HistoricalBar] = self._get_bar_from_cache(key)
+        if historical_bar is not None:
+            return historical_bar
+
+        search: OhlcvSearch = self._search_historical_bar(key)
+        try:
+            request: OhlcvRequest = next(search)
+            while True:
+                request = search.send(await self._fetch_ohlcv_async(key.exchange, f"{key.from_asset}/{key.to_asset}", *request))
+        except StopIteration as stop:
+            return cast(Optional[HistoricalBar], stop.value)
+
+    # Same retry policy as the blocking converter, but waits don't block the other lookups: returns None if the exchange kept refusing
+    # the request, and raises if it stayed unavailable
+    async def _fetch_ohlcv_async(self, exchange: str, symbol: str, timeframe: str, ms_timestamp: int, limit: int) -> Optional[List[List[Union[int, float]]]]:
+        async_exchange: Any = self._get_async_exchange(exchange)
+        request_count: int = 0
+
+        while True:
+            try:
+                # The token bucket is shared with the blocking converter: only the wait is asynchronous
+                second_delay: float = self._get_token_bucket(exchange).reserve()
+                if second_delay > 0:
+                    LOGGER.debug("Delayed %s for %s seconds", exchange, second_delay)
+                    await asyncio.sleep(second_delay)
+
+                return cast(List[List[Union[int, float]]], await async_exchange.fetch_ohlcv(symbol, timeframe, ms_timestamp, limit))
+            except BadRequest as exc:
+                self._add_rejected_request_miss(exchange, symbol, ms_timestamp, exc)
+                return []
+            except DDoSProtection as exc:
+                request_count += 3
+                if request_count >= 9:
+                    LOGGER.debug("Exception from server, most likely too many requests. Giving up on %s %s. Exception - %s", exchange, symbol, exc)
+                    return None
+                LOGGER.debug("Exception from server, most likely too many requests. Making another attempt after 0.1 second delay. Exception - %s", exc)
+                await asyncio.sleep(0.1)
+            except (ExchangeNotAvailable, NetworkError, RequestTimeout) as exc_na:
+                request_count += 1
+                if request_count > 9:
+                    LOGGER.info("Maximum number of retries reached. Saving to cache and exiting.")
+                    self.save_historical_price_cache()
+                    raise RP2RuntimeError("Server error") from exc_na
+
+                LOGGER.debug("Server not available. Making attempt #%s of 10 after a ten second delay. Exception - %s", request_count, exc_na)
+                await asyncio.sleep(10)
+
+    def _get_async_exchange(self, exchange: str) -> Any:
+        async_exchanges: Optional[Dict[str, Any]] = _BATCH_ASYNC_EXCHANGES.get(None)
+        if async_exchanges is None:
+            raise RP2RuntimeError("Internal error: async exchanges are only available within get_conversion_rates()")
+        async_exchange: Any = async_exchanges.get(exchange)
+        if async_exchange is None:
+            # async_support has the same classes as ccxt, named after the exchange id. Requests are throttled by the token bucket shared
+            # with the blocking clients, so the client's own rate limiter is disabled.
+            async_exchange = getattr(async_support, self.exchanges[exchange].id)({"enableRateLimit": False})
+            async_exchanges[exchange] = async_exchange
+        return async_exchange
+
+    @staticmethod
+    async def _run_in_executor(function: Any, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
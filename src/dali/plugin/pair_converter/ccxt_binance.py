@@ -24,6 +24,11 @@ class PairConverterPlugin(CcxtPairConverterPlugin):
         self,
         historical_price_type: str,
         fiat_priority: Optional[str] = None,
+        use_ohlcv_pages: Optional[bool] = None,
+        thread_count: Optional[int] = None,
+        market_snapshot_ttl: Optional[int] = None,
+        refresh_markets: Optional[bool] = None,
+        negative_cache_ttl: Optional[int] = None,
     ) -> None:
 
         super().__init__(
@@ -31,4 +36,9 @@ class PairConverterPlugin(CcxtPairConverterPlugin):
             default_exchange="Binance.com",
             fiat_priority=fiat_priority,
             exchange_locked=True,
+            use_ohlcv_pages=use_ohlcv_pages,
+            thread_count=thread_count,
+            market_snapshot_ttl=market_snapshot_ttl,
+            refresh_markets=refresh_markets,
+            negative_cache_ttl=negative_cache_ttl,
         )
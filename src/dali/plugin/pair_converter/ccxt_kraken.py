@@ -25,6 +25,13 @@ class PairConverterPlugin(CcxtPairConverterPlugin):
         historical_price_type: str,
         fiat_priority: Optional[str] = None,
         google_api_key: Optional[str] = None,
+        use_ohlcv_pages: Optional[bool] = None,
+        thread_count: Optional[int] = None,
+        csv_process_count: Optional[int] = None,
+        csv_chunk_cache_size: Optional[int] = None,
+        market_snapshot_ttl: Optional[int] = None,
+        refresh_markets: Optional[bool] = None,
+        negative_cache_ttl: Optional[int] = None,
     ) -> None:
 
         super().__init__(
@@ -33,4 +40,11 @@ class PairConverterPlugin(CcxtPairConverterPlugin):
             fiat_priority=fiat_priority,
             google_api_key=google_api_key,
             exchange_locked=True,
+            use_ohlcv_pages=use_ohlcv_pages,
+            thread_count=thread_count,
+            csv_process_count=csv_process_count,
+            csv_chunk_cache_size=csv_chunk_cache_size,
+            market_snapshot_ttl=market_snapshot_ttl,
+            refresh_markets=refresh_markets,
+            negative_cache_ttl=negative_cache_ttl,
         )
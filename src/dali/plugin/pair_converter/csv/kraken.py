@@ -15,16 +15,32 @@
 # Kraken CSV format: (epoch) timestamp, open, high, low, close, volume, trades
 
 import logging
-from csv import reader, writer
+from collections import OrderedDict
+from csv import reader
 from datetime import datetime, timedelta, timezone
 from gzip import open as gopen
-from io import BytesIO
+from io import TextIOWrapper
 from json import JSONDecodeError
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
-from os import makedirs, path
-from typing import Any, Dict, Generator, List, NamedTuple, Optional, Tuple, cast
+from os import close, makedirs, path, remove
+from tempfile import mkstemp
+from threading import Lock
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    cast,
+)
 from zipfile import ZipFile
 
+import numpy as np
 import requests
 from requests.models import Response
 from requests.sessions import Session
@@ -32,8 +48,9 @@ from rp2.logger import create_logger
 from rp2.rp2_decimal import RP2Decimal
 from rp2.rp2_error import RP2RuntimeError
 
-from dali.cache import load_from_cache, save_to_cache
+from dali.cache import get_schema, load_from_cache, save_to_cache
 from dali.historical_bar import HistoricalBar
+from dali.single_flight import SingleFlight
 
 # Google Drive parameters
 _ACCESS_NOT_CONFIGURED: str = "accessNotConfigured"
@@ -52,6 +69,7 @@ _ID: str = "id"
 # Files in this folder will be updated every quarter and thus will have new file IDs.
 # However, the file ID for the folder or parent should remain the same.
 _KRAKEN_FOLDER_ID: str = "1aoA6SKgPbS_p3pYStXUXFvmjqShJ2jv9"
+_KRAKEN_ASSET_PAIRS_URL: str = "https://api.kraken.com/0/public/AssetPairs"
 _MESSAGE: str = "message"
 _REASON: str = "reason"
 
@@ -83,10 +101,39 @@ _PAIR_MIDDLE: str = "middle"
 _PAIR_END: str = "end"
 _MAX_MULTIPLIER: int = 500
 
+# Size of the blocks the zip file is downloaded in
+_DOWNLOAD_BLOCK_SIZE: int = 1024 * 1024
+
+# Chunk file formats: chunks are stored as NumPy arrays, which can be memory-mapped and binary-searched by timestamp.
+# Gzipped CSV chunks were used by earlier versions and are converted when they are first read.
+_CHUNK_EXTENSION: str = "npy"
+_LEGACY_CHUNK_EXTENSION: str = "csv.gz"
+
+# Prices are stored as strings to preserve their exact decimal value
+_TIMESTAMP: str = "timestamp"
+_OHLCV_FIELDS: List[str] = ["open", "high", "low", "close", "volume"]
+
 
 class _PairStartEnd(NamedTuple):
     end: int
     start: int
+    # None if the assets of the pair are unknown: pair names are the base and quote asset concatenated (e.g. USDTUSD)
+    base_asset: Optional[str] = None
+    quote_asset: Optional[str] = None
+
+
+_CACHED_PAIRS_SCHEMA: str = get_schema(_PairStartEnd)
+
+
+class _ChunkKey(NamedTuple):
+    pair: str
+    granularity: str
+    start: int
+
+
+class _DecodedChunk(NamedTuple):
+    rows: np.ndarray
+    timestamps: np.ndarray  # Timestamp column of rows (sorted): a view of the memory-mapped file, not a copy
 
 
 class Kraken:
@@ -99,6 +146,9 @@ class Kraken:
     __TIMEOUT: int = 30
     __THREAD_COUNT: int = 3
 
+    # Number of decoded chunks kept in memory: a 1-minute chunk covers 30 days
+    __DEFAULT_CHUNK_CACHE_SIZE: int = 32
+
     __TIMESTAMP_INDEX: int = 0
     __OPEN: int = 1
     __HIGH: int = 2
@@ -112,28 +162,57 @@ class Kraken:
     def __init__(
         self,
         google_api_key: str,
+        chunk_cache_size: Optional[int] = None,
+        process_count: Optional[int] = None,
+        cache_directory: Optional[str] = None,
     ) -> None:
 
         self.__google_api_key: str = google_api_key
+        # Splitting is CPU-bound: if process_count is set, zip members are split on a process pool instead of a thread pool
+        self.__process_count: Optional[int] = process_count
+        if cache_directory is not None:
+            self.__CACHE_DIRECTORY = cache_directory  # pylint: disable=invalid-name
         self.__logger: logging.Logger = create_logger(self.__KRAKEN_OHLCVT)
         self.__session: Session = requests.Session()
         self.__cached_pairs: Dict[str, _PairStartEnd] = {}
         self.__cache_loaded: bool = False
 
+        # LRU of decoded chunks, most recently used last
+        self.__chunk_cache: "OrderedDict[_ChunkKey, _DecodedChunk]" = OrderedDict()
+        self.__chunk_cache_size: int = chunk_cache_size if chunk_cache_size else self.__DEFAULT_CHUNK_CACHE_SIZE
+        self.__chunk_cache_lock: Lock = Lock()
+        self.__chunk_cache_hits: int = 0
+        self.__chunk_cache_misses: int = 0
+        # Threads missing the same chunk share one decode
+        self.__chunk_flights: SingleFlight[_ChunkKey, Optional[_DecodedChunk]] = SingleFlight()
+
         if not path.exists(self.__CACHE_DIRECTORY):
             makedirs(self.__CACHE_DIRECTORY)
 
     def cache_key(self) -> str:
         return self.__CACHE_KEY
 
+    @property
+    def chunk_cache_hits(self) -> int:
+        return self.__chunk_cache_hits
+
+    @property
+    def chunk_cache_misses(self) -> int:
+        return self.__chunk_cache_misses
+
+    def close(self) -> None:
+        self.__logger.debug("Chunk cache: %d hits, %d misses", self.__chunk_cache_hits, self.__chunk_cache_misses)
+        self.__session.close()
+
     def __load_cache(self) -> None:
-        result = cast(Dict[str, _PairStartEnd], load_from_cache(self.cache_key()))
+        result = cast(Dict[str, _PairStartEnd], load_from_cache(self.cache_key(), schema=_CACHED_PAIRS_SCHEMA))
         self.__cached_pairs = result if result is not None else {}
 
-    def __split_process(self, csv_file: str, chunk_size: int = _CHUNK_SIZE) -> Generator[Tuple[str, List[List[str]]], None, None]:
+    # Only one chunk at a time is kept in memory: csv_lines can be a stream
+    def __split_process(self, csv_lines: Iterable[str], chunk_size: int = _CHUNK_SIZE) -> Generator[Tuple[str, List[List[str]]], None, None]:
         chunk: List[List[str]] = []
 
-        lines = reader(csv_file.splitlines())
+        lines = reader(csv_lines)
         position = _PAIR_START
         next_timestamp: Optional[int] = None
 
@@ -152,7 +231,7 @@ class Kraken:
             position = _PAIR_END
             yield position, chunk
 
-    def _split_chunks_size_n(self, file_name: str, csv_file: str, chunk_size: int = _CHUNK_SIZE) -> None:
+    def _split_chunks_size_n(self, file_name: str, csv_lines: Iterable[str], chunk_size: int = _CHUNK_SIZE) -> None:
 
         pair, duration_in_minutes = file_name.strip(".csv").split("_", 1)
         chunk_size *= min(int(duration_in_minutes), _MAX_MULTIPLIER)
@@ -161,7 +240,7 @@ class Kraken:
         pair_end: int
         pair_duration: str = pair + duration_in_minutes
 
-        for position, chunk in self.__split_process(csv_file, chunk_size):
+        for position, chunk in self.__split_process(csv_lines, chunk_size):
             file_timestamp = str((int(chunk[0][self.__TIMESTAMP_INDEX])) // chunk_size * chunk_size)
             if position == _PAIR_END:
                 pair_end = int(chunk[-1][self.__TIMESTAMP_INDEX])
@@ -170,17 +249,72 @@ class Kraken:
             elif position == _PAIR_START:
                 pair_start = int(chunk[0][self.__TIMESTAMP_INDEX])
 
-            chunk_filename: str = f'{pair}_{file_timestamp}_{duration_in_minutes}.{"csv.gz"}'
-            chunk_filepath: str = path.join(self.__CACHE_DIRECTORY, chunk_filename)
-
-            with gopen(chunk_filepath, "wt", encoding="utf-8", newline="") as chunk_file:
-                csv_writer = writer(chunk_file)
-                for row in chunk:
-                    csv_writer.writerow(row)
+            chunk_filename: str = f"{pair}_{file_timestamp}_{duration_in_minutes}.{_CHUNK_EXTENSION}"
+            self._save_chunk(path.join(self.__CACHE_DIRECTORY, chunk_filename), chunk)
 
         if pair_start:
             self.__cached_pairs[pair_duration] = _PairStartEnd(start=pair_start, end=pair_end)
 
+    # Fixed-width structured array sorted by timestamp: string columns are as wide as the longest value in the chunk
+    def _save_chunk(self, chunk_filepath: str, chunk: List[List[str]]) -> None:
+        columns: List[int] = [self.__OPEN, self.__HIGH, self.__LOW, self.__CLOSE, self.__VOLUME]
+        widths: List[int] = [max([1] + [len(row[column]) for row in chunk]) for column in columns]
+        dtype: np.dtype = np.dtype([(_TIMESTAMP, "<i8")] + [(field, f"S{width}") for field, width in zip(_OHLCV_FIELDS, widths)])
+        chunk_array: np.ndarray = np.array(
+            [(int(row[self.__TIMESTAMP_INDEX]),) + tuple(row[column] for column in columns) for row in chunk],
+            dtype=dtype,
+        )
+        chunk_array.sort(order=_TIMESTAMP, kind="stable")
+        with open(chunk_filepath, "wb") as chunk_file:
+            np.save(chunk_file, chunk_array, allow_pickle=False)
+
+    def _load_chunk(self, chunk_filepath: str) -> Optional[np.ndarray]:
+        if path.exists(chunk_filepath):
+            return cast(np.ndarray, np.load(chunk_filepath, mmap_mode="r", allow_pickle=False))
+
+        legacy_chunk_filepath: str = f"{chunk_filepath[: -len(_CHUNK_EXTENSION)]}{_LEGACY_CHUNK_EXTENSION}"
+        if not path.exists(legacy_chunk_filepath):
+            return None
+        self.__logger.debug("Converting legacy chunk %s", legacy_chunk_filepath)
+        with gopen(legacy_chunk_filepath, "rt") as file:
+            self._save_chunk(chunk_filepath, list(reader(file)))
+        return cast(np.ndarray, np.load(chunk_filepath, mmap_mode="r", allow_pickle=False))
+
+    def _get_decoded_chunk(self, chunk_key: _ChunkKey) -> Optional[_DecodedChunk]:
+        decoded_chunk: Optional[_DecodedChunk] = self.__get_cached_chunk(chunk_key)
+        if decoded_chunk is not None:
+            return decoded_chunk
+        return self.__chunk_flights.do(chunk_key, lambda: self.__load_decoded_chunk(chunk_key))
+
+    def __get_cached_chunk(self, chunk_key: _ChunkKey) -> Optional[_DecodedChunk]:
+        with self.__chunk_cache_lock:
+            decoded_chunk: Optional[_DecodedChunk] = self.__chunk_cache.get(chunk_key)
+            if decoded_chunk is not None:
+                self.__chunk_cache.move_to_end(chunk_key)
+                self.__chunk_cache_hits += 1
+            return decoded_chunk
+
+    def __load_decoded_chunk(self, chunk_key: _ChunkKey) -> Optional[_DecodedChunk]:
+        # A decode that just ended may have cached the chunk after this thread looked it up
+        decoded_chunk: Optional[_DecodedChunk] = self.__get_cached_chunk(chunk_key)
+        if decoded_chunk is not None:
+            return decoded_chunk
+        with self.__chunk_cache_lock:
+            self.__chunk_cache_misses += 1
+
+        file_name: str = f"{chunk_key.pair}_{chunk_key.start}_{chunk_key.granularity}.{_CHUNK_EXTENSION}"
+        rows: Optional[np.ndarray] = self._load_chunk(path.join(self.__CACHE_DIRECTORY, file_name))
+        if rows is None:
+            return None
+        decoded_chunk = _DecodedChunk(rows=rows, timestamps=rows[_TIMESTAMP])
+
+        with self.__chunk_cache_lock:
+            self.__chunk_cache[chunk_key] = decoded_chunk
+            self.__chunk_cache.move_to_end(chunk_key)
+            while len(self.__chunk_cache) > self.__chunk_cache_size:
+                self.__chunk_cache.popitem(last=False)
+        return decoded_chunk
+
     def _retrieve_cached_bar(self, base_asset: str, quote_asset: str, timestamp: int) -> Optional[HistoricalBar]:
         pair_name: str = base_asset + quote_asset
 
@@ -209,22 +343,22 @@ class Kraken:
                 int(_TIME_GRANULARITY[retry_count]) * _SECONDS_IN_MINUTE
             )
 
-            file_name: str = f"{base_asset + quote_asset}_{file_timestamp}_{_TIME_GRANULARITY[retry_count]}.csv.gz"
-            file_path: str = path.join(self.__CACHE_DIRECTORY, file_name)
             self.__logger.debug("Retrieving %s -> %s at %s from %s stamped file.", base_asset, quote_asset, duration_timestamp, file_timestamp)
-            with gopen(file_path, "rt") as file:
-                rows = reader(file)
-                for row in rows:
-                    if int(row[self.__TIMESTAMP_INDEX]) == duration_timestamp:
-                        return HistoricalBar(
-                            duration=timedelta(minutes=int(_TIME_GRANULARITY[retry_count])),
-                            timestamp=datetime.fromtimestamp(int(row[self.__TIMESTAMP_INDEX]), timezone.utc),
-                            open=RP2Decimal(row[self.__OPEN]),
-                            high=RP2Decimal(row[self.__HIGH]),
-                            low=RP2Decimal(row[self.__LOW]),
-                            close=RP2Decimal(row[self.__CLOSE]),
-                            volume=RP2Decimal(row[self.__VOLUME]),
-                        )
+            decoded_chunk: Optional[_DecodedChunk] = self._get_decoded_chunk(_ChunkKey(pair_name, _TIME_GRANULARITY[retry_count], file_timestamp))
+            if decoded_chunk is not None:
+                # Binary search: only the pages of the file holding the visited timestamps are read
+                index: int = int(np.searchsorted(decoded_chunk.timestamps, duration_timestamp))
+                if index < len(decoded_chunk.timestamps) and int(decoded_chunk.timestamps[index]) == duration_timestamp:
+                    row: Any = decoded_chunk.rows[index]
+                    return HistoricalBar(
+                        duration=timedelta(minutes=int(_TIME_GRANULARITY[retry_count])),
+                        timestamp=datetime.fromtimestamp(int(row[_TIMESTAMP]), timezone.utc),
+                        open=RP2Decimal(row["open"].decode("ascii")),
+                        high=RP2Decimal(row["high"].decode("ascii")),
+                        low=RP2Decimal(row["low"].decode("ascii")),
+                        close=RP2Decimal(row["close"].decode("ascii")),
+                        volume=RP2Decimal(row["volume"].decode("ascii")),
+                    )
 
             retry_count += 1
 
@@ -246,31 +380,117 @@ class Kraken:
         base_file: str = f"{base_asset}_OHLCVT.zip"
 
         self.__logger.info("Attempting to load %s from Kraken Google Drive.", base_file)
-        file_bytes = self._google_file_to_bytes(base_file)
 
-        if file_bytes:
-            with ZipFile(BytesIO(file_bytes)) as zipped_ohlcvt:
-                self.__logger.debug("Files found in zipped file - %s", zipped_ohlcvt.namelist())
-                all_timespans_for_pair: List[str] = [x for x in zipped_ohlcvt.namelist() if x.startswith(f"{base_asset}{quote_asset}_")]
-                if len(all_timespans_for_pair) == 0:
-                    self.__logger.debug("Market not found in Kraken files. Skipping file read.")
+        # The zip file is downloaded to disk and its members are split as streams: memory usage doesn't depend on the length of the history
+        zip_file_descriptor, zip_file_path = mkstemp(suffix=".zip")
+        close(zip_file_descriptor)
+        try:
+            with open(zip_file_path, "wb") as zip_file:
+                if not self._google_file_to_file(base_file, zip_file):
                     return None
 
-                csv_files: Dict[str, str] = {}
-                for file_name in all_timespans_for_pair:
-                    self.__logger.debug("Reading in file %s for Kraken CSV pricing.", file_name)
-                    csv_files[file_name] = zipped_ohlcvt.read(file_name).decode(encoding="utf-8")
-
-                with ThreadPool(self.__THREAD_COUNT) as pool:
-                    pool.starmap(self._split_chunks_size_n, zip(list(csv_files.keys()), list(csv_files.values())))
+            with ZipFile(zip_file_path) as zipped_ohlcvt:
+                self.__logger.debug("Files found in zipped file - %s", zipped_ohlcvt.namelist())
+                all_timespans_for_pair: List[str] = [x for x in zipped_ohlcvt.namelist() if x.startswith(f"{base_asset}{quote_asset}_")]
+            if len(all_timespans_for_pair) == 0:
+                self.__logger.debug("Market not found in Kraken files. Skipping file read.")
+                return None
 
-            save_to_cache(self.cache_key(), self.__cached_pairs)
-            return self._retrieve_cached_bar(base_asset, quote_asset, epoch_timestamp)
+            self._split_archive_members(zip_file_path, all_timespans_for_pair)
+        finally:
+            remove(zip_file_path)
+
+        for file_name in all_timespans_for_pair:
+            self.__set_pair_assets(file_name, base_asset, quote_asset)
+
+        save_to_cache(self.cache_key(), self.__cached_pairs, schema=_CACHED_PAIRS_SCHEMA, plugin=self.__KRAKEN_OHLCVT)
+        return self._retrieve_cached_bar(base_asset, quote_asset, epoch_timestamp)
+
+    # Splits all the markets in a local OHLCVT zip file into chunks and returns their time ranges (it doesn't save them to the cache)
+    def ingest_archive(self, archive_path: str) -> Dict[str, _PairStartEnd]:
+        self.__cached_pairs = {}
+        with ZipFile(archive_path) as zipped_ohlcvt:
+            file_names: List[str] = [file_name for file_name in zipped_ohlcvt.namelist() if file_name.endswith(".csv")]
+        self._split_archive_members(archive_path, file_names)
+        pair_2_assets: Dict[str, Tuple[str, str]] = self._get_pair_assets()
+        for file_name in file_names:
+            base_and_quote_asset: Optional[Tuple[str, str]] = pair_2_assets.get(file_name.strip(".csv").split("_", 1)[0])
+            if base_and_quote_asset is not None:
+                self.__set_pair_assets(file_name, *base_and_quote_asset)
+        return dict(self.__cached_pairs)
+
+    # Records the assets of the pair of a split zip member (<pair>_<duration in minutes>.csv)
+    def __set_pair_assets(self, file_name: str, base_asset: str, quote_asset: str) -> None:
+        pair, duration_in_minutes = file_name.strip(".csv").split("_", 1)
+        pair_start_end: Optional[_PairStartEnd] = self.__cached_pairs.get(pair + duration_in_minutes)
+        if pair_start_end is not None:
+            self.__cached_pairs[pair + duration_in_minutes] = pair_start_end._replace(base_asset=base_asset, quote_asset=quote_asset)
 
-        return None
+    # isolated in order to be mocked
+    # Base and quote asset of the Kraken markets by pair name (e.g. USDTUSD: USDT and USD), from their websocket names (e.g.
+    # USDT/USD). Pairs delisted since the archive was made are missing: their assets stay unknown.
+    def _get_pair_assets(self) -> Dict[str, Tuple[str, str]]:
+        try:
+            response: Response = self.__session.get(_KRAKEN_ASSET_PAIRS_URL, timeout=self.__TIMEOUT)
+            response.raise_for_status()
+            asset_pairs: Dict[str, Dict[str, str]] = response.json()["result"]
+        except (requests.exceptions.RequestException, JSONDecodeError, KeyError) as exc:
+            self.__logger.warning("Cannot read the Kraken markets, the assets of the ingested pairs are unknown: %s", exc)
+            return {}
+        result: Dict[str, Tuple[str, str]] = {}
+        for asset_pair in asset_pairs.values():
+            if "/" in asset_pair.get("wsname", ""):
+                base_asset, quote_asset = asset_pair["wsname"].split("/", 1)
+                result[asset_pair["altname"]] = (base_asset, quote_asset)
+        return result
+
+    # Splits one member of a zip file and returns its time range: used by process pool workers
+    def split_archive_member(self, archive_path: str, file_name: str) -> Dict[str, _PairStartEnd]:
+        self.__cached_pairs = {}
+        with ZipFile(archive_path) as zipped_ohlcvt:
+            self._split_zipped_file(zipped_ohlcvt, file_name)
+        return dict(self.__cached_pairs)
+
+    def _split_archive_members(self, archive_path: str, file_names: List[str]) -> None:
+        if not file_names:
+            return
+        if self.__process_count:
+            with Pool(min(self.__process_count, len(file_names))) as process_pool:
+                results: List[Dict[str, _PairStartEnd]] = process_pool.starmap(
+                    _split_archive_member, [(archive_path, file_name, self.__CACHE_DIRECTORY) for file_name in file_names]
+                )
+            for cached_pairs in results:
+                self.__cached_pairs.update(cached_pairs)
+            return
+
+        with ZipFile(archive_path) as zipped_ohlcvt:
+            with ThreadPool(self.__THREAD_COUNT) as pool:
+                pool.starmap(self._split_zipped_file, [(zipped_ohlcvt, file_name) for file_name in file_names])
+
+    # Merges time ranges returned by ingest_archive() into the cache
+    def save_cached_pairs(self, cached_pairs: Dict[str, _PairStartEnd]) -> None:
+        self.__load_cache()
+        self.__cached_pairs.update(cached_pairs)
+        save_to_cache(self.cache_key(), self.__cached_pairs, schema=_CACHED_PAIRS_SCHEMA, plugin=self.__KRAKEN_OHLCVT)
+
+    # Used by dali_cache: the pairs of deleted chunks are forgotten, so that they are downloaded again when needed
+    def delete_chunks(self, chunk_file_names: Iterable[str]) -> None:
+        self.__load_cache()
+        for chunk_file_name in chunk_file_names:
+            # Chunk file names are <pair>_<start timestamp>_<duration in minutes>.<extension>
+            pair, _, duration_in_minutes = chunk_file_name.split(".", 1)[0].rsplit("_", 2)
+            self.__cached_pairs.pop(pair + duration_in_minutes, None)
+            remove(path.join(self.__CACHE_DIRECTORY, chunk_file_name))
+        save_to_cache(self.cache_key(), self.__cached_pairs, schema=_CACHED_PAIRS_SCHEMA, plugin=self.__KRAKEN_OHLCVT)
+
+    def _split_zipped_file(self, zipped_ohlcvt: ZipFile, file_name: str) -> None:
+        self.__logger.debug("Reading in file %s for Kraken CSV pricing.", file_name)
+        with zipped_ohlcvt.open(file_name) as zipped_file:
+            self._split_chunks_size_n(file_name, TextIOWrapper(zipped_file, encoding="utf-8", newline=""))
 
     # isolated in order to be mocked
-    def _google_file_to_bytes(self, file_name: str) -> Optional[bytes]:
+    # Writes the file to output_file in blocks and returns False if the file is not found
+    def _google_file_to_file(self, file_name: str, output_file: IO[bytes]) -> bool:
         params: Dict[str, Any] = {
             _QUERY: f"'{_KRAKEN_FOLDER_ID}' in parents and name = '{file_name}'",
             _API_KEY: self.__google_api_key,
@@ -356,17 +576,24 @@ class Kraken:
                         raise RP2RuntimeError("Google Drive key invalid")
             if not data.get(_FILES):
                 self.__logger.debug("The file '%s' was not found on the Kraken Google Drive.")
-                return None
+                return False
 
             self.__logger.debug("Retrieved %s from %s", data, response.url)
 
             # Downloading the zipfile that contains the 6 files one for each of the standard durations of candles:
             # 1m, 5m, 15m, 1h, 12h, 24h.
             params = {_ALT: _MEDIA, _API_KEY: self.__google_api_key, _CONFIRM: 1}  # _CONFIRM: 1 bypasses large file warning
-            file_response: Response = self.__session.get(f"{_GOOGLE_APIS_URL}/{data[_FILES][0][_ID]}", params=params, timeout=self.__TIMEOUT)
+            with self.__session.get(f"{_GOOGLE_APIS_URL}/{data[_FILES][0][_ID]}", params=params, timeout=self.__TIMEOUT, stream=True) as file_response:
+                for block in file_response.iter_content(chunk_size=_DOWNLOAD_BLOCK_SIZE):
+                    output_file.write(block)
 
         except JSONDecodeError as exc:
             self.__logger.debug("Fetching of kraken csv files failed. Try again later.")
             raise RP2RuntimeError("JSON decode error") from exc
 
-        return file_response.content
+        return True
+
+
+# Module-level so that it can be pickled and run on a process pool
+def _split_archive_member(archive_path: str, file_name: str, cache_directory: str) -> Dict[str, _PairStartEnd]:
+    return Kraken("", cache_directory=cache_directory).split_archive_member(archive_path, file_name)
@@ -0,0 +1,150 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from csv import reader
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from rp2.rp2_decimal import ZERO, RP2Decimal
+from rp2.rp2_error import RP2TypeError, RP2ValueError
+
+from dali.abstract_pair_converter_plugin import (
+    AbstractPairConverterPlugin,
+    AssetPairAndExchange,
+)
+from dali.historical_bar import HistoricalBar
+from dali.logger import LOGGER
+
+_DATE: str = "Date"
+_DATE_FORMAT: str = "%Y-%m-%d"
+_MISSING_RATES: Set[str] = {"", "N/A", "n/a"}
+_DAYS_IN_SECONDS: int = 86400
+
+
+# Reads fiat exchange rates from a local CSV file with one row per day and one column per currency, in the format of the
+# European Central Bank's euro foreign exchange reference rates (https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip):
+#
+# Date,USD,JPY,BGN,...
+# 2023-01-03,1.0545,138.02,1.9558,...
+#
+# Each rate is the amount of that currency bought by one unit of the base currency (EUR for ECB files). Days with no published
+# rates (weekends, holidays) use the rates of the last published day. Crypto pairs are left to the next pair converters.
+class PairConverterPlugin(AbstractPairConverterPlugin):
+    def __init__(
+        self,
+        historical_price_type: str,
+        rate_file: str,
+        base_currency: str = "EUR",
+        fiat_priority: Optional[str] = None,
+    ) -> None:
+        if not isinstance(rate_file, str):
+            raise RP2TypeError(f"rate_file is not a string: {rate_file}")
+        if not isinstance(base_currency, str):
+            raise RP2TypeError(f"base_currency is not a string: {base_currency}")
+        self.__rate_file: str = rate_file
+        self.__base_currency: str = base_currency
+        super().__init__(historical_price_type=historical_price_type, fiat_priority=fiat_priority)
+
+        # Rates are stored as a (published day, currency) float matrix, with NaN for missing rates. Day ordinals are mapped to
+        # rows with an index array covering every day between the first and the last published day, so lookups are O(1).
+        self.__currency_2_column: Dict[str, int]
+        self.__rates: np.ndarray
+        self.__first_ordinal: int
+        self.__day_2_row: np.ndarray
+        self.__currency_2_column, self.__rates, self.__first_ordinal, self.__day_2_row = self._load_rate_file()
+        self._set_fiat_list(list(self.__currency_2_column))
+        LOGGER.debug(
+            "Loaded %d days of %s fiat rates for %d currencies from %s",
+            len(self.__rates),
+            base_currency,
+            len(self.__currency_2_column),
+            rate_file,
+        )
+
+    def name(self) -> str:
+        return "ECB-CSV"
+
+    def cache_key(self) -> str:
+        return f"{self.name()}-{self.__base_currency}"
+
+    def _load_rate_file(self) -> Tuple[Dict[str, int], np.ndarray, int, np.ndarray]:
+        with open(self.__rate_file, encoding="utf-8") as rate_file:
+            lines = reader(rate_file)
+            header: List[str] = [field.strip() for field in next(lines)]
+            if not header or header[0] != _DATE:
+                raise RP2ValueError(f"{self.__rate_file}: the first column must be '{_DATE}', instead it was: {header[:1]}")
+            # ECB files end each line with a comma, which produces an empty column
+            columns: List[int] = [index for index, currency in enumerate(header) if index > 0 and currency]
+            currency_2_column: Dict[str, int] = {header[index]: column for column, index in enumerate(columns)}
+            if self.__base_currency in currency_2_column:
+                raise RP2ValueError(f"{self.__rate_file}: base currency {self.__base_currency} is also a rate column")
+            currency_2_column[self.__base_currency] = len(columns)
+
+            ordinal_2_rates: Dict[int, List[float]] = {}
+            for line in lines:
+                if not line or not line[0].strip():
+                    continue
+                ordinal: int = datetime.strptime(line[0].strip(), _DATE_FORMAT).date().toordinal()
+                rates: List[float] = [float("nan") if index >= len(line) or line[index].strip() in _MISSING_RATES else float(line[index]) for index in columns]
+                ordinal_2_rates[ordinal] = rates + [1.0]
+
+        if not ordinal_2_rates:
+            raise RP2ValueError(f"{self.__rate_file}: no rates found")
+        ordinals: np.ndarray = np.array(sorted(ordinal_2_rates), dtype=np.int32)
+        rate_matrix: np.ndarray = np.array([ordinal_2_rates[int(ordinal)] for ordinal in ordinals], dtype=np.float64)
+        first_ordinal: int = int(ordinals[0])
+        # Days without a published row point to the last published day before them
+        day_2_row: np.ndarray = np.searchsorted(ordinals, np.arange(first_ordinal, int(ordinals[-1]) + 1), side="right").astype(np.int32) - 1
+        return currency_2_column, rate_matrix, first_ordinal, day_2_row
+
+    def _get_rate(self, rate_date: date, from_asset: str, to_asset: str) -> Optional[RP2Decimal]:
+        from_column: Optional[int] = self.__currency_2_column.get(from_asset)
+        to_column: Optional[int] = self.__currency_2_column.get(to_asset)
+        day: int = rate_date.toordinal() - self.__first_ordinal
+        if from_column is None or to_column is None or not 0 <= day < len(self.__day_2_row):
+            return None
+        row: int = int(self.__day_2_row[day])
+        from_rate: float = float(self.__rates[row, from_column])
+        to_rate: float = float(self.__rates[row, to_column])
+        # NaN rates fail both comparisons
+        if not (from_rate > 0 and to_rate > 0):
+            return None
+        # repr() of a float parsed from a short decimal string returns the same string, so no precision is lost
+        return RP2Decimal(repr(to_rate)) / RP2Decimal(repr(from_rate))
+
+    def get_historic_bar_from_native_source(self, timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[HistoricalBar]:
+        rate: Optional[RP2Decimal] = self._get_rate(timestamp.date(), from_asset, to_asset)
+        if rate is None:
+            return None
+        return HistoricalBar(
+            duration=timedelta(seconds=_DAYS_IN_SECONDS),
+            timestamp=timestamp,
+            open=rate,
+            high=rate,
+            low=rate,
+            close=rate,
+            volume=ZERO,
+        )
+
+    # All rates are in memory: only the pairs and days the file doesn't cover are left to the next pair converter
+    def prefetch_historical_bars(self, pair_2_timestamps: Dict[AssetPairAndExchange, List[datetime]]) -> Dict[AssetPairAndExchange, List[datetime]]:
+        result: Dict[AssetPairAndExchange, List[datetime]] = {}
+        for pair, timestamps in pair_2_timestamps.items():
+            missing_timestamps: List[datetime] = [
+                timestamp for timestamp in timestamps if self._get_rate(timestamp.date(), pair.from_asset, pair.to_asset) is None
+            ]
+            if missing_timestamps:
+                result[pair] = missing_timestamps
+        return result
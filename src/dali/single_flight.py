@@ -0,0 +1,98 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from threading import Event, Lock
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, TypeVar, cast
+
+_K = TypeVar("_K", bound=Hashable)
+_V = TypeVar("_V")
+
+
+class _Call(Generic[_V]):
+    def __init__(self) -> None:
+        self.done: Event = Event()
+        self.result: Optional[_V] = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[_K, _V]):
+    """Deduplicates concurrent calls: threads calling do() with the key of a call that is still running wait for it and share its result (or exception)."""
+
+    def __init__(self) -> None:
+        self.__lock: Lock = Lock()
+        self.__calls: Dict[_K, _Call[_V]] = {}
+
+    def do(self, key: _K, function: Callable[[], _V]) -> _V:
+        with self.__lock:
+            call: Optional[_Call[_V]] = self.__calls.get(key)
+            is_leader: bool = call is None
+            if call is None:
+                call = _Call()
+                self.__calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return cast(_V, call.result)
+
+        try:
+            call.result = function()
+        except BaseException as exc:  # pylint: disable=broad-except
+            call.error = exc
+            raise
+        finally:
+            # Calls that start after this point run the function again (e.g. to see data cached by this one)
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+        return call.result
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__calls)
+
+
+class AsyncSingleFlight(Generic[_K, _V]):
+    """Same as SingleFlight for the tasks of one event loop: tasks awaiting do() with the key of a running call share its result (or exception)."""
+
+    def __init__(self) -> None:
+        self.__calls: Dict[_K, "asyncio.Future[_V]"] = {}
+
+    async def do(self, key: _K, function: Callable[[], Awaitable[_V]]) -> _V:
+        call: Optional["asyncio.Future[_V]"] = self.__calls.get(key)
+        if call is not None:
+            # A follower that is cancelled doesn't cancel the call the others are waiting for
+            return await asyncio.shield(call)
+
+        call = asyncio.get_running_loop().create_future()
+        self.__calls[key] = call
+        try:
+            result: _V = await function()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as exc:  # pylint: disable=broad-except
+            call.set_exception(exc)
+            # The leader raises it: the call doesn't need to be awaited by a follower
+            call.exception()
+            raise
+        finally:
+            del self.__calls[key]
+        call.set_result(result)
+        return result
+
+    def __len__(self) -> int:
+        return len(self.__calls)
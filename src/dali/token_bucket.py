@@ -0,0 +1,69 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable
+
+from rp2.rp2_error import RP2ValueError
+
+
+class TokenBucket:
+    """Thread-safe token bucket: allows bursts of up to capacity requests, then one request every 1 / rate seconds."""
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float = 1.0,
+        clock: Callable[[], float] = monotonic,
+        sleeper: Callable[[float], None] = sleep,
+    ) -> None:
+        if rate <= 0:
+            raise RP2ValueError(f"Token bucket rate must be positive: {rate}")
+        if capacity < 1:
+            raise RP2ValueError(f"Token bucket capacity must be at least 1: {capacity}")
+        self.__rate: float = rate
+        self.__capacity: float = capacity
+        self.__clock: Callable[[], float] = clock
+        self.__sleeper: Callable[[float], None] = sleeper
+        self.__tokens: float = capacity
+        self.__last_refill: float = clock()
+        self.__lock: Lock = Lock()
+
+    @property
+    def rate(self) -> float:
+        return self.__rate
+
+    @property
+    def capacity(self) -> float:
+        return self.__capacity
+
+    # Takes a token and returns how many seconds the caller must wait before using it. Tokens can go negative: this
+    # queues callers in arrival order without holding the lock while they wait.
+    def reserve(self) -> float:
+        with self.__lock:
+            now: float = self.__clock()
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last_refill) * self.__rate)
+            self.__last_refill = now
+            self.__tokens -= 1
+            if self.__tokens >= 0:
+                return 0.0
+            return -self.__tokens / self.__rate
+
+    # Blocks until a token is available and returns the time spent waiting
+    def acquire(self) -> float:
+        wait: float = self.reserve()
+        if wait > 0:
+            self.__sleeper(wait)
+        return wait
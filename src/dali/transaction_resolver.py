@@ -14,12 +14,16 @@
 
 
 from datetime import datetime
-from typing import Any, Dict, List, NamedTuple, Optional, cast
+from multiprocessing.pool import ThreadPool
+from typing import Any, Dict, List, NamedTuple, Optional, Set, cast
 
 from rp2.rp2_decimal import ZERO, RP2Decimal
 from rp2.rp2_error import RP2RuntimeError, RP2TypeError, RP2ValueError
 
-from dali.abstract_pair_converter_plugin import AbstractPairConverterPlugin
+from dali.abstract_pair_converter_plugin import (
+    AbstractPairConverterPlugin,
+    AssetPairAndExchange,
+)
 from dali.abstract_transaction import AbstractTransaction, AssetAndUniqueId
 from dali.configuration import Keyword, is_unknown, is_unknown_or_none
 from dali.in_transaction import InTransaction
@@ -123,6 +127,45 @@ def _get_originating_exchange(transaction: AbstractTransaction) -> str:
     raise RP2RuntimeError(f"Internal error: not a transaction: {transaction}")
 
 
+def _is_spot_price_missing(transaction: AbstractTransaction) -> bool:
+    if transaction.spot_price is None:  # type: ignore
+        return False
+    return is_unknown(transaction.spot_price) or RP2Decimal(transaction.spot_price) == ZERO  # type: ignore
+
+
+# The exchange that _update_spot_price_from_web() will pass to pair converters once the transactions in the list are resolved
+def _get_prefetch_exchange(transaction_list: List[AbstractTransaction]) -> str:
+    for transaction in transaction_list:
+        if isinstance(transaction, OutTransaction) or (isinstance(transaction, IntraTransaction) and not is_unknown(transaction.from_exchange)):
+            return _get_originating_exchange(transaction)
+    return _get_originating_exchange(transaction_list[0])
+
+
+# Collect the (asset, native fiat, minute, exchange) keys of all the spot prices that will be read from the web, so that pair converters
+# can fill their caches with bulk requests before the per-transaction lookups start. Each pair converter receives the keys that
+# the previous ones in the list could not handle.
+def _prefetch_spot_prices(transaction_lists: List[List[AbstractTransaction]], global_configuration: Dict[str, Any]) -> None:
+    native_fiat: str = global_configuration[Keyword.NATIVE_FIAT.value]
+    pair_2_timestamps: Dict[AssetPairAndExchange, Set[datetime]] = {}
+    for transaction_list in transaction_lists:
+        if not transaction_list or len(transaction_list) > 2:
+            continue
+        if not all(_is_spot_price_missing(transaction) for transaction in transaction_list):
+            continue
+        timestamp: datetime = max(transaction.timestamp_value for transaction in transaction_list)
+        pair: AssetPairAndExchange = AssetPairAndExchange(transaction_list[0].asset, native_fiat, _get_prefetch_exchange(transaction_list))
+        pair_2_timestamps.setdefault(pair, set()).add(timestamp.replace(second=0, microsecond=0))
+
+    if not pair_2_timestamps:
+        return
+    LOGGER.info("Prefetching %d spot prices for %d asset pairs", sum(len(timestamps) for timestamps in pair_2_timestamps.values()), len(pair_2_timestamps))
+    remaining: Dict[AssetPairAndExchange, List[datetime]] = {pair: sorted(timestamps) for pair, timestamps in pair_2_timestamps.items()}
+    for pair_converter in global_configuration[Keyword.HISTORICAL_PAIR_CONVERTERS.value]:
+        if not remaining:
+            break
+        remaining = cast(AbstractPairConverterPlugin, pair_converter).prefetch_historical_bars(remaining)
+
+
 def _update_spot_price_from_web(transaction: AbstractTransaction, global_configuration: Dict[str, Any]) -> AbstractTransaction:
     init_parameters: Dict[str, Any] = transaction.constructor_parameter_dictionary
     if transaction.spot_price is None:  # type: ignore
@@ -223,11 +266,13 @@ def resolve_transactions(
     transactions: List[AbstractTransaction],
     global_configuration: Dict[str, Any],
     read_spot_price_from_web: bool,
+    thread_count: Optional[int] = None,
 ) -> List[AbstractTransaction]:
     if not isinstance(transactions, List):
         raise RP2RuntimeError(f"Internal error: parameter 'transactions' is not of type List. {transactions}")
 
-    resolved_transactions: List[AbstractTransaction] = []
+    resolved_transactions: List[AbstractTransaction]
+    unresolvable_transactions: List[AbstractTransaction] = []
     unique_id_2_transactions: Dict[AssetAndUniqueId, List[AbstractTransaction]] = {}
     transaction: AbstractTransaction
 
@@ -236,65 +281,28 @@ def resolve_transactions(
             if not isinstance(transaction, AbstractTransaction):
                 raise RP2RuntimeError(f"Internal error: Parameter 'transaction' is not a subclass of AbstractTransaction. {transaction}")
 
-            if transaction.fiat_ticker not in {None, global_configuration[Keyword.NATIVE_FIAT.value]}:
-                # Foreign exchanges may have transactions denominated in non-native fiat
-                transaction = _convert_fiat_fields_to_native_fiat(transaction, global_configuration)
-
             if is_unknown(transaction.unique_id):
                 # Cannot resolve further if unique_id is not known
-                if read_spot_price_from_web:
-                    transaction = _update_spot_price_from_web(transaction, global_configuration)
-                LOGGER.debug("Unresolvable transaction (no %s): %s", Keyword.UNIQUE_ID.value, str(transaction))
-                resolved_transactions.append(transaction)
+                unresolvable_transactions.append(transaction)
             else:
                 transaction_list: List[AbstractTransaction]
                 transaction_list = unique_id_2_transactions.setdefault(AssetAndUniqueId(transaction.asset, transaction.unique_id), [])
                 transaction_list.append(transaction)
                 unique_id_2_transactions[AssetAndUniqueId(transaction.asset, transaction.unique_id)] = transaction_list
 
-        for transaction_list in unique_id_2_transactions.values():
-            if len(transaction_list) > 2:
-                raise RP2RuntimeError(
-                    f"Internal error: Attempting to resolve more than two transactions with same {Keyword.UNIQUE_ID.value}: {transaction_list}"
-                )
-            if len(transaction_list) == 1:
-                transaction = _apply_transaction_hint(transaction_list[0], global_configuration)
-                if read_spot_price_from_web:
-                    transaction = _update_spot_price_from_web(transaction, global_configuration)
-                LOGGER.debug("Self-contained transaction: %s", str(transaction))
-                resolved_transactions.append(transaction)
-                continue
-            if len(transaction_list) == 0:
-                raise RP2RuntimeError(f"Internal error: Attempting to resolve zero transactions: {transaction_list}")
-
-            transaction1: AbstractTransaction = transaction_list[0]
-            transaction2: AbstractTransaction = transaction_list[1]
-
-            if transaction1.unique_id != transaction2.unique_id:
-                raise RP2RuntimeError(
-                    f"Internal error: transaction1.{Keyword.UNIQUE_ID.value} != transaction2.{Keyword.UNIQUE_ID.value}: {transaction1}\n{transaction2}"
-                )
-            if transaction1.asset != transaction2.asset:
-                raise RP2RuntimeError(
-                    f"Internal error: transaction1.{Keyword.ASSET.value} != transaction2.{Keyword.ASSET.value}: {transaction1}\n{transaction2}"
-                )
+        # Each list resolves to one transaction, independently of the others: unresolvable transactions are lists of one
+        transaction_lists: List[List[AbstractTransaction]] = [[transaction] for transaction in unresolvable_transactions]
+        transaction_lists.extend(unique_id_2_transactions.values())
 
-            if isinstance(transaction1, InTransaction) and isinstance(transaction2, OutTransaction):
-                transaction = _resolve_in_out_transaction(transaction1, transaction2, None)
-            elif isinstance(transaction1, OutTransaction) and isinstance(transaction2, InTransaction):
-                transaction = _resolve_out_in_transaction(transaction1, transaction2, None)
-            elif isinstance(transaction1, IntraTransaction) and isinstance(transaction2, IntraTransaction):
-                transaction = _resolve_intra_intra_transaction(transaction1, transaction2, None)
-            else:
-                raise RP2RuntimeError(
-                    f"Internal error: attempting to resolve two transactions that aren't Intra/Intra, In/Out or Out/In:\n{transaction1}\n{transaction2}"
-                )
-
-            if read_spot_price_from_web:
-                transaction = _update_spot_price_from_web(transaction, global_configuration)
+        if read_spot_price_from_web:
+            _prefetch_spot_prices(transaction_lists, global_configuration)
 
-            LOGGER.debug("Resolved transaction: %s", str(transaction))
-            resolved_transactions.append(transaction)
+        if thread_count is not None and thread_count > 1:
+            resolved_transactions = _resolve_transaction_lists_by_asset(transaction_lists, global_configuration, read_spot_price_from_web, thread_count)
+        else:
+            resolved_transactions = [
+                _resolve_transaction_list(transaction_list, global_configuration, read_spot_price_from_web) for transaction_list in transaction_lists
+            ]
 
     except KeyboardInterrupt:
         LOGGER.info("Exiting and saving to cache.")
@@ -309,6 +317,97 @@ def resolve_transactions(
     return resolved_transactions
 
 
+# Transactions of different assets never resolve against each other: the lists of each asset are resolved in order on a worker
+# thread (pair converters are thread-safe), so resolution takes about as long as the asset with the most transactions. Results
+# are put back in the order of transaction_lists, so the output doesn't depend on the thread count.
+def _resolve_transaction_lists_by_asset(
+    transaction_lists: List[List[AbstractTransaction]],
+    global_configuration: Dict[str, Any],
+    read_spot_price_from_web: bool,
+    thread_count: int,
+) -> List[AbstractTransaction]:
+    asset_2_indexes: Dict[str, List[int]] = {}
+    for index, transaction_list in enumerate(transaction_lists):
+        asset_2_indexes.setdefault(transaction_list[0].asset, []).append(index)
+    # Assets with the most transactions start first, so that none of them is left running alone at the end
+    partitions: List[List[int]] = sorted(asset_2_indexes.values(), key=len, reverse=True)
+    LOGGER.debug("Resolving %d transaction lists of %d assets on %d threads", len(transaction_lists), len(partitions), thread_count)
+
+    def resolve_partition(indexes: List[int]) -> List[AbstractTransaction]:
+        return [_resolve_transaction_list(transaction_lists[index], global_configuration, read_spot_price_from_web) for index in indexes]
+
+    result: List[Optional[AbstractTransaction]] = [None] * len(transaction_lists)
+    with ThreadPool(min(thread_count, len(partitions)) or 1) as pool:
+        for indexes, resolved_transactions in zip(partitions, pool.map(resolve_partition, partitions)):
+            for index, transaction in zip(indexes, resolved_transactions):
+                result[index] = transaction
+
+    return [transaction for transaction in result if transaction is not None]
+
+
+def _resolve_transaction_list(
+    transaction_list: List[AbstractTransaction],
+    global_configuration: Dict[str, Any],
+    read_spot_price_from_web: bool,
+) -> AbstractTransaction:
+    if len(transaction_list) > 2:
+        raise RP2RuntimeError(f"Internal error: Attempting to resolve more than two transactions with same {Keyword.UNIQUE_ID.value}: {transaction_list}")
+    if len(transaction_list) == 0:
+        raise RP2RuntimeError(f"Internal error: Attempting to resolve zero transactions: {transaction_list}")
+
+    # Foreign exchanges may have transactions denominated in non-native fiat
+    transaction_list = [
+        (
+            _convert_fiat_fields_to_native_fiat(transaction, global_configuration)
+            if transaction.fiat_ticker not in {None, global_configuration[Keyword.NATIVE_FIAT.value]}
+            else transaction
+        )
+        for transaction in transaction_list
+    ]
+    transaction: AbstractTransaction
+
+    if is_unknown(transaction_list[0].unique_id):
+        transaction = transaction_list[0]
+        if read_spot_price_from_web:
+            transaction = _update_spot_price_from_web(transaction, global_configuration)
+        LOGGER.debug("Unresolvable transaction (no %s): %s", Keyword.UNIQUE_ID.value, str(transaction))
+        return transaction
+
+    if len(transaction_list) == 1:
+        transaction = _apply_transaction_hint(transaction_list[0], global_configuration)
+        if read_spot_price_from_web:
+            transaction = _update_spot_price_from_web(transaction, global_configuration)
+        LOGGER.debug("Self-contained transaction: %s", str(transaction))
+        return transaction
+
+    transaction1: AbstractTransaction = transaction_list[0]
+    transaction2: AbstractTransaction = transaction_list[1]
+
+    if transaction1.unique_id != transaction2.unique_id:
+        raise RP2RuntimeError(
+            f"Internal error: transaction1.{Keyword.UNIQUE_ID.value} != transaction2.{Keyword.UNIQUE_ID.value}: {transaction1}\n{transaction2}"
+        )
+    if transaction1.asset != transaction2.asset:
+        raise RP2RuntimeError(f"Internal error: transaction1.{Keyword.ASSET.value} != transaction2.{Keyword.ASSET.value}: {transaction1}\n{transaction2}")
+
+    if isinstance(transaction1, InTransaction) and isinstance(transaction2, OutTransaction):
+        transaction = _resolve_in_out_transaction(transaction1, transaction2, None)
+    elif isinstance(transaction1, OutTransaction) and isinstance(transaction2, InTransaction):
+        transaction = _resolve_out_in_transaction(transaction1, transaction2, None)
+    elif isinstance(transaction1, IntraTransaction) and isinstance(transaction2, IntraTransaction):
+        transaction = _resolve_intra_intra_transaction(transaction1, transaction2, None)
+    else:
+        raise RP2RuntimeError(
+            f"Internal error: attempting to resolve two transactions that aren't Intra/Intra, In/Out or Out/In:\n{transaction1}\n{transaction2}"
+        )
+
+    if read_spot_price_from_web:
+        transaction = _update_spot_price_from_web(transaction, global_configuration)
+
+    LOGGER.debug("Resolved transaction: %s", str(transaction))
+    return transaction
+
+
 def _apply_transaction_hint(
     transaction: AbstractTransaction,
     global_configuration: Dict[str, Any],
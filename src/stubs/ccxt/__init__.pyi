@@ -19,6 +19,7 @@ class ccxt:
 
 class Exchange:
     has: Dict[str, bool]
+    id: str
     def fetch_deposits(  # type: ignore
         self, code: Optional[str] = ..., since: Optional[int] = ..., limit: Optional[int] = ..., params: Optional[Dict[str, Union[int, str, None]]] = ...
     ) -> Any: ...
@@ -14,15 +14,40 @@
 
 
 import os
+import pickle  # nosec
 import unittest
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, NamedTuple, Optional, cast
+from unittest.mock import patch
+
+from rp2.rp2_error import RP2RuntimeError, RP2ValueError
 
 from dali.abstract_transaction import AbstractTransaction
-from dali.cache import CACHE_DIR, load_from_cache, save_to_cache
+from dali.cache import (
+    CACHE_COMPRESSION_ENVIRONMENT_VARIABLE,
+    CACHE_DIR,
+    CacheManifestEntry,
+    append_to_cache,
+    get_cache_manifest,
+    get_schema,
+    load_from_cache,
+    load_records_from_cache,
+    remove_from_cache,
+    save_to_cache,
+)
 from dali.in_transaction import InTransaction
 from dali.out_transaction import OutTransaction
 
+
+class _PriceV1(NamedTuple):
+    price: int
+
+
+class _PriceV2(NamedTuple):
+    price: int
+    volume: int
+
+
 ROOT_PATH: Path = Path(os.path.dirname(__file__)).parent.absolute()
 OUTPUT_PATH: Path = ROOT_PATH / Path("output")
 
@@ -102,6 +127,141 @@ class TestCache(unittest.TestCase):
         loaded_dictionary: Dict[str, int] = load_from_cache(cache_name)
         self.assertEqual(dictionary, loaded_dictionary)
 
+    def _get_cache_path(self, cache_name: str) -> Path:
+        cache_path: Path = ROOT_PATH / CACHE_DIR / cache_name
+        try:
+            cache_path.unlink()
+        except FileNotFoundError:
+            pass
+        return cache_path
+
+    def test_damaged_cache(self) -> None:
+        cache_name: str = "test_damaged_cache"
+        cache_path: Path = self._get_cache_path(cache_name)
+        numbers: List[int] = list(range(1000))
+        save_to_cache(cache_name, numbers)
+        data: bytes = cache_path.read_bytes()
+
+        # Truncated and corrupted files are cache misses
+        cache_path.write_bytes(data[:-10])
+        truncated: Optional[List[int]] = load_from_cache(cache_name)
+        self.assertIsNone(truncated)
+        cache_path.write_bytes(data[:-1] + bytes([data[-1] ^ 0xFF]))
+        corrupted: Optional[List[int]] = load_from_cache(cache_name)
+        self.assertIsNone(corrupted)
+
+        # Payloads that can still be unpickled are checked too
+        corrupted_data: bytearray = bytearray(data)
+        corrupted_data[len(data) // 2] ^= 0x01
+        cache_path.write_bytes(bytes(corrupted_data))
+        loadable_corrupted: Optional[List[int]] = load_from_cache(cache_name)
+        self.assertIsNone(loadable_corrupted)
+
+    def test_legacy_cache(self) -> None:
+        cache_name: str = "test_legacy_cache"
+        cache_path: Path = self._get_cache_path(cache_name)
+        dictionary: Dict[str, int] = {"abc": 12}
+        cache_path.write_bytes(pickle.dumps(dictionary))
+        loaded_dictionary: Dict[str, int] = load_from_cache(cache_name)
+        self.assertEqual(loaded_dictionary, dictionary)
+
+    def test_failed_save(self) -> None:
+        cache_name: str = "test_failed_save"
+        self._get_cache_path(cache_name)
+        dictionary: Dict[str, int] = {"abc": 12}
+        save_to_cache(cache_name, dictionary)
+        unpicklable: Dict[str, Callable[[], int]] = {"abc": lambda: 12}
+
+        # The previous file is left as it was, with no temporary files around it
+        with self.assertRaises((pickle.PicklingError, AttributeError)):
+            save_to_cache(cache_name, unpicklable)
+        loaded_dictionary: Dict[str, int] = load_from_cache(cache_name)
+        self.assertEqual(loaded_dictionary, dictionary)
+        self.assertEqual(len([name for name in os.listdir(ROOT_PATH / CACHE_DIR) if name.startswith(f".{cache_name}.")]), 0)
+
+    def test_compression(self) -> None:
+        cache_name: str = "test_compression"
+        self._get_cache_path(cache_name)
+        numbers: List[int] = list(range(1000))
+        for compression in ("none", "zstd", "lz4"):
+            environment: Dict[str, str] = {CACHE_COMPRESSION_ENVIRONMENT_VARIABLE: compression}
+            with patch.dict(os.environ, environment):
+                try:
+                    save_to_cache(cache_name, numbers)
+                except RP2RuntimeError:
+                    # Compression libraries are optional
+                    continue
+            loaded_numbers: List[int] = load_from_cache(cache_name)
+            self.assertEqual(loaded_numbers, numbers)
+
+        environment = {CACHE_COMPRESSION_ENVIRONMENT_VARIABLE: "gzip"}
+        with patch.dict(os.environ, environment):
+            with self.assertRaisesRegex(RP2ValueError, "must be one of"):
+                save_to_cache(cache_name, numbers)
+
+    def test_schema_invalidation(self) -> None:
+        def _migrate(prices: Dict[str, _PriceV1]) -> Dict[str, _PriceV2]:
+            return {asset: _PriceV2(price.price, 0) for asset, price in prices.items()}
+
+        self.assertNotEqual(get_schema(_PriceV1), get_schema(_PriceV2))
+        cache_name: str = "test_schema_invalidation"
+        self._get_cache_path(cache_name)
+        prices: Dict[str, _PriceV1] = {"BTC": _PriceV1(1)}
+        save_to_cache(cache_name, prices, schema=get_schema(_PriceV1), plugin="my plugin")
+        entry: CacheManifestEntry = get_cache_manifest()[cache_name]
+        self.assertEqual(entry.plugin, "my plugin")
+        self.assertEqual(entry.schema, get_schema(_PriceV1))
+
+        # Same schema, or no schema check
+        loaded_prices: Optional[Dict[str, _PriceV1]] = load_from_cache(cache_name, schema=get_schema(_PriceV1))
+        self.assertEqual(loaded_prices, prices)
+        unchecked_prices: Optional[Dict[str, _PriceV1]] = load_from_cache(cache_name)
+        self.assertEqual(unchecked_prices, prices)
+
+        # Caches with an old schema are migrated if possible...
+        prices_v2: Optional[Dict[str, _PriceV2]] = load_from_cache(cache_name, schema=get_schema(_PriceV2), migrations={get_schema(_PriceV1): _migrate})
+        migrated_prices: Dict[str, _PriceV2] = _migrate(prices)
+        self.assertEqual(prices_v2, migrated_prices)
+        self.assertEqual(get_cache_manifest()[cache_name].schema, get_schema(_PriceV2))
+        saved_prices_v2: Optional[Dict[str, _PriceV2]] = load_from_cache(cache_name, schema=get_schema(_PriceV2))
+        self.assertEqual(saved_prices_v2, migrated_prices)
+
+        # ...and invalidated otherwise
+        invalidated_prices: Optional[Dict[str, _PriceV1]] = load_from_cache(cache_name, schema=get_schema(_PriceV1))
+        self.assertIsNone(invalidated_prices)
+        self.assertNotIn(cache_name, get_cache_manifest())
+        self.assertFalse((ROOT_PATH / CACHE_DIR / cache_name).exists())
+
+        save_to_cache(cache_name, prices)
+        remove_from_cache(cache_name)
+        self.assertNotIn(cache_name, get_cache_manifest())
+
+    def test_record_cache(self) -> None:
+        cache_name: str = "test_record_cache.records"
+        cache_path: Path = self._get_cache_path(cache_name)
+        remove_from_cache(cache_name)
+        self.assertIsNone(load_records_from_cache(cache_name))
+        for price in range(3):
+            append_to_cache(cache_name, _PriceV1(price), schema=get_schema(_PriceV1), plugin="my plugin")
+        records: Optional[List[_PriceV1]] = cast(Optional[List[_PriceV1]], load_records_from_cache(cache_name, schema=get_schema(_PriceV1)))
+        prices: List[_PriceV1] = [_PriceV1(0), _PriceV1(1), _PriceV1(2)]
+        self.assertEqual(records, prices)
+        self.assertEqual(get_cache_manifest()[cache_name].plugin, "my plugin")
+
+        # A record cut short by an interrupted append is dropped, and the records appended after it can be read
+        data: bytes = cache_path.read_bytes()
+        cache_path.write_bytes(data[:-5])
+        truncated_records: Optional[List[_PriceV1]] = cast(Optional[List[_PriceV1]], load_records_from_cache(cache_name, schema=get_schema(_PriceV1)))
+        self.assertEqual(truncated_records, prices[:2])
+        append_to_cache(cache_name, _PriceV1(3), schema=get_schema(_PriceV1))
+        appended_records: Optional[List[_PriceV1]] = cast(Optional[List[_PriceV1]], load_records_from_cache(cache_name, schema=get_schema(_PriceV1)))
+        self.assertEqual(appended_records, prices[:2] + [_PriceV1(3)])
+
+        # Records with an old schema are invalidated
+        invalidated_records: Optional[List[_PriceV2]] = cast(Optional[List[_PriceV2]], load_records_from_cache(cache_name, schema=get_schema(_PriceV2)))
+        self.assertIsNone(invalidated_records)
+        self.assertFalse(cache_path.exists())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,159 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tarfile
+import time
+import unittest
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2ValueError
+
+from dali.abstract_pair_converter_plugin import AssetPairAndTimestamp
+from dali.cache import (
+    CACHE_DIR,
+    get_cache_manifest,
+    load_from_cache,
+    remove_from_cache,
+    save_to_cache,
+)
+from dali.cache_manager import (
+    NamespaceStats,
+    _get_kraken_chunk_assets,
+    export_namespaces,
+    get_namespace_stats,
+    get_namespaces,
+    import_namespaces,
+    prune_namespaces,
+)
+from dali.historical_bar import HistoricalBar
+from dali.historical_bar_store import HistoricalBarStore, open_historical_bar_store
+from dali.plugin.pair_converter.csv.kraken import _PairStartEnd
+
+ROOT_PATH: Path = Path(os.path.dirname(__file__)).parent.absolute()
+OUTPUT_PATH: Path = ROOT_PATH / Path("output")
+
+BAR_TIMESTAMP: datetime = datetime(2020, 6, 1, 0, 0, tzinfo=timezone.utc)
+BAR: HistoricalBar = HistoricalBar(
+    duration=timedelta(minutes=1),
+    timestamp=BAR_TIMESTAMP,
+    open=RP2Decimal("9445.83"),
+    high=RP2Decimal("9447.52"),
+    low=RP2Decimal("9436.6"),
+    close=RP2Decimal("9435.8"),
+    volume=RP2Decimal("1"),
+)
+KEY: AssetPairAndTimestamp = AssetPairAndTimestamp(BAR_TIMESTAMP, "BTC", "USD", "Kraken")
+
+
+class TestCacheManager(unittest.TestCase):
+    def setUp(self) -> None:  # pylint: disable=invalid-name
+        self.maxDiff = None  # pylint: disable=invalid-name
+
+    @staticmethod
+    def _remove_store(cache_name: str) -> None:
+        open_historical_bar_store(cache_name).close()
+        remove_from_cache(f"{cache_name}.sqlite")
+
+    def test_stats_prune_export_and_import(self) -> None:
+        store_name: str = "test_cache_manager_store"
+        pickle_name: str = "test_cache_manager_rates"
+        archive_path: str = str(OUTPUT_PATH / "test_cache_manager.tar.gz")
+        self._remove_store(store_name)
+        os.makedirs(OUTPUT_PATH, exist_ok=True)
+
+        store: HistoricalBarStore = open_historical_bar_store(store_name)
+        store.put(KEY, BAR)
+        later_key: AssetPairAndTimestamp = KEY._replace(timestamp=BAR_TIMESTAMP + timedelta(days=1), from_asset="ETH", exchange="Binance.com")
+        store.put(later_key, BAR._replace(timestamp=later_key.timestamp))
+        store.commit()
+        rates: Dict[date, RP2Decimal] = {date(2020, 1, 1): RP2Decimal("1.1"), date(2020, 3, 1): RP2Decimal("1.2")}
+        save_to_cache(pickle_name, rates, plugin="test")
+
+        self.assertIn(f"{store_name}.sqlite", get_namespaces())
+        store_stats: NamespaceStats = get_namespace_stats(f"{store_name}.sqlite")
+        self.assertEqual(store_stats.entry_count, 2)
+        self.assertEqual(store_stats.start, BAR_TIMESTAMP)
+        self.assertEqual(store_stats.end, later_key.timestamp + timedelta(minutes=1))
+        pickle_stats: NamespaceStats = get_namespace_stats(pickle_name)
+        self.assertEqual(pickle_stats.entry_count, 2)
+        self.assertEqual(pickle_stats.start, datetime(2020, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(pickle_stats.end, datetime(2020, 3, 1, tzinfo=timezone.utc))
+        self.assertIsNotNone(pickle_stats.manifest_entry)
+
+        export_namespaces(archive_path, [f"{store_name}.sqlite", pickle_name])
+
+        # Pruning by asset only touches the bars of that asset
+        prune_namespaces([f"{store_name}.sqlite", pickle_name], asset="ETH")
+        self.assertEqual(len(store), 1)
+        self.assertIsNone(store.get(later_key))
+        pruned_rates: Dict[date, RP2Decimal] = load_from_cache(pickle_name)
+        self.assertEqual(pruned_rates, rates)
+
+        # Importing merges bar stores and restores missing files with their manifest entries
+        other_key: AssetPairAndTimestamp = KEY._replace(to_asset="EUR")
+        store.put(other_key, BAR)
+        store.commit()
+        remove_from_cache(pickle_name)
+        imported_names: List[str] = import_namespaces(archive_path)
+        expected_names: List[str] = [f"{store_name}.sqlite", pickle_name]
+        self.assertCountEqual(imported_names, expected_names)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.get(later_key), BAR._replace(timestamp=later_key.timestamp))
+        imported_rates: Dict[date, RP2Decimal] = load_from_cache(pickle_name)
+        self.assertEqual(imported_rates, rates)
+        self.assertEqual(get_cache_manifest()[pickle_name].plugin, "test")
+
+        # Old namespaces are pruned as a whole
+        old_time: float = time.time() - 10 * 86400
+        os.utime(ROOT_PATH / CACHE_DIR / pickle_name, (old_time, old_time))
+        prune_namespaces([pickle_name], older_than=timedelta(days=5))
+        self.assertNotIn(pickle_name, get_namespaces())
+        self.assertNotIn(pickle_name, get_cache_manifest())
+
+        self._remove_store(store_name)
+
+    def test_kraken_chunk_assets(self) -> None:
+        kraken_pairs: Dict[str, _PairStartEnd] = {
+            "USDTUSD1": _PairStartEnd(end=1601856120, start=1601856000, base_asset="USDT", quote_asset="USD"),
+            "TUSDUSD1": _PairStartEnd(end=1601856120, start=1601856000),
+        }
+        expected_assets: List[Optional[Tuple[str, str]]] = [("USDT", "USD"), None, None]
+
+        # Pruning USD doesn't touch USDT pairs: the assets of chunks without market metadata are unknown, they aren't guessed from the pair name
+        chunk_assets: List[Optional[Tuple[str, str]]] = [
+            _get_kraken_chunk_assets(chunk_name, kraken_pairs)
+            for chunk_name in ["USDTUSD_1601856000_1.npy", "TUSDUSD_1601856000_1.npy", "XBTUSDT_1601856000_5.csv.gz"]
+        ]
+        self.assertEqual(chunk_assets, expected_assets)
+
+    def test_import_rejects_unsafe_archives(self) -> None:
+        archive_path: str = str(OUTPUT_PATH / "test_cache_manager_unsafe.tar")
+        os.makedirs(OUTPUT_PATH, exist_ok=True)
+        with tarfile.open(archive_path, "w") as archive:
+            member_info: tarfile.TarInfo = tarfile.TarInfo("../outside_of_cache")
+            member_info.size = 4
+            archive.addfile(member_info, io.BytesIO(b"data"))
+
+        with self.assertRaisesRegex(RP2ValueError, "Invalid cache archive member"):
+            import_namespaces(archive_path)
+        self.assertFalse((ROOT_PATH / "outside_of_cache").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
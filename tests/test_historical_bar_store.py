@@ -0,0 +1,184 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sqlite3
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List
+
+from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2TypeError
+
+from dali.abstract_pair_converter_plugin import AssetPairAndTimestamp
+from dali.bar_series import BarSeries, bar_to_row, to_microseconds
+from dali.cache import CACHE_DIR, save_to_cache
+from dali.historical_bar import HistoricalBar
+from dali.historical_bar_store import HistoricalBarStore, open_historical_bar_store
+
+ROOT_PATH: Path = Path(os.path.dirname(__file__)).parent.absolute()
+
+BAR_TIMESTAMP: datetime = datetime(2020, 6, 1, 0, 0, tzinfo=timezone.utc)
+BAR: HistoricalBar = HistoricalBar(
+    duration=timedelta(minutes=1),
+    timestamp=BAR_TIMESTAMP,
+    open=RP2Decimal("9445.83"),
+    high=RP2Decimal("9447.52"),
+    low=RP2Decimal("9436.6"),
+    close=RP2Decimal("9435.800000000001"),
+    volume=RP2Decimal("1"),
+)
+KEY: AssetPairAndTimestamp = AssetPairAndTimestamp(BAR_TIMESTAMP, "BTC", "USD", "Kraken")
+
+
+class TestHistoricalBarStore(unittest.TestCase):
+    def setUp(self) -> None:  # pylint: disable=invalid-name
+        self.maxDiff = None  # pylint: disable=invalid-name
+
+    @staticmethod
+    def _remove_cache(cache_name: str) -> None:
+        for path in [ROOT_PATH / CACHE_DIR / cache_name, ROOT_PATH / CACHE_DIR / f"{cache_name}.sqlite"]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def test_put_and_get(self) -> None:
+        cache_name: str = "test_put_and_get"
+        self._remove_cache(cache_name)
+        store: HistoricalBarStore = open_historical_bar_store(cache_name)
+
+        self.assertIsNone(store.get(KEY))
+        store.put(KEY, BAR)
+        self.assertEqual(store.get(KEY), BAR)
+        self.assertIn(KEY, store)
+        self.assertNotIn(KEY._replace(exchange="Binance.com"), store)
+
+        # Upserts replace the existing bar
+        store.put(KEY, BAR._replace(high=RP2Decimal("10000")))
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get(KEY), BAR._replace(high=RP2Decimal("10000")))
+
+        # Bars survive reopening the store once committed, and the lookup is independent of the timezone object
+        store.commit()
+        reopened_store: HistoricalBarStore = HistoricalBarStore(cache_name)
+        other_timezone_key: AssetPairAndTimestamp = KEY._replace(timestamp=BAR_TIMESTAMP.astimezone(timezone(timedelta(hours=9))))
+        self.assertEqual(reopened_store.get(other_timezone_key), BAR._replace(high=RP2Decimal("10000")))
+        reopened_store.close()
+
+        with self.assertRaisesRegex(RP2TypeError, "timezone-aware"):
+            store.get(KEY._replace(timestamp=datetime(2020, 6, 1)))
+
+    def test_legacy_cache_import(self) -> None:
+        cache_name: str = "test_legacy_cache_import"
+        self._remove_cache(cache_name)
+        legacy_cache: Dict[AssetPairAndTimestamp, HistoricalBar] = {KEY: BAR, KEY._replace(to_asset="EUR"): BAR._replace(open=RP2Decimal("8000"))}
+        save_to_cache(cache_name, legacy_cache)
+
+        store: HistoricalBarStore = open_historical_bar_store(cache_name)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get(KEY), BAR)
+        self.assertEqual(store.get(KEY._replace(to_asset="EUR")), BAR._replace(open=RP2Decimal("8000")))
+
+        # The legacy cache is imported only once
+        newer_legacy_cache: Dict[AssetPairAndTimestamp, HistoricalBar] = {KEY._replace(to_asset="JPY"): BAR}
+        save_to_cache(cache_name, newer_legacy_cache)
+        store.close()
+        self.assertEqual(len(HistoricalBarStore(cache_name)), 2)
+
+    def test_bar_series(self) -> None:
+        timestamp: int = to_microseconds(BAR_TIMESTAMP)
+        minute: int = to_microseconds(BAR_TIMESTAMP + timedelta(minutes=1)) - timestamp
+        series: BarSeries = BarSeries(bar_to_row(timestamp + index * minute, BAR) for index in range(0, 2000, 2))
+
+        self.assertEqual(len(series), 1000)
+        self.assertEqual(series.get(timestamp + 10 * minute), BAR)
+        self.assertIsNone(series.get(timestamp + 11 * minute))
+        self.assertIsNone(series.get(timestamp - minute))
+
+        # Added bars are visible right away, and replace the ones with the same timestamp when merged into the columns
+        series.add(bar_to_row(timestamp + 11 * minute, BAR._replace(low=RP2Decimal("1.123456789012345678"))))
+        series.add(bar_to_row(timestamp + 10 * minute, BAR._replace(high=RP2Decimal("10000"))))
+        self.assertEqual(series.get(timestamp + 11 * minute), BAR._replace(low=RP2Decimal("1.123456789012345678")))
+        for index in range(1, 2000, 2):
+            series.add(bar_to_row(timestamp + index * minute, BAR))
+        self.assertEqual(len(series), 2000)
+        self.assertEqual(series.get(timestamp + 10 * minute), BAR._replace(high=RP2Decimal("10000")))
+        self.assertEqual(series.get(timestamp + 1999 * minute), BAR)
+
+    def test_find_covering_row(self) -> None:
+        timestamp: int = to_microseconds(BAR_TIMESTAMP)
+        minute: int = to_microseconds(BAR_TIMESTAMP + timedelta(minutes=1)) - timestamp
+        hourly_bar: HistoricalBar = BAR._replace(duration=timedelta(hours=1), open=RP2Decimal("1"))
+        daily_bar: HistoricalBar = BAR._replace(duration=timedelta(days=1), open=RP2Decimal("2"))
+        synthesized_bar: HistoricalBar = BAR._replace(duration=timedelta(days=1), timestamp=BAR_TIMESTAMP + timedelta(minutes=20))
+        series: BarSeries = BarSeries([bar_to_row(timestamp, daily_bar, native=True)])
+        series.add(bar_to_row(timestamp + 60 * minute, hourly_bar._replace(timestamp=BAR_TIMESTAMP + timedelta(hours=1)), native=True))
+        series.add(bar_to_row(timestamp + 90 * minute, BAR._replace(timestamp=BAR_TIMESTAMP + timedelta(minutes=90)), native=True))
+        series.add(bar_to_row(timestamp + 20 * minute, synthesized_bar))
+
+        # The finest native bar containing the timestamp wins, whether it's been merged into the columns or not: synthesized bars
+        # (e.g. route products) are only valid for their own lookup timestamp
+        for merged in [False, True]:
+            self.assertEqual(series.find_covering_row(timestamp + 30 * minute), bar_to_row(timestamp, daily_bar, native=True))
+            self.assertEqual(series.get(timestamp + 20 * minute), synthesized_bar)
+            row = series.find_covering_row(timestamp + 61 * minute)
+            self.assertEqual(row[3] if row else None, "1")
+            row = series.find_covering_row(timestamp + 90 * minute + 1)
+            self.assertEqual(row[3] if row else None, str(BAR.open))
+            self.assertIsNone(series.find_covering_row(timestamp - 1))
+            self.assertIsNone(series.find_covering_row(timestamp + 24 * 60 * minute))
+            if not merged:
+                self.assertEqual(len(series), 4)
+
+    def test_native_column_migration(self) -> None:
+        cache_name: str = "test_native_column_migration"
+        self._remove_cache(cache_name)
+        os.makedirs(ROOT_PATH / CACHE_DIR, exist_ok=True)
+        with sqlite3.connect(str(ROOT_PATH / CACHE_DIR / f"{cache_name}.sqlite")) as connection:
+            connection.execute(
+                "CREATE TABLE bars (from_asset TEXT NOT NULL, to_asset TEXT NOT NULL, exchange TEXT NOT NULL, timestamp INTEGER NOT NULL, "
+                "duration INTEGER NOT NULL, bar_timestamp INTEGER NOT NULL, open TEXT NOT NULL, high TEXT NOT NULL, low TEXT NOT NULL, "
+                "close TEXT NOT NULL, volume TEXT NOT NULL, PRIMARY KEY (from_asset, to_asset, exchange, timestamp)) WITHOUT ROWID"
+            )
+            timestamp: int = to_microseconds(BAR_TIMESTAMP)
+            prices: List[str] = [str(BAR.open), str(BAR.high), str(BAR.low), str(BAR.close), str(BAR.volume)]
+            connection.execute("INSERT INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ["BTC", "USD", "Kraken", timestamp, 60_000_000, timestamp] + prices)
+        connection.close()
+
+        # Bars of older stores are still found by key, but they don't cover other timestamps: their bar timestamp may be wrong
+        store: HistoricalBarStore = HistoricalBarStore(cache_name)
+        self.assertEqual(store.get(KEY), BAR)
+        self.assertIsNone(store.find_covering(KEY._replace(timestamp=BAR_TIMESTAMP + timedelta(seconds=30))))
+        store.put(KEY, BAR, native=True)
+        self.assertEqual(store.find_covering(KEY._replace(timestamp=BAR_TIMESTAMP + timedelta(seconds=30))), BAR)
+        store.close()
+
+    def test_series_and_database_agree(self) -> None:
+        cache_name: str = "test_series_and_database_agree"
+        self._remove_cache(cache_name)
+        store: HistoricalBarStore = open_historical_bar_store(cache_name)
+
+        # Bars written after a series is loaded are added to it
+        self.assertIsNone(store.get(KEY))
+        store.put_many((KEY._replace(timestamp=BAR_TIMESTAMP + timedelta(minutes=minute)), BAR) for minute in range(3))
+        self.assertEqual(store.get(KEY._replace(timestamp=BAR_TIMESTAMP + timedelta(minutes=2))), BAR)
+        store.close()
+
+        self.assertEqual(HistoricalBarStore(cache_name).get(KEY._replace(timestamp=BAR_TIMESTAMP + timedelta(minutes=2))), BAR)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,11 +18,12 @@ import datetime
 from itertools import chain, repeat
 from typing import Any, Dict, List, Union
 
+import pytest
 from ccxt import Exchange
 from dateutil import parser
-
 from rp2.plugin.country.us import US
 from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2RuntimeError
 
 from dali.configuration import Keyword
 from dali.in_transaction import InTransaction
@@ -38,6 +39,21 @@ _NORMAL_SUBSCRIPTION_TIME: int = 1552089166000
 _EARLY_REDEEM_SUBSCRIPTION_TIME: int = 1552089166000 + _MS_IN_DAY
 
 
+def _deposit(transaction_id: str, timestamp: int) -> Dict[str, Any]:
+    return {
+        "info": {"coin": "PAXG", "txId": transaction_id, "insertTime": str(timestamp)},
+        "id": None,
+        "txid": transaction_id,
+        "timestamp": timestamp,
+        "datetime": datetime.datetime.fromtimestamp(timestamp / 1000, datetime.timezone.utc).isoformat(),
+        "type": "deposit",
+        "amount": 0.00999800,
+        "currency": "PAXG",
+        "status": "ok",
+        "fee": None,
+    }
+
+
 class TestBinance:
     def test_deposits(self, mocker: Any) -> None:
         plugin = InputPlugin(
@@ -887,3 +903,82 @@ class TestBinance:
         assert crypto_withdrawal_transaction.from_exchange == "Binance.com"
         assert crypto_withdrawal_transaction.crypto_received == Keyword.UNKNOWN.value
         assert RP2Decimal(crypto_withdrawal_transaction.crypto_sent) == RP2Decimal("0.00999800")
+
+    # Binance.com plugin that only reads deposits
+    @staticmethod
+    def __create_deposit_plugin(mocker: Any, account_holder: str, start_time: int) -> InputPlugin:
+        plugin = InputPlugin(
+            account_holder=account_holder,
+            api_key="a",
+            api_secret="b",
+            native_fiat="USD",
+        )
+        mocker.patch.object(plugin._client, "fetch_markets").return_value = [{"id": "ETHBTC"}]
+        mocker.patch.object(plugin, "_AbstractCcxtInputPlugin__start_time_ms", start_time)
+        mocker.patch.object(plugin, "_process_trades").return_value = None
+        mocker.patch.object(plugin, "_process_gains").return_value = None
+        mocker.patch.object(plugin, "_process_withdrawals").return_value = None
+        mocker.patch.object(plugin, "_process_implicit_api").return_value = None
+        return plugin
+
+    def test_incremental_load(self, mocker: Any) -> None:
+        now: int = int(datetime.datetime.now().timestamp()) * 1000
+        start_time: int = now - 10 * _MS_IN_DAY
+
+        # Full load
+        plugin = self.__create_deposit_plugin(mocker, "incremental_tester", start_time)
+        fetch_deposits: Any = mocker.patch.object(plugin._client, "fetch_deposits")
+        fetch_deposits.return_value = [_deposit("0xaaaa", now - 5 * _MS_IN_DAY)]
+        cached_transactions = plugin.load(US())
+        plugin.save_to_cache(cached_transactions)
+        assert fetch_deposits.call_args_list[0].kwargs["since"] == start_time
+
+        # The next load starts shortly before the previous one and doesn't duplicate the records it reads again
+        plugin = self.__create_deposit_plugin(mocker, "incremental_tester", start_time)
+        assert plugin.load_from_cache() == cached_transactions
+        fetch_deposits = mocker.patch.object(plugin._client, "fetch_deposits")
+        fetch_deposits.return_value = [
+            _deposit("0xaaaa", now - 5 * _MS_IN_DAY),
+            _deposit("0xbbbb", now - _MS_IN_HOUR),
+        ]
+        result = plugin.load_incrementally(US(), cached_transactions)
+        assert fetch_deposits.call_args_list[0].kwargs["since"] >= now - _MS_IN_DAY
+        assert sorted(transaction.unique_id for transaction in result) == ["aaaa", "bbbb"]
+
+    def test_resume_from_checkpoint(self, mocker: Any) -> None:
+        now: int = int(datetime.datetime.now().timestamp()) * 1000
+        # Three 90-day deposit windows
+        start_time: int = now - 200 * _MS_IN_DAY
+
+        # The load fails after the first page
+        plugin = self.__create_deposit_plugin(mocker, "resume_tester", start_time)
+        mocker.patch.object(plugin._client, "fetch_deposits").side_effect = [
+            [_deposit("0xaaaa", start_time + 10 * _MS_IN_DAY)],
+            RP2RuntimeError("Server error"),
+        ]
+        with pytest.raises(RP2RuntimeError, match="Server error"):
+            plugin.load(US())
+
+        # The resumed load starts from the second page, and fails after it
+        plugin = self.__create_deposit_plugin(mocker, "resume_tester", start_time)
+        plugin.resume_from_checkpoints()
+        fetch_deposits: Any = mocker.patch.object(plugin._client, "fetch_deposits")
+        fetch_deposits.side_effect = [[_deposit("0xbbbb", start_time + 100 * _MS_IN_DAY)], RP2RuntimeError("Server error")]
+        with pytest.raises(RP2RuntimeError, match="Server error"):
+            plugin.load(US())
+        assert fetch_deposits.call_args_list[0].kwargs["since"] == start_time + 90 * _MS_IN_DAY
+
+        # Checkpoints have the pages of both loads: the next one starts from the third page and returns the deposits of the first two
+        plugin = self.__create_deposit_plugin(mocker, "resume_tester", start_time)
+        plugin.resume_from_checkpoints()
+        fetch_deposits = mocker.patch.object(plugin._client, "fetch_deposits")
+        fetch_deposits.side_effect = [[_deposit("0xcccc", start_time + 190 * _MS_IN_DAY)]]
+        result = plugin.load(US())
+        assert fetch_deposits.call_args_list[0].kwargs["since"] == start_time + 180 * _MS_IN_DAY
+        assert sorted(transaction.unique_id for transaction in result) == ["aaaa", "bbbb", "cccc"]
+
+        # Checkpoints don't outlive a successful load
+        plugin.clear_checkpoints()
+        plugin = self.__create_deposit_plugin(mocker, "resume_tester", start_time)
+        plugin.resume_from_checkpoints()
+        assert plugin._get_checkpoint(plugin.DEPOSITS_ENDPOINT) is None
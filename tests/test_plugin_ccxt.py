@@ -13,16 +13,24 @@
 # limitations under the License.
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Union
+from time import sleep
+from typing import Any, Dict, List, Optional, Union
 
-from ccxt import binance, kraken
+import pytest
+from ccxt import BadSymbol, ExchangeError, RateLimitExceeded, binance, kraken
 from rp2.rp2_decimal import ZERO, RP2Decimal
 
-from dali.abstract_pair_converter_plugin import AssetPairAndTimestamp
-from dali.cache import CACHE_DIR, load_from_cache
+from dali.abstract_pair_converter_plugin import (
+    AssetPairAndExchange,
+    AssetPairAndTimestamp,
+    UnavailableBarError,
+)
+from dali.cache import CACHE_DIR
 from dali.configuration import Keyword
 from dali.historical_bar import HistoricalBar
+from dali.historical_bar_store import open_historical_bar_store
 from dali.plugin.pair_converter.ccxt import PairConverterPlugin
 from dali.plugin.pair_converter.csv.kraken import Kraken as KrakenCsvPricing
 
@@ -31,12 +39,13 @@ TEST_EXCHANGE: str = "Kraken"
 ALT_EXCHANGE: str = "Binance.com"
 LOCKED_EXCHANGE: str = "Kraken"
 FIAT_EXHANGE: str = "fiat"
-TEST_GRAPH: Dict[str, List[str]] = {
-    "BETH": ["ETH"],
-    "BTC": ["USDT", "GBP"],
-    "ETH": ["USDT"],
-    "USDT": ["USD"],
-    "USD": ["JPY"],
+# Adjacent assets of each asset, in priority order (same format as the graphs built by the plugin)
+TEST_GRAPH: Dict[str, Dict[str, None]] = {
+    "BETH": {"ETH": None},
+    "BTC": {"USDT": None, "GBP": None},
+    "ETH": {"USDT": None},
+    "USDT": {"USD": None},
+    "USD": {"JPY": None},
 }
 TEST_MARKETS: Dict[str, List[str]] = {
     "BTCUSDT": [ALT_EXCHANGE],
@@ -106,6 +115,10 @@ KRAKEN_OPEN: RP2Decimal = RP2Decimal("1.5555")
 KRAKEN_CLOSE: RP2Decimal = RP2Decimal("1.5558")
 KRAKEN_VOLUME: RP2Decimal = RP2Decimal("15.15")
 
+# Prefetch Test
+PREFETCH_TIMESTAMP: datetime = datetime(2021, 3, 4, 5, 6, tzinfo=timezone.utc)
+PREFETCH_FIAT_LIST: List[str] = ["GBP", "JPY", "USD"]
+
 _MS_IN_SECOND: int = 1000
 
 
@@ -131,7 +144,7 @@ class TestCcxtPlugin:
         mocker.patch.object(plugin, "_PairConverterPlugin__exchange_csv_reader", {"kraken": kraken_csv})
         mocker.patch.object(alt_exchange, "fetchOHLCV").return_value = [
             [
-                BAR_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(BAR_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 BAR_OPEN,  # (O)pen price, float
                 BAR_HIGH,  # (H)ighest price, float
                 BAR_LOW,  # (L)owest price, float
@@ -142,7 +155,7 @@ class TestCcxtPlugin:
 
         mocker.patch.object(exchange, "fetchOHLCV").return_value = [
             [
-                USDTUSD_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(USDTUSD_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 USDTUSD_OPEN,  # (O)pen price, float
                 USDTUSD_HIGH,  # (H)ighest price, float
                 USDTUSD_LOW,  # (L)owest price, float
@@ -162,7 +175,7 @@ class TestCcxtPlugin:
 
     def test_historical_prices(self, mocker: Any) -> None:
         plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
-        cache_path = os.path.join(CACHE_DIR, plugin.cache_key())
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
         if os.path.exists(cache_path):
             os.remove(cache_path)
 
@@ -189,13 +202,13 @@ class TestCcxtPlugin:
         plugin.save_historical_price_cache()
 
         # Load plugin cache and verify
-        cache = load_from_cache(plugin.cache_key())
+        cache = open_historical_bar_store(plugin.cache_key())
         key = AssetPairAndTimestamp(BAR_TIMESTAMP, "BTC", "USD", TEST_EXCHANGE)
 
         # 3 cached prices - BTC/USDT, USDT/USD, BTC/USD
         assert len(cache) == 3, str(cache)
         assert key in cache
-        data = cache[key]
+        data = cache.get(key)
 
         assert data
         assert data.timestamp == BAR_TIMESTAMP
@@ -289,7 +302,7 @@ class TestCcxtPlugin:
         mocker.patch.object(alt_exchange, "fetchOHLCV").side_effect = no_fiat_fetch_ohlcv
         mocker.patch.object(exchange, "fetchOHLCV").return_value = [
             [
-                USDTUSD_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(USDTUSD_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 USDTUSD_OPEN,  # (O)pen price, float
                 USDTUSD_HIGH,  # (H)ighest price, float
                 USDTUSD_LOW,  # (L)owest price, float
@@ -328,7 +341,7 @@ class TestCcxtPlugin:
         mocker.patch.object(plugin, "_PairConverterPlugin__exchange_markets", {TEST_EXCHANGE: TEST_MARKETS})
         mocker.patch.object(exchange, "fetchOHLCV").return_value = [
             [
-                BAR_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(BAR_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 BAR_OPEN,  # (O)pen price, float
                 BAR_HIGH,  # (H)ighest price, float
                 BAR_LOW,  # (L)owest price, float
@@ -338,7 +351,7 @@ class TestCcxtPlugin:
         ]
         mocker.patch.object(alt_exchange, "fetchOHLCV").return_value = [
             [
-                BTCGBP_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(BTCGBP_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 BTCGBP_OPEN,  # (O)pen price, float
                 BTCGBP_HIGH,  # (H)ighest price, float
                 BTCGBP_LOW,  # (L)owest price, float
@@ -406,7 +419,8 @@ class TestCcxtPlugin:
         if not os.path.exists("output/kraken_test"):
             os.makedirs("output/kraken_test")
         with open("input/USD_OHLCVT_test.zip", "rb") as file:
-            mocker.patch.object(kraken_csv, "_google_file_to_bytes").return_value = file.read()
+            zip_file_bytes: bytes = file.read()
+        mocker.patch.object(kraken_csv, "_google_file_to_file").side_effect = lambda file_name, output_file: output_file.write(zip_file_bytes) > 0
 
         mocker.patch.object(plugin, "_PairConverterPlugin__exchange_csv_reader", {"Kraken": kraken_csv})
         exchange = kraken(
@@ -426,7 +440,7 @@ class TestCcxtPlugin:
         mocker.patch.object(plugin, "_PairConverterPlugin__exchange_markets", {TEST_EXCHANGE: modified_markets})
         mocker.patch.object(alt_exchange, "fetchOHLCV").return_value = [
             [
-                KRAKEN_TIMESTAMP,  # Match the timestamp to assure correct price look up
+                int(KRAKEN_TIMESTAMP.timestamp() * 1000),  # Match the timestamp to assure correct price look up
                 BAR_OPEN,  # (O)pen price, float
                 BAR_HIGH,  # (H)ighest price, float
                 BAR_LOW,  # (L)owest price, float
@@ -437,7 +451,7 @@ class TestCcxtPlugin:
 
         mocker.patch.object(exchange, "fetchOHLCV").return_value = [
             [
-                KRAKEN_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(KRAKEN_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 USDTUSD_OPEN,  # (O)pen price, float
                 USDTUSD_HIGH,  # (H)ighest price, float
                 USDTUSD_LOW,  # (L)owest price, float
@@ -479,7 +493,7 @@ class TestCcxtPlugin:
         mocker.patch.object(plugin, "_PairConverterPlugin__exchange_csv_reader", {LOCKED_EXCHANGE: kraken_csv})
         mocker.patch.object(exchange_instance, "fetchOHLCV").return_value = [
             [
-                BAR_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(BAR_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 BAR_OPEN,  # (O)pen price, float
                 BAR_HIGH,  # (H)ighest price, float
                 BAR_LOW,  # (L)owest price, float
@@ -490,7 +504,7 @@ class TestCcxtPlugin:
 
         mocker.patch.object(alt_exchange, "fetchOHLCV").return_value = [
             [
-                USDTUSD_TIMESTAMP,  # UTC timestamp in milliseconds, integer
+                int(USDTUSD_TIMESTAMP.timestamp() * 1000),  # UTC timestamp in milliseconds, integer
                 USDTUSD_OPEN,  # (O)pen price, float
                 USDTUSD_HIGH,  # (H)ighest price, float
                 USDTUSD_LOW,  # (L)owest price, float
@@ -510,3 +524,399 @@ class TestCcxtPlugin:
 
         assert data
         assert mocker.patch.object(plugin, "_add_exchange_to_memcache").called_once_with(LOCKED_EXCHANGE)
+
+    def test_prefetch_historical_bars(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.__btcusdt_mock(plugin, mocker)
+        mocker.patch.object(plugin, "_AbstractPairConverterPlugin__fiat_list", PREFETCH_FIAT_LIST)
+        exchanges: Dict[str, Any] = plugin.exchanges
+
+        def page_fetch_ohlcv(symbol: str, timeframe: str, timestamp: int, candles: int) -> List[List[Union[float, int]]]:
+            if symbol == "ETH/USDT":
+                return []
+            if symbol == "BETH/ETH":
+                raise ExchangeError("Internal error")
+            candle_ms: int = (3600 if timeframe == "1h" else 60) * _MS_IN_SECOND
+            return [[timestamp + candle * candle_ms, 1.0, 2.0, 0.5, 1.5, 10.0] for candle in range(candles)]
+
+        mocker.patch.object(exchanges[TEST_EXCHANGE], "fetchOHLCV").side_effect = page_fetch_ohlcv
+        mocker.patch.object(exchanges[ALT_EXCHANGE], "fetchOHLCV").side_effect = page_fetch_ohlcv
+        later_timestamp: datetime = PREFETCH_TIMESTAMP + timedelta(minutes=90)
+
+        remaining = plugin.prefetch_historical_bars(
+            {
+                AssetPairAndExchange("BTC", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP, later_timestamp],
+                AssetPairAndExchange("ETH", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+                AssetPairAndExchange("BETH", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+                AssetPairAndExchange("BOGUSCOIN", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+            }
+        )
+
+        # BOGUSCOIN has no route, the ETH/USDT page is empty and the BETH/ETH request failed: they are left for the next pair converter
+        assert remaining == {
+            AssetPairAndExchange("BOGUSCOIN", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+            AssetPairAndExchange("ETH", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+            AssetPairAndExchange("BETH", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+        }
+
+        # One page per hop covers both timestamps: BTC/USDT, ETH/USDT and BETH/ETH on Binance.com and USDT/USD on Kraken
+        assert exchanges[ALT_EXCHANGE].fetchOHLCV.call_count == 3
+        assert exchanges[TEST_EXCHANGE].fetchOHLCV.call_count == 1
+
+        data = plugin.get_historic_bar_from_native_source(later_timestamp, "BTC", "USD", TEST_EXCHANGE)
+
+        assert data
+        assert data.high == RP2Decimal("4.0")
+        assert data.low == RP2Decimal("0.25")
+        assert exchanges[ALT_EXCHANGE].fetchOHLCV.call_count == 3
+        assert exchanges[TEST_EXCHANGE].fetchOHLCV.call_count == 1
+
+        # Hops with hourly bars in the cache are read in pages of hourly candles, and known misses aren't requested again
+        hour_timestamp: datetime = PREFETCH_TIMESTAMP.replace(minute=0)
+        plugin._add_bar_to_cache(  # pylint: disable=protected-access
+            AssetPairAndTimestamp(hour_timestamp, "BTC", "GBP", ALT_EXCHANGE),
+            HistoricalBar(duration=timedelta(hours=1), timestamp=hour_timestamp, open=BAR_OPEN, high=BAR_HIGH, low=BAR_LOW, close=BAR_CLOSE, volume=BAR_VOLUME),
+        )
+        plugin._add_miss("ETH", "USDT", ALT_EXCHANGE, PREFETCH_TIMESTAMP)  # pylint: disable=protected-access
+        remaining = plugin.prefetch_historical_bars(
+            {
+                AssetPairAndExchange("BTC", "GBP", TEST_EXCHANGE): [PREFETCH_TIMESTAMP, PREFETCH_TIMESTAMP + timedelta(hours=5)],
+                AssetPairAndExchange("ETH", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP],
+            }
+        )
+        assert remaining == {AssetPairAndExchange("ETH", "USD", TEST_EXCHANGE): [PREFETCH_TIMESTAMP]}
+        assert exchanges[ALT_EXCHANGE].fetchOHLCV.call_count == 4
+        assert exchanges[ALT_EXCHANGE].fetchOHLCV.call_args[0][:2] == ("BTC/GBP", "1h")
+
+    def test_ohlcv_pages(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, use_ohlcv_pages=True)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, use_ohlcv_pages=True)
+        self.__btcusdt_mock(plugin, mocker)
+        alt_exchange: Any = plugin.exchanges[ALT_EXCHANGE]
+
+        def page_fetch_ohlcv(symbol: str, timeframe: str, timestamp: int, candles: int) -> List[List[Union[float, int]]]:
+            # pylint: disable=unused-argument
+            return [[timestamp + minute * 60 * _MS_IN_SECOND, 1.0, 2.0 + minute, 0.5, 1.5, 10.0] for minute in range(candles)]
+
+        mocker.patch.object(alt_exchange, "fetchOHLCV").side_effect = page_fetch_ohlcv
+
+        data = plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP + timedelta(seconds=30), ALT_EXCHANGE)
+
+        # The page is centered on the requested minute
+        assert data
+        assert data.timestamp == PREFETCH_TIMESTAMP
+        assert data.high == RP2Decimal("502.0")
+        assert alt_exchange.fetchOHLCV.call_count == 1
+
+        data = plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP + timedelta(minutes=100), ALT_EXCHANGE)
+
+        assert data
+        assert data.high == RP2Decimal("602.0")
+        assert alt_exchange.fetchOHLCV.call_count == 1
+
+    def test_route_cache(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.__btcusdt_mock(plugin, mocker)
+        build_bfs_tree = mocker.spy(plugin, "_build_bfs_tree")
+
+        assert plugin._bfs_cyclic(TEST_GRAPH, "BETH", "JPY") == ["BETH", "ETH", "USDT", "USD", "JPY"]  # pylint: disable=protected-access
+        assert plugin._bfs_cyclic(TEST_GRAPH, "BTC", "BTC") == ["BTC"]  # pylint: disable=protected-access
+        assert plugin._bfs_cyclic(TEST_GRAPH, "USD", "BTC") is None  # pylint: disable=protected-access
+        build_bfs_tree.reset_mock()
+
+        # Routes from the same asset reuse the BFS tree built by the first lookup
+        for to_asset in ["USD", "JPY", "USD"]:
+            route = plugin._get_conversion_route("BTC", to_asset, TEST_EXCHANGE)  # pylint: disable=protected-access
+            assert route
+            assert [hop.from_asset for hop in route] == ["BTC", "USDT", "USD"][: len(route)]
+        assert build_bfs_tree.call_count == 1
+
+    def test_market_snapshot(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = os.path.join(CACHE_DIR, plugin._market_snapshot_cache_key(TEST_EXCHANGE))  # pylint: disable=protected-access
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        markets: List[Dict[str, str]] = [{"base": "BTC", "quote": "USDT", "type": "spot"}, {"base": "ETH", "quote": "BTC", "type": "future"}]
+
+        def add_exchange(snapshot_plugin: PairConverterPlugin, fiat_list: List[str]) -> Any:
+            exchange: Any = kraken({})
+            fetch_markets: Any = mocker.patch.object(exchange, "fetch_markets")
+            fetch_markets.return_value = markets
+            mocker.patch.object(snapshot_plugin, "_PairConverterPlugin__exchanges", {TEST_EXCHANGE: exchange})
+            mocker.patch.object(snapshot_plugin, "_AbstractPairConverterPlugin__fiat_list", fiat_list)
+            snapshot_plugin._add_exchange_to_memcache(TEST_EXCHANGE)  # pylint: disable=protected-access
+            return fetch_markets
+
+        fetch_markets: Any = add_exchange(plugin, PREFETCH_FIAT_LIST)
+        assert fetch_markets.call_count == 1
+        assert plugin.exchange_markets[TEST_EXCHANGE]["BTCUSDT"] == [TEST_EXCHANGE]
+
+        # A warm start reads markets and fiat symbols from the snapshot
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        fetch_markets = add_exchange(plugin, [])
+        assert fetch_markets.call_count == 0
+        assert plugin.fiat_list == PREFETCH_FIAT_LIST
+        assert plugin.exchange_markets[TEST_EXCHANGE]["BTCUSDT"] == [TEST_EXCHANGE]
+        assert "ETHBTC" not in plugin.exchange_markets[TEST_EXCHANGE]
+
+        # Forced refresh
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, refresh_markets=True)
+        fetch_markets = add_exchange(plugin, PREFETCH_FIAT_LIST)
+        assert fetch_markets.call_count == 1
+
+        # Expired snapshot
+        mocker.patch("dali.plugin.pair_converter.ccxt.datetime").now.return_value = datetime.now(timezone.utc) + timedelta(hours=25)
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        fetch_markets = add_exchange(plugin, PREFETCH_FIAT_LIST)
+        assert fetch_markets.call_count == 1
+
+    def test_fiat_rate_table(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = os.path.join(CACHE_DIR, plugin._fiat_rates_cache_key())  # pylint: disable=protected-access
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        mocker.patch.object(plugin, "_AbstractPairConverterPlugin__fiat_list", PREFETCH_FIAT_LIST)
+        session_get: Any = mocker.patch.object(plugin, "_AbstractPairConverterPlugin__session").get
+        session_get.return_value.json.return_value = {"success": True, "base": "USD", "rates": {"GBP": 0.8, "JPY": 115, "USD": 1}}
+
+        # One request returns the rates of all fiat currencies: cross rates are computed without further requests
+        data = plugin.get_historic_bar_from_native_source(BAR_TIMESTAMP, "USD", "JPY", TEST_EXCHANGE)
+        assert data
+        assert data.close == RP2Decimal("115")
+        data = plugin.get_historic_bar_from_native_source(BAR_TIMESTAMP, "GBP", "JPY", TEST_EXCHANGE)
+        assert data
+        assert data.close == RP2Decimal("115") / RP2Decimal("0.8")
+        assert session_get.call_count == 1
+
+        # Prefetching downloads a timeseries for the days that don't have rates in the base yet (rates in other bases don't count)
+        next_day: datetime = BAR_TIMESTAMP + timedelta(days=1)
+        session_get.return_value.json.return_value = {
+            "success": True,
+            "base": "GBP",
+            "rates": {
+                BAR_TIMESTAMP.strftime("%Y-%m-%d"): {"JPY": 143.75, "USD": 1.25},
+                next_day.strftime("%Y-%m-%d"): {"JPY": 140, "USD": 1.25},
+            },
+        }
+        remaining = plugin.prefetch_historical_bars({AssetPairAndExchange("GBP", "USD", TEST_EXCHANGE): [BAR_TIMESTAMP, next_day]})
+        assert not remaining
+        assert session_get.call_count == 2
+        assert session_get.call_args.kwargs["params"]["base"] == "GBP"
+        assert session_get.call_args.kwargs["params"]["start_date"] == BAR_TIMESTAMP.strftime("%Y-%m-%d")
+
+        session_get.return_value.json.return_value = {
+            "success": True,
+            "base": "USD",
+            "rates": {next_day.strftime("%Y-%m-%d"): {"GBP": 0.8, "JPY": 112, "USD": 1}},
+        }
+        remaining = plugin.prefetch_historical_bars({AssetPairAndExchange("USD", "GBP", TEST_EXCHANGE): [BAR_TIMESTAMP, next_day]})
+        assert not remaining
+        assert session_get.call_count == 3
+        assert session_get.call_args.kwargs["params"]["start_date"] == next_day.strftime("%Y-%m-%d")
+        remaining = plugin.prefetch_historical_bars({AssetPairAndExchange("USD", "GBP", TEST_EXCHANGE): [BAR_TIMESTAMP, next_day]})
+        assert session_get.call_count == 3
+
+        data = plugin.get_historic_bar_from_native_source(next_day, "USD", "JPY", TEST_EXCHANGE)
+        assert data
+        assert data.close == RP2Decimal("112")
+        assert session_get.call_count == 3
+
+        # Rates survive a restart
+        plugin.save_historical_price_cache()
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        mocker.patch.object(plugin, "_AbstractPairConverterPlugin__fiat_list", PREFETCH_FIAT_LIST)
+        assert plugin._get_fiat_exchange_rate(next_day, "GBP", "JPY")  # pylint: disable=protected-access
+
+    def test_covering_bar(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.__btcusdt_mock(plugin, mocker)
+        alt_exchange: Any = plugin.exchanges[ALT_EXCHANGE]
+
+        # An illiquid pair with hourly candles only: like most exchanges, the mock returns the first candle opening at or after since
+        def hourly_fetch_ohlcv(symbol: str, timeframe: str, timestamp: int, candles: int) -> List[List[Union[float, int]]]:
+            # pylint: disable=unused-argument
+            hour_in_ms: int = 3600 * 1000
+            return [[-(-timestamp // hour_in_ms) * hour_in_ms, 1.0, 2.0, 0.5, 1.5, 10.0]] if timeframe == "1h" else []
+
+        mocker.patch.object(alt_exchange, "fetchOHLCV").side_effect = hourly_fetch_ohlcv
+        next_hour: datetime = PREFETCH_TIMESTAMP.replace(minute=0) + timedelta(hours=1)
+
+        data = plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP, ALT_EXCHANGE)
+        assert data
+        assert data.duration == timedelta(hours=1)
+        assert data.timestamp == next_hour
+        assert alt_exchange.fetchOHLCV.call_count == 4
+
+        # Timestamps within the candle reuse the cached hourly bar instead of going through the granularities again
+        data = plugin.find_historical_bar("BTC", "USDT", next_hour + timedelta(minutes=42), ALT_EXCHANGE)
+        assert data
+        assert data.high == RP2Decimal("2.0")
+        assert alt_exchange.fetchOHLCV.call_count == 4
+
+        # The candle doesn't cover the minutes between the requested timestamp and its open time
+        data = plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP + timedelta(minutes=42), ALT_EXCHANGE)
+        assert data
+        assert alt_exchange.fetchOHLCV.call_count == 8
+
+    def test_negative_cache(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.__btcusdt_mock(plugin, mocker)
+        mocker.patch.object(plugin, "_AbstractPairConverterPlugin__fiat_list", PREFETCH_FIAT_LIST)
+        alt_exchange: Any = plugin.exchanges[ALT_EXCHANGE]
+        mocker.patch.object(alt_exchange, "fetchOHLCV").return_value = []
+
+        # An airdropped token with no candles yet: each granularity is tried once per day
+        assert plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP, ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 6
+        assert plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP + timedelta(hours=1), ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 6
+        assert plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP + timedelta(days=1), ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 12
+
+        # Requests that the exchange keeps refusing (3 attempts per granularity) don't prove that there are no candles: the price is
+        # missing, but the lookup isn't recorded as a miss
+        refused_timestamp: datetime = PREFETCH_TIMESTAMP + timedelta(days=2)
+        mocker.patch("dali.plugin.pair_converter.ccxt.sleep")
+        alt_exchange.fetchOHLCV.side_effect = RateLimitExceeded("Too many requests")
+        with pytest.raises(UnavailableBarError):
+            plugin.find_historical_bar("BTC", "USDT", refused_timestamp, ALT_EXCHANGE)
+        assert plugin.get_conversion_rate(refused_timestamp, "BTC", "USD", TEST_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 48
+        alt_exchange.fetchOHLCV.side_effect = None
+        assert plugin.find_historical_bar("BTC", "USDT", refused_timestamp, ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 54
+
+        # A market that the exchange doesn't have is a miss: it isn't retried, at any granularity
+        bad_symbol_timestamp: datetime = PREFETCH_TIMESTAMP + timedelta(days=3)
+        alt_exchange.fetchOHLCV.side_effect = BadSymbol("binance does not have market symbol BTC/USDT")
+        assert plugin.find_historical_bar("BTC", "USDT", bad_symbol_timestamp, ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 55
+        assert plugin._is_known_miss("BTC", "USDT", ALT_EXCHANGE, bad_symbol_timestamp)  # pylint: disable=protected-access
+        assert plugin.find_historical_bar("BTC", "USDT", bad_symbol_timestamp, ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 55
+        alt_exchange.fetchOHLCV.side_effect = None
+
+        # Missing routes are remembered too
+        get_conversion_route = mocker.spy(plugin, "_get_conversion_route")
+        assert plugin.get_historic_bar_from_native_source(PREFETCH_TIMESTAMP, "BOGUSCOIN", "USD", TEST_EXCHANGE) is None
+        assert plugin.get_historic_bar_from_native_source(PREFETCH_TIMESTAMP, "BOGUSCOIN", "USD", TEST_EXCHANGE) is None
+        assert get_conversion_route.call_count == 1
+
+        # Misses are persisted and expire after the TTL
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.__btcusdt_mock(plugin, mocker)
+        mocker.patch.object(plugin, "_AbstractPairConverterPlugin__fiat_list", PREFETCH_FIAT_LIST)
+        alt_exchange = plugin.exchanges[ALT_EXCHANGE]
+        mocker.patch.object(alt_exchange, "fetchOHLCV").return_value = []
+        assert plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP, ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 0
+
+        mocker.patch("dali.abstract_pair_converter_plugin.datetime").now.return_value = datetime.now(timezone.utc) + timedelta(hours=25)
+        assert plugin.find_historical_bar("BTC", "USDT", PREFETCH_TIMESTAMP, ALT_EXCHANGE) is None
+        assert alt_exchange.fetchOHLCV.call_count == 6
+
+    def test_concurrent_lookups(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.__btcusdt_mock(plugin, mocker)
+        alt_exchange: Any = plugin.exchanges[ALT_EXCHANGE]
+
+        def slow_fetch_ohlcv(symbol: str, timeframe: str, timestamp: int, candles: int) -> List[List[Union[float, int]]]:
+            # pylint: disable=unused-argument
+            sleep(0.2)
+            return [[timestamp, 1.0, 2.0, 0.5, 1.5, 10.0]]
+
+        mocker.patch.object(alt_exchange, "fetchOHLCV").side_effect = slow_fetch_ohlcv
+
+        # Workers looking up the same minute share one request
+        timestamps: List[datetime] = [PREFETCH_TIMESTAMP + timedelta(seconds=second) for second in range(0, 40, 10)]
+        with ThreadPoolExecutor(max_workers=len(timestamps)) as executor:
+            bars: List[Optional[HistoricalBar]] = list(
+                executor.map(lambda timestamp: plugin.find_historical_bar("BTC", "USDT", timestamp, ALT_EXCHANGE), timestamps)
+            )
+        assert all(historical_bar is not None and historical_bar.high == RP2Decimal("2.0") for historical_bar in bars)
+        assert alt_exchange.fetchOHLCV.call_count == 1
+
+    def test_coalesced_conversion_rates(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+
+        def slow_native_source(timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[HistoricalBar]:
+            # pylint: disable=unused-argument
+            sleep(0.2)
+            return HistoricalBar(
+                duration=timedelta(minutes=1),
+                timestamp=timestamp,
+                open=BAR_OPEN,
+                high=BAR_HIGH,
+                low=BAR_LOW,
+                close=BAR_CLOSE,
+                volume=BAR_VOLUME,
+            )
+
+        native_source = mocker.patch.object(plugin, "get_historic_bar_from_native_source")
+        native_source.side_effect = slow_native_source
+
+        # The fills of an order are priced with one fetch, whether they are looked up concurrently or one after the other
+        timestamps: List[datetime] = [BAR_TIMESTAMP + timedelta(seconds=second) for second in range(0, 40, 10)]
+        with ThreadPoolExecutor(max_workers=len(timestamps)) as executor:
+            rates: List[Optional[RP2Decimal]] = list(
+                executor.map(lambda timestamp: plugin.get_conversion_rate(timestamp, "BTC", "USD", TEST_EXCHANGE), timestamps)
+            )
+        assert rates == [BAR_HIGH] * len(timestamps)
+        assert plugin.get_conversion_rate(BAR_TIMESTAMP + timedelta(seconds=50), "BTC", "USD", TEST_EXCHANGE) == BAR_HIGH
+        assert native_source.call_count == 1
+
+        assert plugin.get_conversion_rate(BAR_TIMESTAMP + timedelta(minutes=1), "BTC", "USD", TEST_EXCHANGE) == BAR_HIGH
+        assert native_source.call_count == 2
+
+    def test_csv_reader_parameters(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(
+            Keyword.HISTORICAL_PRICE_HIGH.value, google_api_key="whatever", csv_process_count=2, csv_chunk_cache_size=4
+        )
+
+        csv_reader: KrakenCsvPricing = plugin._get_csv_reader("Kraken")  # pylint: disable=protected-access
+
+        assert getattr(csv_reader, "_Kraken__process_count") == 2
+        assert getattr(csv_reader, "_Kraken__chunk_cache_size") == 4
+
+        # Closing the plugin closes its CSV readers
+        csv_reader_close = mocker.patch.object(csv_reader, "close")
+        plugin.close()
+        csv_reader_close.assert_called_once()
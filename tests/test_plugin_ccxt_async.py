@@ -0,0 +1,175 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Union
+
+import pytest
+from ccxt import BadSymbol, NetworkError, RateLimitExceeded, binance, kraken
+from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2RuntimeError
+
+from dali.abstract_pair_converter_plugin import AssetPairAndTimestamp
+from dali.configuration import Keyword
+from dali.historical_bar_store import open_historical_bar_store
+from dali.plugin.pair_converter.ccxt_async import PairConverterPlugin
+from dali.token_bucket import TokenBucket
+
+TEST_EXCHANGE: str = "Kraken"
+ALT_EXCHANGE: str = "Binance.com"
+TEST_MARKETS: Dict[str, List[str]] = {
+    "BTCUSDT": [ALT_EXCHANGE],
+    "USDTUSD": [TEST_EXCHANGE],
+}
+TEST_GRAPH: Dict[str, Dict[str, None]] = {"BTC": {"USDT": None}, "USDT": {"USD": None}}
+TEST_FIAT_LIST: List[str] = ["EUR", "JPY", "USD"]
+TIMESTAMP: datetime = datetime(2021, 3, 4, 5, 6, tzinfo=timezone.utc)
+HIGHS: Dict[str, float] = {"kraken": 1.25, "binance": 40000.0}
+
+
+# Stands in for the ccxt.async_support clients
+class FakeAsyncExchange:
+    in_flight: int = 0
+    max_in_flight: int = 0
+    instances: List["FakeAsyncExchange"] = []
+
+    def __init__(self, exchange_id: str, config: Dict[str, bool], error: Optional[Exception] = None) -> None:
+        self.high: float = HIGHS[exchange_id]
+        self.config: Dict[str, bool] = config
+        self.error: Optional[Exception] = error
+        self.symbols: List[str] = []
+        self.closed: bool = False
+        FakeAsyncExchange.instances.append(self)
+
+    async def fetch_ohlcv(self, symbol: str, timeframe: str, timestamp: int, candles: int) -> List[List[Union[float, int]]]:
+        # pylint: disable=unused-argument
+        assert not self.closed
+        self.symbols.append(symbol)
+        if self.error is not None:
+            raise self.error
+        FakeAsyncExchange.in_flight += 1
+        FakeAsyncExchange.max_in_flight = max(FakeAsyncExchange.max_in_flight, FakeAsyncExchange.in_flight)
+        await asyncio.sleep(0.01)
+        FakeAsyncExchange.in_flight -= 1
+        return [[timestamp, 1.0, self.high, 0.5, 1.5, 10.0]]
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class TestCcxtAsyncPlugin:
+    @staticmethod
+    def __create_plugin(mocker: Any, error: Optional[Exception] = None, negative_cache_ttl: Optional[int] = None) -> PairConverterPlugin:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        # Reinstantiate plugin now that cache is gone
+        plugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, negative_cache_ttl=negative_cache_ttl)
+        mocker.patch.object(plugin, "_PairConverterPlugin__exchanges", {TEST_EXCHANGE: kraken({}), ALT_EXCHANGE: binance({})})
+        mocker.patch.object(plugin, "_PairConverterPlugin__exchange_markets", {TEST_EXCHANGE: TEST_MARKETS})
+        mocker.patch.object(plugin, "_PairConverterPlugin__exchange_graphs", {TEST_EXCHANGE: TEST_GRAPH})
+        mocker.patch.object(plugin, "_AbstractPairConverterPlugin__fiat_list", TEST_FIAT_LIST)
+        async_support: Any = mocker.patch("dali.plugin.pair_converter.ccxt_async.async_support")
+        for exchange_id in HIGHS:
+            getattr(async_support, exchange_id).side_effect = lambda config, exchange_id=exchange_id: FakeAsyncExchange(exchange_id, config, error)
+        # No Kraken throttling in tests
+        mocker.patch.object(plugin, "_get_token_bucket").return_value = TokenBucket(rate=1000, capacity=10)
+        FakeAsyncExchange.max_in_flight = 0
+        FakeAsyncExchange.instances = []
+        return plugin
+
+    def test_get_conversion_rates(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = self.__create_plugin(mocker)
+        keys: List[AssetPairAndTimestamp] = [AssetPairAndTimestamp(TIMESTAMP + timedelta(days=day), "BTC", "USD", TEST_EXCHANGE) for day in range(3)] + [
+            AssetPairAndTimestamp(TIMESTAMP, "BTC", "USD", TEST_EXCHANGE)
+        ]
+
+        rates = asyncio.run(plugin.get_conversion_rates(keys))
+
+        # Duplicate keys are priced once, and lookups on both exchanges overlap
+        assert list(rates) == keys[:3]
+        assert all(rate == RP2Decimal("40000.0") * RP2Decimal("1.25") for rate in rates.values())
+        binance_exchange, kraken_exchange = sorted(FakeAsyncExchange.instances, key=lambda instance: -instance.high)
+        assert binance_exchange.symbols == ["BTC/USDT"] * 3
+        assert kraken_exchange.symbols == ["USDT/USD"] * 3
+        assert FakeAsyncExchange.max_in_flight > 1
+
+        # Requests are throttled by the token bucket only, and the clients are closed at the end of the batch
+        assert all(not instance.config["enableRateLimit"] and instance.closed for instance in FakeAsyncExchange.instances)
+
+        # Same cache as the blocking plugin
+        assert plugin.get_conversion_rate(TIMESTAMP, "BTC", "USD", TEST_EXCHANGE) == RP2Decimal("40000.0") * RP2Decimal("1.25")
+        rates = asyncio.run(plugin.get_conversion_rates(keys))
+        assert len(FakeAsyncExchange.instances) == 2
+
+    def test_shared_hops(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = self.__create_plugin(mocker)
+        keys: List[AssetPairAndTimestamp] = [
+            AssetPairAndTimestamp(TIMESTAMP, "BTC", "USD", TEST_EXCHANGE),
+            AssetPairAndTimestamp(TIMESTAMP + timedelta(seconds=10), "USDT", "USD", TEST_EXCHANGE),
+        ]
+
+        # Both routes end with the USDT/USD hop: concurrent lookups of the same minute share one search
+        rates: Dict[AssetPairAndTimestamp, Optional[RP2Decimal]] = asyncio.run(plugin.get_conversion_rates(keys))
+        assert rates == {keys[0]: RP2Decimal("40000.0") * RP2Decimal("1.25"), keys[1]: RP2Decimal("1.25")}
+        kraken_exchange: FakeAsyncExchange = next(instance for instance in FakeAsyncExchange.instances if instance.high == HIGHS["kraken"])
+        assert kraken_exchange.symbols == ["USDT/USD"]
+
+    def test_overlapping_batches(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = self.__create_plugin(mocker)
+        short_batch: List[AssetPairAndTimestamp] = [AssetPairAndTimestamp(TIMESTAMP, "BTC", "USD", TEST_EXCHANGE)]
+        long_batch: List[AssetPairAndTimestamp] = [AssetPairAndTimestamp(TIMESTAMP + timedelta(days=day), "BTC", "USD", TEST_EXCHANGE) for day in range(1, 6)]
+
+        async def get_both_batches() -> List[Dict[AssetPairAndTimestamp, Optional[RP2Decimal]]]:
+            return list(await asyncio.gather(plugin.get_conversion_rates(long_batch), plugin.get_conversion_rates(short_batch)))
+
+        # Each batch has its own clients: the short one doesn't close the clients the long one is still using
+        long_rates, short_rates = asyncio.run(get_both_batches())
+        assert list(long_rates) == long_batch
+        assert list(short_rates) == short_batch
+        assert len(FakeAsyncExchange.instances) == 4
+        assert all(instance.closed for instance in FakeAsyncExchange.instances)
+
+    def test_retries(self, mocker: Any) -> None:
+        async def no_sleep(delay: float) -> None:
+            # pylint: disable=unused-argument
+            pass
+
+        keys: List[AssetPairAndTimestamp] = [AssetPairAndTimestamp(TIMESTAMP, "BTC", "USD", TEST_EXCHANGE)]
+
+        # Requests that the exchange keeps refusing (3 attempts per granularity) don't fail the batch, and they aren't recorded as misses
+        plugin: PairConverterPlugin = self.__create_plugin(mocker, RateLimitExceeded("Too many requests"), negative_cache_ttl=24)
+        mocker.patch("dali.plugin.pair_converter.ccxt_async.asyncio.sleep", no_sleep)
+        assert asyncio.run(plugin.get_conversion_rates(keys)) == {keys[0]: None}
+        assert [len(instance.symbols) for instance in FakeAsyncExchange.instances] == [18, 18]
+        assert asyncio.run(plugin.get_conversion_rates(keys)) == {keys[0]: None}
+        assert [len(instance.symbols) for instance in FakeAsyncExchange.instances] == [18, 18, 18, 18]
+
+        # Markets that the exchange doesn't have are requested once and recorded as misses
+        plugin = self.__create_plugin(mocker, BadSymbol("kraken does not have market symbol"), negative_cache_ttl=24)
+        assert asyncio.run(plugin.get_conversion_rates(keys)) == {keys[0]: None}
+        assert [len(instance.symbols) for instance in FakeAsyncExchange.instances] == [1, 1]
+        assert asyncio.run(plugin.get_conversion_rates(keys)) == {keys[0]: None}
+        assert [len(instance.symbols) for instance in FakeAsyncExchange.instances] == [1, 1]
+
+        # An exchange that stays unavailable fails the batch after 10 attempts
+        plugin = self.__create_plugin(mocker, NetworkError("Connection refused"))
+        with pytest.raises(RP2RuntimeError, match="Server error"):
+            asyncio.run(plugin.get_conversion_rates(keys))
+        assert max(len(instance.symbols) for instance in FakeAsyncExchange.instances) == 10
+        assert all(instance.closed for instance in FakeAsyncExchange.instances)
@@ -0,0 +1,88 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timezone
+from typing import Any
+
+import pytest
+from rp2.rp2_decimal import RP2Decimal
+from rp2.rp2_error import RP2ValueError
+
+from dali.abstract_pair_converter_plugin import AssetPairAndExchange
+from dali.configuration import Keyword
+from dali.plugin.pair_converter.ecb_csv import PairConverterPlugin
+
+RATE_FILE: str = "input/test_ecb_rates.csv"
+TEST_EXCHANGE: str = "Kraken"
+# Saturday: the rates of Friday 2022-12-30 apply until the next published day
+WEEKEND_TIMESTAMP: datetime = datetime(2022, 12, 31, 12, 0, tzinfo=timezone.utc)
+
+
+class TestEcbCsvPlugin:
+    def test_fiat_list(self) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, RATE_FILE)
+
+        assert sorted(plugin.fiat_list) == ["CYP", "EUR", "GBP", "JPY", "USD"]
+
+    def test_historical_prices(self, mocker: Any) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, RATE_FILE)
+        # No network access
+        session_get: Any = mocker.patch.object(plugin, "_AbstractPairConverterPlugin__session").get
+
+        data = plugin.get_historic_bar_from_native_source(datetime(2023, 1, 3, 15, 0, tzinfo=timezone.utc), "EUR", "USD", TEST_EXCHANGE)
+        assert data
+        assert data.high == RP2Decimal("1.0545")
+
+        data = plugin.get_historic_bar_from_native_source(WEEKEND_TIMESTAMP, "USD", "JPY", TEST_EXCHANGE)
+        assert data
+        assert data.close == RP2Decimal("140.66") / RP2Decimal("1.0666")
+
+        data = plugin.get_historic_bar_from_native_source(datetime(2008, 1, 5, tzinfo=timezone.utc), "CYP", "EUR", TEST_EXCHANGE)
+        assert data
+        assert data.open == RP2Decimal("1") / RP2Decimal("0.585274")
+
+        # Missing rates, unknown currencies and days outside the file are left to other pair converters
+        assert plugin.get_historic_bar_from_native_source(WEEKEND_TIMESTAMP, "CYP", "EUR", TEST_EXCHANGE) is None
+        assert plugin.get_historic_bar_from_native_source(WEEKEND_TIMESTAMP, "BTC", "EUR", TEST_EXCHANGE) is None
+        assert plugin.get_historic_bar_from_native_source(datetime(2007, 12, 30, tzinfo=timezone.utc), "USD", "EUR", TEST_EXCHANGE) is None
+        assert plugin.get_historic_bar_from_native_source(datetime(2023, 1, 5, tzinfo=timezone.utc), "USD", "EUR", TEST_EXCHANGE) is None
+
+        assert plugin.get_conversion_rate(WEEKEND_TIMESTAMP, "EUR", "GBP", TEST_EXCHANGE) == RP2Decimal("0.88693")
+        assert session_get.call_count == 0
+
+    def test_prefetch_historical_bars(self) -> None:
+        plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, RATE_FILE)
+        late_timestamp: datetime = datetime(2023, 2, 1, tzinfo=timezone.utc)
+
+        remaining = plugin.prefetch_historical_bars(
+            {
+                AssetPairAndExchange("USD", "JPY", TEST_EXCHANGE): [WEEKEND_TIMESTAMP, late_timestamp],
+                AssetPairAndExchange("BTC", "USD", TEST_EXCHANGE): [WEEKEND_TIMESTAMP],
+            }
+        )
+
+        assert remaining == {
+            AssetPairAndExchange("USD", "JPY", TEST_EXCHANGE): [late_timestamp],
+            AssetPairAndExchange("BTC", "USD", TEST_EXCHANGE): [WEEKEND_TIMESTAMP],
+        }
+
+    def test_bad_rate_file(self, tmp_path: Any) -> None:
+        rate_file: Any = tmp_path / "rates.csv"
+        rate_file.write_text("Day,USD\n2023-01-03,1.0545\n")
+        with pytest.raises(RP2ValueError, match="first column must be 'Date'"):
+            PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, str(rate_file))
+
+        rate_file.write_text("Date,USD,EUR\n2023-01-03,1.0545,1\n")
+        with pytest.raises(RP2ValueError, match="base currency EUR is also a rate column"):
+            PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value, str(rate_file))
@@ -19,9 +19,9 @@ from typing import Any
 from rp2.rp2_decimal import RP2Decimal
 
 from dali.abstract_pair_converter_plugin import AssetPairAndTimestamp
-from dali.cache import CACHE_DIR, load_from_cache
 from dali.configuration import Keyword
 from dali.historical_bar import HistoricalBar
+from dali.historical_bar_store import open_historical_bar_store
 from dali.plugin.pair_converter.historic_crypto import PairConverterPlugin
 
 BAR_DURATION: timedelta = timedelta(seconds=60)
@@ -36,7 +36,7 @@ BAR_VOLUME: RP2Decimal = RP2Decimal("1")
 class TestHistoricCryptoPlugin:
     def test_historical_prices(self, mocker: Any) -> None:
         plugin: PairConverterPlugin = PairConverterPlugin(Keyword.HISTORICAL_PRICE_HIGH.value)
-        cache_path = os.path.join(CACHE_DIR, plugin.cache_key())
+        cache_path = open_historical_bar_store(plugin.cache_key()).path
         if os.path.exists(cache_path):
             os.remove(cache_path)
 
@@ -73,11 +73,11 @@ class TestHistoricCryptoPlugin:
         plugin.save_historical_price_cache()
 
         # Load plugin cache and verify
-        cache = load_from_cache(plugin.cache_key())
+        cache = open_historical_bar_store(plugin.cache_key())
         key = AssetPairAndTimestamp(BAR_TIMESTAMP, "BTC", "USD", "Coinbase")
         assert len(cache) == 1, str(cache)
         assert key in cache
-        data = cache[key]
+        data = cache.get(key)
 
         assert data
         assert data.timestamp == BAR_TIMESTAMP
@@ -14,16 +14,21 @@
 
 # pylint: disable=protected-access
 
-from datetime import datetime
+from datetime import datetime, timezone
+from gzip import open as gopen
+from multiprocessing.pool import ThreadPool
 from os import listdir, makedirs, path, remove, unlink
-from typing import Any, List, Optional
+from time import sleep
+from typing import Any, Dict, List, Optional
+from zipfile import ZipFile
 
 from rp2.rp2_decimal import RP2Decimal
 from rp2.rp2_error import RP2RuntimeError
 
 from dali.cache import CACHE_DIR
 from dali.historical_bar import HistoricalBar
-from dali.plugin.pair_converter.csv.kraken import Kraken
+from dali.kraken_ingest import ingest_archives
+from dali.plugin.pair_converter.csv.kraken import Kraken, _PairStartEnd
 
 _CACHE_DIRECTORY: str = "output/kraken_test"
 
@@ -49,7 +54,8 @@ class TestKrakenCsvDownload:
         if not path.exists(_CACHE_DIRECTORY):
             makedirs(_CACHE_DIRECTORY)
         with open("input/USD_OHLCVT_test.zip", "rb") as file:
-            mocker.patch.object(kraken_csv, "_google_file_to_bytes").return_value = file.read()
+            zip_file_bytes: bytes = file.read()
+        mocker.patch.object(kraken_csv, "_google_file_to_file").side_effect = lambda file_name, output_file: output_file.write(zip_file_bytes) > 0
 
         test_bar: Optional[HistoricalBar] = kraken_csv.find_historical_bar("USDT", "USD", datetime.fromtimestamp(1601856000))
         files: List[str] = listdir(_CACHE_DIRECTORY)
@@ -57,7 +63,7 @@ class TestKrakenCsvDownload:
         # Test if proper price was retrieved and file was chunked
         assert test_bar
         assert test_bar.low == RP2Decimal("1.778")
-        assert "USDTUSD_1594080000_5.csv.gz" in files
+        assert "USDTUSD_1594080000_5.npy" in files
 
         test_bar = kraken_csv.find_historical_bar("USDT", "USD", datetime.fromtimestamp(1601683300))
 
@@ -65,3 +71,137 @@ class TestKrakenCsvDownload:
         # Also that proper price was retrieved from chunked files in the cache folder
         assert test_bar
         assert test_bar.low == RP2Decimal("1.6668")
+
+    def test_legacy_chunk(self, mocker: Any) -> None:
+        kraken_csv = Kraken("whatever")
+        mocker.patch.object(kraken_csv, "_Kraken__CACHE_DIRECTORY", _CACHE_DIRECTORY)
+        mocker.patch.object(kraken_csv, "_Kraken__cached_pairs", {"BTCUSD1": _PairStartEnd(start=1601856000, end=1601856120)})
+        if not path.exists(_CACHE_DIRECTORY):
+            makedirs(_CACHE_DIRECTORY)
+
+        # Chunk written by an earlier version
+        chunk_name: str = "BTCUSD_1601856000_1"
+        for extension in [".npy", ".csv.gz"]:
+            if path.exists(path.join(_CACHE_DIRECTORY, chunk_name + extension)):
+                remove(path.join(_CACHE_DIRECTORY, chunk_name + extension))
+        with gopen(path.join(_CACHE_DIRECTORY, chunk_name + ".csv.gz"), "wt", encoding="utf-8", newline="") as chunk_file:
+            chunk_file.write("1601856000,10600.1,10610.5,10590,10605.25,1.5,12\n1601856060,10605.25,10620,10600,10615,0.123456789,3\n")
+
+        test_bar: Optional[HistoricalBar] = kraken_csv._retrieve_cached_bar("BTC", "USD", 1601856070)
+
+        assert test_bar
+        assert test_bar.timestamp == datetime.fromtimestamp(1601856060, timezone.utc)
+        assert test_bar.high == RP2Decimal("10620")
+        assert test_bar.volume == RP2Decimal("0.123456789")
+        assert path.exists(path.join(_CACHE_DIRECTORY, chunk_name + ".npy"))
+
+        # The decoded chunk is kept in memory for the next lookups
+        assert kraken_csv.chunk_cache_misses == 1
+        assert kraken_csv.chunk_cache_hits == 0
+        test_bar = kraken_csv._retrieve_cached_bar("BTC", "USD", 1601856000)
+        assert test_bar
+        assert test_bar.close == RP2Decimal("10605.25")
+        assert kraken_csv.chunk_cache_misses == 1
+        assert kraken_csv.chunk_cache_hits == 1
+
+    def test_concurrent_chunk_misses(self, mocker: Any) -> None:
+        kraken_csv = Kraken("whatever", cache_directory=_CACHE_DIRECTORY)
+        mocker.patch.object(kraken_csv, "_Kraken__cached_pairs", {"ETHUSD1": _PairStartEnd(start=1601856000, end=1601856060)})
+        kraken_csv._save_chunk(path.join(_CACHE_DIRECTORY, "ETHUSD_1601856000_1.npy"), [["1601856000", "350", "351", "349", "350.5", "2", "7"]])
+        load_chunk = kraken_csv._load_chunk
+
+        def slow_load_chunk(chunk_filepath: str) -> Any:
+            sleep(0.2)
+            return load_chunk(chunk_filepath)
+
+        mocked_load_chunk = mocker.patch.object(kraken_csv, "_load_chunk", side_effect=slow_load_chunk)
+
+        # Threads missing the same chunk wait for the one decoding it
+        with ThreadPool(4) as pool:
+            test_bars: List[Optional[HistoricalBar]] = pool.map(lambda _: kraken_csv._retrieve_cached_bar("ETH", "USD", 1601856000), range(4))
+
+        assert all(test_bar and test_bar.close == RP2Decimal("350.5") for test_bar in test_bars)
+        mocked_load_chunk.assert_called_once()
+        assert kraken_csv.chunk_cache_misses == 1
+
+    def test_ingest_archive(self, mocker: Any) -> None:
+        kraken_csv = Kraken("")
+        mocker.patch.object(kraken_csv, "_Kraken__CACHE_DIRECTORY", _CACHE_DIRECTORY)
+        mocker.patch.object(kraken_csv, "cache_key").return_value = "Test-" + kraken_csv.cache_key()
+        if not path.exists(_CACHE_DIRECTORY):
+            makedirs(_CACHE_DIRECTORY)
+        cache_path = path.join(CACHE_DIR, kraken_csv.cache_key())
+        if path.exists(cache_path):
+            remove(cache_path)
+        mocker.patch.object(kraken_csv, "_get_pair_assets").return_value = {"USDTUSD": ("USDT", "USD"), "XBTUSDT": ("XBT", "USDT")}
+
+        cached_pairs: Dict[str, _PairStartEnd] = kraken_csv.ingest_archive("input/USD_OHLCVT_test.zip")
+
+        assert sorted(cached_pairs) == ["USDTUSD1", "USDTUSD1440", "USDTUSD15", "USDTUSD5", "USDTUSD60", "USDTUSD720"]
+        assert "USDTUSD_1594080000_5.npy" in listdir(_CACHE_DIRECTORY)
+        # The assets come from the market metadata
+        assert (cached_pairs["USDTUSD5"].base_asset, cached_pairs["USDTUSD5"].quote_asset) == ("USDT", "USD")
+
+        # Without metadata the assets of the pairs are unknown
+        mocker.patch.object(kraken_csv, "_get_pair_assets").return_value = {}
+        assert kraken_csv.ingest_archive("input/USD_OHLCVT_test.zip")["USDTUSD5"].base_asset is None
+
+        # Once saved, lookups don't need to download anything
+        kraken_csv.save_cached_pairs(cached_pairs)
+        google_file_to_file = mocker.patch.object(kraken_csv, "_google_file_to_file")
+        test_bar: Optional[HistoricalBar] = kraken_csv.find_historical_bar("USDT", "USD", datetime.fromtimestamp(1601856000))
+
+        assert test_bar
+        assert test_bar.low == RP2Decimal("1.778")
+        google_file_to_file.assert_not_called()
+
+    def test_ingest_archive_process_pool(self, mocker: Any) -> None:
+        mocker.patch.object(Kraken, "_get_pair_assets").return_value = {"USDTUSD": ("USDT", "USD")}
+        kraken_csv = Kraken("", process_count=2, cache_directory=_CACHE_DIRECTORY)
+        if not path.exists(_CACHE_DIRECTORY):
+            makedirs(_CACHE_DIRECTORY)
+        for filename in listdir(_CACHE_DIRECTORY):
+            unlink(path.join(_CACHE_DIRECTORY, filename))
+
+        # Zip members are split by worker processes, which send the time ranges back to the parent
+        cached_pairs: Dict[str, _PairStartEnd] = kraken_csv.ingest_archive("input/USD_OHLCVT_test.zip")
+
+        assert sorted(cached_pairs) == ["USDTUSD1", "USDTUSD1440", "USDTUSD15", "USDTUSD5", "USDTUSD60", "USDTUSD720"]
+        assert cached_pairs == Kraken("", cache_directory=_CACHE_DIRECTORY).ingest_archive("input/USD_OHLCVT_test.zip")
+        assert "USDTUSD_1594080000_5.npy" in listdir(_CACHE_DIRECTORY)
+
+    def test_ingest_archive_without_csv_files(self) -> None:
+        archive_path: str = path.join(_CACHE_DIRECTORY, "EMPTY_OHLCVT_test.zip")
+        if not path.exists(_CACHE_DIRECTORY):
+            makedirs(_CACHE_DIRECTORY)
+        with ZipFile(archive_path, "w") as zipped_ohlcvt:
+            zipped_ohlcvt.writestr("README.txt", "No markets")
+
+        # No worker processes are started when there is nothing to split
+        assert not Kraken("", process_count=2, cache_directory=_CACHE_DIRECTORY).ingest_archive(archive_path)
+        remove(archive_path)
+
+    def test_ingest_archives(self, mocker: Any) -> None:
+        # Worker processes are forked: they inherit the patched class
+        mocker.patch.object(Kraken, "_Kraken__CACHE_DIRECTORY", _CACHE_DIRECTORY)
+        mocker.patch.object(Kraken, "_Kraken__CACHE_KEY", "Test-Kraken-csv-download")
+        mocker.patch.object(Kraken, "_get_pair_assets").return_value = {"USDTUSD": ("USDT", "USD")}
+        if not path.exists(_CACHE_DIRECTORY):
+            makedirs(_CACHE_DIRECTORY)
+        for filename in listdir(_CACHE_DIRECTORY):
+            unlink(path.join(_CACHE_DIRECTORY, filename))
+        cache_path = path.join(CACHE_DIR, "Test-Kraken-csv-download")
+        if path.exists(cache_path):
+            remove(cache_path)
+
+        cached_pairs: Dict[str, _PairStartEnd] = ingest_archives(["input/USD_OHLCVT_test.zip"], process_count=1)
+
+        assert sorted(cached_pairs) == ["USDTUSD1", "USDTUSD1440", "USDTUSD15", "USDTUSD5", "USDTUSD60", "USDTUSD720"]
+        assert cached_pairs["USDTUSD5"].base_asset == "USDT"
+        chunk_file_names: List[str] = listdir(_CACHE_DIRECTORY)
+        assert "USDTUSD_1594080000_5.npy" in chunk_file_names
+        assert {chunk_file_name.rsplit("_", 1)[1] for chunk_file_name in chunk_file_names} == {"1.npy", "5.npy", "15.npy", "60.npy", "720.npy", "1440.npy"}
+        # The time ranges are saved: lookups find the chunks
+        test_bar: Optional[HistoricalBar] = Kraken("").find_historical_bar("USDT", "USD", datetime.fromtimestamp(1601856000))
+        assert test_bar
+        assert test_bar.low == RP2Decimal("1.778")
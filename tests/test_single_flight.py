@@ -0,0 +1,114 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event
+from time import sleep
+from typing import List
+
+from rp2.rp2_error import RP2RuntimeError
+
+from dali.single_flight import AsyncSingleFlight, SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_result(self) -> None:
+        single_flight: SingleFlight[str, int] = SingleFlight()
+        started: Event = Event()
+        release: Event = Event()
+        calls: List[str] = []
+
+        def slow_function() -> int:
+            calls.append("slow")
+            started.set()
+            release.wait(5)
+            return 42
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            leader: Future[int] = executor.submit(single_flight.do, "BTC", slow_function)
+            self.assertTrue(started.wait(5))
+            followers: List[Future[int]] = [executor.submit(single_flight.do, "BTC", lambda: 0) for _ in range(3)]
+            # Different keys don't wait for each other
+            self.assertEqual(single_flight.do("ETH", lambda: 7), 7)
+            # Give the followers time to start waiting
+            sleep(0.2)
+            release.set()
+
+            self.assertEqual(leader.result(5), 42)
+            results: List[int] = [follower.result(5) for follower in followers]
+            expected_results: List[int] = [42, 42, 42]
+            self.assertEqual(results, expected_results)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(single_flight), 0)
+
+    def test_exception_is_shared(self) -> None:
+        single_flight: SingleFlight[str, int] = SingleFlight()
+        started: Event = Event()
+        release: Event = Event()
+
+        def failing_function() -> int:
+            started.set()
+            release.wait(5)
+            raise RP2RuntimeError("Server error")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader: Future[int] = executor.submit(single_flight.do, "BTC", failing_function)
+            self.assertTrue(started.wait(5))
+            follower: Future[int] = executor.submit(single_flight.do, "BTC", lambda: 0)
+            sleep(0.2)
+            release.set()
+
+            with self.assertRaisesRegex(RP2RuntimeError, "Server error"):
+                leader.result(5)
+            with self.assertRaisesRegex(RP2RuntimeError, "Server error"):
+                follower.result(5)
+
+        # Finished calls are not remembered
+        self.assertEqual(single_flight.do("BTC", lambda: 1), 1)
+
+    def test_async_concurrent_calls_share_result(self) -> None:
+        single_flight: AsyncSingleFlight[str, int] = AsyncSingleFlight()
+        calls: List[str] = []
+
+        async def slow_function() -> int:
+            calls.append("slow")
+            await asyncio.sleep(0.1)
+            return 42
+
+        async def failing_function() -> int:
+            await asyncio.sleep(0.1)
+            raise RP2RuntimeError("Server error")
+
+        async def call_all() -> List[int]:
+            return list(await asyncio.gather(*(single_flight.do("BTC", slow_function) for _ in range(4)), single_flight.do("ETH", lambda: asyncio.sleep(0, 7))))
+
+        results: List[int] = asyncio.run(call_all())
+        expected_results: List[int] = [42, 42, 42, 42, 7]
+        self.assertEqual(results, expected_results)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(single_flight), 0)
+
+        async def fail_all() -> List[object]:
+            return list(await asyncio.gather(*(single_flight.do("BTC", failing_function) for _ in range(2)), return_exceptions=True))
+
+        errors: List[object] = asyncio.run(fail_all())
+        self.assertTrue(all(isinstance(error, RP2RuntimeError) for error in errors))
+        self.assertEqual(len(single_flight), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright 2022 eprbell
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from typing import List
+
+from rp2.rp2_error import RP2ValueError
+
+from dali.token_bucket import TokenBucket
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now: float = 100.0
+        self.sleeps: List[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve(self) -> None:
+        clock: FakeClock = FakeClock()
+        token_bucket: TokenBucket = TokenBucket(rate=0.5, capacity=2, clock=clock.time, sleeper=clock.sleep)
+
+        # The bucket starts full, then each extra request waits for one more token
+        self.assertEqual(token_bucket.reserve(), 0.0)
+        self.assertEqual(token_bucket.reserve(), 0.0)
+        self.assertEqual(token_bucket.reserve(), 2.0)
+        self.assertEqual(token_bucket.reserve(), 4.0)
+
+        # Tokens refill over time, but never beyond capacity
+        clock.now += 100.0
+        self.assertEqual(token_bucket.reserve(), 0.0)
+        self.assertEqual(token_bucket.reserve(), 0.0)
+        self.assertEqual(token_bucket.reserve(), 2.0)
+
+    def test_acquire(self) -> None:
+        clock: FakeClock = FakeClock()
+        token_bucket: TokenBucket = TokenBucket(rate=2, clock=clock.time, sleeper=clock.sleep)
+
+        for _ in range(3):
+            token_bucket.acquire()
+
+        expected_sleeps: List[float] = [0.5, 0.5]
+        self.assertEqual(clock.sleeps, expected_sleeps)
+        self.assertEqual(clock.now, 101.0)
+
+    def test_bad_parameters(self) -> None:
+        with self.assertRaisesRegex(RP2ValueError, "rate must be positive"):
+            TokenBucket(rate=0)
+        with self.assertRaisesRegex(RP2ValueError, "capacity must be at least 1"):
+            TokenBucket(rate=1, capacity=0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,13 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import NamedTuple, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional
 
 import pytest
+from rp2.rp2_decimal import RP2Decimal
 
+from dali.abstract_pair_converter_plugin import (
+    AbstractPairConverterPlugin,
+    AssetPairAndExchange,
+)
 from dali.configuration import Keyword
+from dali.historical_bar import HistoricalBar
+from dali.in_transaction import InTransaction
 from dali.intra_transaction import IntraTransaction
-from dali.transaction_resolver import _resolve_intra_intra_transaction
+from dali.transaction_resolver import (
+    _resolve_intra_intra_transaction,
+    resolve_transactions,
+)
 
 
 class IntraTransactionNotesTestCase(NamedTuple):
@@ -84,3 +95,97 @@ def test_resolve_intra_intra_transaction(prior_notes: Optional[str], notes1: Opt
     assert resolved.to_holder == "to_holder2"
     assert resolved.spot_price == "1000.0"
     assert resolved.notes == resolved_notes
+
+
+class PrefetchRecordingPairConverter(AbstractPairConverterPlugin):
+    def __init__(self) -> None:
+        super().__init__(Keyword.HISTORICAL_PRICE_HIGH.value)
+        self.prefetch_requests: List[Dict[AssetPairAndExchange, List[datetime]]] = []
+
+    def name(self) -> str:
+        return "Test-prefetch-recorder"
+
+    def cache_key(self) -> str:
+        return self.name()
+
+    def prefetch_historical_bars(self, pair_2_timestamps: Dict[AssetPairAndExchange, List[datetime]]) -> Dict[AssetPairAndExchange, List[datetime]]:
+        self.prefetch_requests.append(pair_2_timestamps)
+        return {}
+
+    def get_historic_bar_from_native_source(self, timestamp: datetime, from_asset: str, to_asset: str, exchange: str) -> Optional[HistoricalBar]:
+        return HistoricalBar(
+            duration=timedelta(minutes=1),
+            timestamp=timestamp,
+            open=RP2Decimal("1000"),
+            high=RP2Decimal("1000"),
+            low=RP2Decimal("1000"),
+            close=RP2Decimal("1000"),
+            volume=RP2Decimal("1"),
+        )
+
+
+def _make_interest(unique_id: str, timestamp: str, spot_price: str, asset: str = "BTC") -> InTransaction:
+    return InTransaction(
+        plugin="plugin",
+        unique_id=unique_id,
+        raw_data="raw_data",
+        timestamp=timestamp,
+        asset=asset,
+        exchange="Coinbase",
+        holder="Bob",
+        transaction_type="Interest",
+        spot_price=spot_price,
+        crypto_in="0.001",
+    )
+
+
+def test_prefetch_spot_prices() -> None:
+    """Verify missing spot prices are deduplicated by minute and prefetched in one call before resolution."""
+    pair_converter = PrefetchRecordingPairConverter()
+    transactions: List[InTransaction] = [
+        _make_interest(Keyword.UNKNOWN.value, "2022-01-01 00:00:10+00:00", Keyword.UNKNOWN.value),
+        _make_interest(Keyword.UNKNOWN.value, "2022-01-01 00:00:50+00:00", Keyword.UNKNOWN.value),
+        _make_interest("id_1", "2022-01-02 00:00:00+00:00", Keyword.UNKNOWN.value),
+        _make_interest("id_2", "2022-01-03 00:00:00+00:00", "900"),
+    ]
+    global_configuration = {
+        Keyword.NATIVE_FIAT.value: "USD",
+        Keyword.HISTORICAL_PAIR_CONVERTERS.value: [pair_converter],
+    }
+
+    resolved = resolve_transactions(transactions, global_configuration, True)  # type: ignore
+
+    assert pair_converter.prefetch_requests == [
+        {
+            AssetPairAndExchange("BTC", "USD", "Coinbase"): [
+                datetime(2022, 1, 1, tzinfo=timezone.utc),
+                datetime(2022, 1, 2, tzinfo=timezone.utc),
+            ]
+        }
+    ]
+    assert [transaction.spot_price for transaction in resolved] == ["1000", "1000", "1000", "900"]  # type: ignore
+
+
+def test_resolve_transactions_by_asset() -> None:
+    """Verify that resolving on several threads returns the same transactions in the same order as resolving on one."""
+    global_configuration = {
+        Keyword.NATIVE_FIAT.value: "USD",
+        Keyword.HISTORICAL_PAIR_CONVERTERS.value: [PrefetchRecordingPairConverter()],
+    }
+    transactions: List[InTransaction] = [
+        _make_interest(
+            Keyword.UNKNOWN.value if index % 3 == 0 else f"id_{index}",
+            f"2022-01-{index % 28 + 1:02d} 00:00:00+00:00",
+            Keyword.UNKNOWN.value if index % 2 == 0 else str(index),
+            ["BTC", "ETH", "SOL", "ADA"][index % 4] if index < 20 else "BTC",
+        )
+        for index in range(40)
+    ]
+
+    sequential = resolve_transactions(transactions, global_configuration, True)  # type: ignore
+    parallel = resolve_transactions(transactions, global_configuration, True, thread_count=3)  # type: ignore
+
+    assert [(transaction.unique_id, transaction.asset, transaction.spot_price) for transaction in parallel] == [  # type: ignore
+        (transaction.unique_id, transaction.asset, transaction.spot_price) for transaction in sequential  # type: ignore
+    ]
+    assert len(parallel) == len(transactions)